@@ -14,6 +14,7 @@ import pprint as pp
 import sys
 import time
 import warnings
+from collections import Counter
 from datetime import datetime
 from pathlib import Path
 import logging
@@ -25,14 +26,23 @@ logging.basicConfig(
     level=logging.INFO,
 )
 
-from utils import DisableLogger, print_spacer, remove_trailing_punctuation
-
-with DisableLogger():
-    from cleantext import clean
+from utils import chunks, clean, print_spacer, remove_trailing_punctuation
+from cancellation import STATUS_CANCELLED, STATUS_OK
 
 warnings.filterwarnings(action="ignore", message=".*gradient_checkpointing*")
 
-from aitextgen import aitextgen
+# torch, transformers (via generation_utils) and aitextgen (via the registry) are imported when a response is
+# generated, not when this module is imported: --help and argument errors return immediately.
+# see import_report.py for the import time of each module
+from model_registry import BACKENDS, PRECISIONS, get_model, get_model_key
+from token_budget import (
+    count_tokens,
+    get_context_window,
+    get_history_budget,
+    trim_history_to_tokens,
+)
+from turn_history import TurnHistory
+from turn_utils import find_turn_end, get_visible_text, is_name_line
 
 
 def extract_response(full_resp: list, plist: list, verbose: bool = False):
@@ -48,12 +58,15 @@ def extract_response(full_resp: list, plist: list, verbose: bool = False):
         response (str): the response, without the prompt
     """
     bot_response = []
+    remaining = Counter(plist)  # prompt lines not matched yet, one lookup per line
+    n_remaining = len(plist)
     for line in full_resp:
-        if line.lower() in plist and len(bot_response) < len(plist):
-            first_loc = plist.index(line)
-            del plist[first_loc]
+        if remaining[line.lower()] > 0 and len(bot_response) < n_remaining:
+            remaining[line.lower()] -= 1
+            n_remaining -= 1
             continue
         bot_response.append(line)
+    plist = list(remaining.elements())
     full_resp = [clean(ele, lower=False) for ele in bot_response]
 
     if verbose:
@@ -91,7 +104,7 @@ def get_bot_response(
             name_counter += 1
             break_safe = True
             continue
-        if ":" in resline and name_resp.lower() not in resline.lower():
+        if is_name_line(resline) and name_resp.lower() not in resline.lower():
             break
         if name_spk.lower() in resline.lower() and not break_safe:
             break
@@ -104,48 +117,62 @@ def get_bot_response(
     return fn_resp
 
 
-def query_gpt_model(
-    folder_path: str or Path,
-    prompt_msg: str,
-    conversation_history: list = None,
-    speaker: str = None,
-    responder: str = None,
-    resp_length: int = 48,
-    kparam: int = 20,
-    temp: float = 0.4,
-    top_p: float = 0.9,
-    aitextgen_obj=None,
-    verbose: bool = False,
-    use_gpu: bool = False,
+def isolate_reply(
+    generated_text: str, speaker: str, responder: str, verbose: bool = False
 ):
     """
-    query_gpt_model - queries the GPT model and returns the first response by <responder>
+    isolate_reply - get the responder's reply from text generated after the prompt (i.e. there is no prompt text to strip).
+    The text is cut at the end of the responder's turn in one pass, so only the lines of the reply are looked at and
+    cleaned: the cost does not depend on the length of the conversation.
 
     Args:
-        folder_path (str or Path): the path to the model folder
-        prompt_msg (str): the prompt message
-        conversation_history (list, optional): the conversation history. Defaults to None.
-        speaker (str, optional): the name of the speaker. Defaults to None.
-        responder (str, optional): the name of the responder. Defaults to None.
-        resp_length (int, optional): the length of the response in tokens. Defaults to 48.
-        kparam (int, optional): the k parameter for the top_k. Defaults to 40.
-        temp (float, optional): the temperature for the softmax. Defaults to 0.7.
-        top_p (float, optional): the top_p parameter for nucleus sampling. Defaults to 0.9.
-        aitextgen_obj (_type_, optional): a pre-loaded aitextgen object. Defaults to None.
+        generated_text (str): the generated text only (decoded from the new token ids), starting after the "responder:" tag
+        speaker (str): the name of the speaker
+        responder (str): the name of the responder
         verbose (bool, optional): Defaults to False.
-        use_gpu (bool, optional): Defaults to False.
 
     Returns:
-        model_resp (dict): the model response, as a dict with the following keys: out_text (str) the generated text and full_conv (dict) the conversation history
+        str: the bot response
     """
+    turn_end = find_turn_end(generated_text, speaker, responder)
+    turn_text = generated_text if turn_end == -1 else generated_text[:turn_end]
+    bot_dialogue = get_bot_response(
+        name_resp=responder,
+        model_resp=[line for line in turn_text.split("\n") if line.strip()],
+        name_spk=speaker,
+        verbose=verbose,
+    )
+    bot_dialogue = [clean(line, lower=False) for line in bot_dialogue]
+    bot_resp = remove_trailing_punctuation(
+        ", ".join(bot_dialogue).strip()
+    )  # remove trailing punctuation to seem more natural
+    if verbose:
+        print("\n... bot response:\n")
+        pp.pprint(bot_resp)
+    return bot_resp
 
+
+def load_model_or_exit(
+    folder_path: str or Path,
+    aitextgen_obj=None,
+    use_gpu=False,
+    precision="fp32",
+    verbose=False,
+    backend="torch",
+):
+    """
+    load_model_or_exit - return aitextgen_obj if passed, else the registry model for folder_path. Exits if it cannot be loaded.
+    """
     try:
-        ai = (
+        return (
             aitextgen_obj
             if aitextgen_obj
-            else aitextgen(
-                model_folder=folder_path,
-                to_gpu=use_gpu,
+            else get_model(
+                folder_path,
+                use_gpu=use_gpu,
+                precision=precision,
+                verbose=verbose,
+                backend=backend,
             )
         )
     except Exception as e:
@@ -155,6 +182,16 @@ def query_gpt_model(
         )
         sys.exit(1)
 
+
+def get_speaker_names(
+    folder_path: str or Path, speaker: str = None, responder: str = None, verbose=False
+):
+    """
+    get_speaker_names - fill in the default speaker/responder names for a model folder if they were not passed
+
+    Returns:
+        tuple: (speaker, responder)
+    """
     mpath = Path(folder_path)
     mpath_base = (
         mpath.stem
@@ -169,40 +206,101 @@ def query_gpt_model(
             print("speaker and responder not set - using default")
         speaker = "person" if speaker is None else speaker
         responder = "george robot" if responder is None else responder
+    return speaker, responder
 
-    prompt_list = (
-        conversation_history if conversation_history is not None else []
-    )  # track conversation
-    prompt_list.append(speaker.lower() + ":" + "\n")
-    prompt_list.append(prompt_msg.lower() + "\n")
-    prompt_list.append("\n")
-    prompt_list.append(responder.lower() + ":" + "\n")
-    this_prompt = "".join(prompt_list)
-    pr_len = len(this_prompt)
-    if verbose:
-        print("overall prompt:\n")
-        pp.pprint(prompt_list)
-    # call the model
-    print("\n... generating...")
-    this_result = ai.generate(
-        n=1,
-        top_k=kparam,
-        batch_size=128,
-        # the prompt input counts for text length constraints
-        max_length=resp_length + pr_len,
-        min_length=16 + pr_len,
-        prompt=this_prompt,
-        temperature=temp,
-        top_p=top_p,
-        do_sample=True,
-        return_as_list=True,
-        use_cache=True,
+
+def make_new_turn(prompt_msg: str, speaker: str, responder: str):
+    """make_new_turn - the prompt lines for a new message: the speaker's turn followed by the responder's name tag"""
+    return [
+        speaker.lower() + ":" + "\n",
+        prompt_msg.lower() + "\n",
+        "\n",
+        responder.lower() + ":" + "\n",
+    ]
+
+
+def get_prompt_history_budget(ai, new_turn: list, resp_length: int):
+    """get_prompt_history_budget - the tokens of history that fit in the context window with new_turn and the response"""
+    return get_history_budget(
+        get_context_window(ai.model),
+        resp_length=resp_length,
+        new_turn_tokens=count_tokens(ai.tokenizer, "".join(new_turn)),
     )
-    if verbose:
-        print("\n... generated:\n")
-        pp.pprint(this_result)  # for debugging
+
+
+def build_prompt(
+    ai,
+    prompt_msg: str,
+    conversation_history: list = None,
+    speaker: str = "person alpha",
+    responder: str = "person beta",
+    resp_length: int = 48,
+):
+    """
+    build_prompt - build the prompt for one query and tokenize it once. History is trimmed by whole turns so that the
+    prompt + resp_length tokens fit in the model's context window. With a TurnHistory, only the new turn is tokenized:
+    the history turns have their token ids cached.
+
+    Returns:
+        tuple: (prompt_list, this_prompt, input_ids) - the prompt lines, the prompt text, and a 1-D tensor of prompt token ids
+    """
+    import torch
+
+    # count the new turn once, then fit as much whole-turn history as the context window allows
+    new_turn = make_new_turn(prompt_msg, speaker, responder)
+    context_window = get_context_window(ai.model)
+    history_budget = get_prompt_history_budget(ai, new_turn, resp_length)
+    if isinstance(conversation_history, TurnHistory):
+        prompt_list, history_ids = conversation_history.get_window(history_budget)
+        new_ids = ai.tokenizer("".join(new_turn))["input_ids"]
+        input_ids = torch.tensor(history_ids + new_ids, dtype=torch.long)
+        prompt_list.extend(new_turn)
+        this_prompt = "".join(prompt_list)
+    else:
+        prompt_list = (
+            trim_history_to_tokens(
+                conversation_history, ai.tokenizer, max_tokens=history_budget
+            )
+            if conversation_history is not None
+            else []
+        )  # track conversation
+        prompt_list.extend(new_turn)
+        this_prompt = "".join(prompt_list)
+        input_ids = ai.tokenizer(this_prompt, return_tensors="pt")["input_ids"][0]
+    if getattr(ai.model.config, "line_by_line", None):
+        bos = torch.tensor([ai.tokenizer.bos_token_id])
+        input_ids = torch.cat((bos, input_ids))
+    # a single message longer than the window: keep its end, which has the responder tag
+    input_ids = input_ids[-(context_window - resp_length) :]
+    return prompt_list, this_prompt, input_ids
+
+
+def process_response(
+    generated_text: str,
+    this_prompt: str,
+    prompt_list: list,
+    speaker: str,
+    responder: str,
+    verbose: bool = False,
+):
+    """
+    process_response - isolate the responder's reply from the generated text and append it to the conversation. For
+    text that still contains the prompt: when the generated token ids are available, decode only the new ones and use
+    isolate_reply instead (as query_gpt_model does), which does not depend on the length of the prompt.
+
+    Args:
+        generated_text (str): the decoded model output (prompt + generated text)
+        this_prompt (str): the prompt text
+        prompt_list (list): the prompt lines, the reply is appended to this list
+        speaker (str): the name of the speaker
+        responder (str): the name of the responder
+        verbose (bool, optional): Defaults to False.
+
+    Returns:
+        dict: out_text (str) the bot response and full_conv (dict) the conversation history
+    """
     # process the full result to get the ~bot response~ piece
-    this_result = str(this_result[0]).split("\n")
+    this_result = str(generated_text).split("\n")
     input_prompt = this_prompt.split("\n")
 
     diff_list = extract_response(
@@ -219,6 +317,16 @@ def query_gpt_model(
     if verbose:
         print("\n... bot response:\n")
         pp.pprint(bot_resp)
+    return add_reply_to_history(bot_resp, prompt_list, verbose=verbose)
+
+
+def add_reply_to_history(bot_resp: str, prompt_list: list, verbose: bool = False):
+    """
+    add_reply_to_history - append the bot response to the prompt lines and build the result dict
+
+    Returns:
+        dict: out_text (str) the bot response and full_conv (dict) the conversation history
+    """
     prompt_list.append(bot_resp + "\n")
     prompt_list.append("\n")
     conv_history = {}
@@ -228,12 +336,653 @@ def query_gpt_model(
     if verbose:
         print("\n... conversation history:\n")
         pp.pprint(conv_history)
-    print("\nfinished!")
 
-    # return the bot response and the full conversation
     return {"out_text": bot_resp, "full_conv": conv_history}
 
 
+def add_exchange_to_history(
+    conversation_history, prompt_msg: str, bot_resp: str, speaker: str, responder: str
+):
+    """add_exchange_to_history - append the message and the reply to a TurnHistory (lists of lines are left as they are)"""
+    if isinstance(conversation_history, TurnHistory):
+        conversation_history.append(speaker, prompt_msg.lower())
+        conversation_history.append(responder, bot_resp)
+
+
+def pad_left(id_list: list, pad_token_id: int):
+    """
+    pad_left - left-pad a list of 1-D token id tensors into one batch, so every prompt ends at the last column and generation
+    continues each of them from the same position
+
+    Returns:
+        tuple: (input_ids, attention_mask) - 2-D tensors of shape (len(id_list), longest prompt)
+    """
+    import torch
+
+    max_len = max(len(ids) for ids in id_list)
+    input_ids = torch.full((len(id_list), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(id_list), max_len), dtype=torch.long)
+    for i, ids in enumerate(id_list):
+        input_ids[i, max_len - len(ids) :] = ids
+        attention_mask[i, max_len - len(ids) :] = 1
+    return input_ids, attention_mask
+
+
+def pick_best_candidate(
+    ai, prompt_ids, raw_texts: list, speaker: str, responder: str, verbose: bool = False
+):
+    """
+    pick_best_candidate - rerank several sampled responses to the same prompt and return the best one
+
+    Args:
+        ai (aitextgen): the loaded model
+        prompt_ids (torch.Tensor): 1-D tensor of the prompt token ids
+        raw_texts (list): the generated text of each candidate (after the prompt)
+        speaker (str): the name of the speaker
+        responder (str): the name of the responder
+        verbose (bool, optional): Defaults to False.
+
+    Returns:
+        str: the bot response with the highest score
+    """
+    from generation_utils import get_reply_penalty, score_replies
+
+    replies = [isolate_reply(text, speaker, responder) for text in raw_texts]
+    reply_ids = [
+        ai.tokenizer(reply + "\n")["input_ids"] if reply else [] for reply in replies
+    ]
+    likelihoods = score_replies(ai.model, prompt_ids, reply_ids)
+    scores = [
+        ll - get_reply_penalty(reply, raw, speaker, responder)
+        for ll, reply, raw in zip(likelihoods, replies, raw_texts)
+    ]
+    best = max(range(len(replies)), key=lambda i: scores[i])
+    if verbose:
+        print("\n... candidate responses and scores:\n")
+        pp.pprint(list(zip(replies, [round(sc, 3) for sc in scores])))
+    return replies[best]
+
+
+def lookup_response_caches(
+    folder_path: str or Path,
+    prompt_msg: str,
+    conversation_history: list,
+    speaker: str,
+    responder: str,
+    sampling: dict,
+    response_cache=None,
+    semantic_cache=None,
+    use_gpu: bool = False,
+    precision: str = "fp32",
+    backend: str = "torch",
+):
+    """
+    lookup_response_caches - look a query up in the exact-match cache, then (for single-turn queries) in the near-duplicate
+    cache, without loading the model
+
+    Args:
+        sampling (dict): the generation arguments that change the reply (kparam, top_p, temp, resp_length)
+        response_cache (response_cache.ResponseCache, optional): the exact-match cache. Defaults to None.
+        semantic_cache (semantic_cache.SemanticCache, optional): the near-duplicate cache. Defaults to None.
+        other args: as in query_gpt_model
+
+    Returns:
+        tuple: (cached reply or None, a function that adds a newly generated reply to the caches)
+    """
+    use_semantic = semantic_cache is not None and not conversation_history
+    if response_cache is None and not use_semantic:
+        return None, lambda reply: None
+
+    model_key = str(get_model_key(folder_path, use_gpu, precision, backend))
+    cached = None
+    if response_cache is not None:
+        cache_key = response_cache.make_key(
+            model_key,
+            prompt_msg,
+            conversation_history,
+            speaker,
+            responder,
+            **sampling,
+        )
+        cached = response_cache.get(cache_key)
+    namespace = (model_key, speaker, responder, tuple(sorted(sampling.items())))
+    if cached is None and use_semantic:
+        cached = semantic_cache.get(prompt_msg, namespace)
+
+    def store_reply(reply: str):
+        if response_cache is not None:
+            response_cache.put(cache_key, reply)
+        if use_semantic:
+            semantic_cache.put(prompt_msg, namespace, reply)
+
+    return cached, store_reply
+
+
+def query_gpt_model(
+    folder_path: str or Path,
+    prompt_msg: str,
+    conversation_history: list = None,
+    speaker: str = None,
+    responder: str = None,
+    resp_length: int = 48,
+    kparam: int = 20,
+    temp: float = 0.4,
+    top_p: float = 0.9,
+    aitextgen_obj=None,
+    verbose: bool = False,
+    use_gpu: bool = False,
+    n_candidates: int = 1,
+    precision: str = "fp32",
+    backend: str = "torch",
+    response_cache=None,
+    semantic_cache=None,
+    engine=None,
+    token=None,
+    show_progress: bool = True,
+):
+    """
+    query_gpt_model - queries the GPT model and returns the first response by <responder>
+
+    Args:
+        folder_path (str or Path): the path to the model folder
+        prompt_msg (str): the prompt message
+        conversation_history (list or turn_history.TurnHistory, optional): the conversation history as a list of lines, or a TurnHistory (the new message and the reply are appended to it). Whole turns are dropped (oldest first) so that the prompt + resp_length tokens fit in the model's context window. Defaults to None.
+        speaker (str, optional): the name of the speaker. Defaults to None.
+        responder (str, optional): the name of the responder. Defaults to None.
+        resp_length (int, optional): the length of the response in tokens. Defaults to 48.
+        kparam (int, optional): the k parameter for the top_k. Defaults to 40.
+        temp (float, optional): the temperature for the softmax. Defaults to 0.7.
+        top_p (float, optional): the top_p parameter for nucleus sampling. Defaults to 0.9.
+        aitextgen_obj (_type_, optional): a pre-loaded aitextgen object. Defaults to None, in which case the model is taken from the process-wide registry (loaded on first use).
+        verbose (bool, optional): Defaults to False.
+        use_gpu (bool, optional): Defaults to False.
+        precision (str, optional): model precision when loading from the registry, "fp32", "int8" or "bf16" (CPU only). Defaults to "fp32".
+        n_candidates (int, optional): if > 1, sample this many responses in one batched generate call and return the one with the best length-normalised log-likelihood (empty responses and responses with name tags are penalised). Defaults to 1.
+        backend (str, optional): "torch", or "onnx" to generate with the ONNX Runtime export of the model (run export_onnx.py first). Sampling and post-processing are the same for both. Defaults to "torch".
+        response_cache (response_cache.ResponseCache, optional): answer repeated queries from a pool of earlier replies instead of generating. Defaults to None.
+        semantic_cache (semantic_cache.SemanticCache, optional): also answer near-duplicates of earlier single-turn prompts (no conversation_history) from their reply pool. Defaults to None.
+        engine (batch_engine.BatchEngine, optional): generate in this engine's shared decode batch, together with other concurrent requests, instead of with a model.generate call of its own. The engine's model is used (aitextgen_obj, use_gpu, precision and backend only matter for the caches). Defaults to None.
+        token (cancellation.CancellationToken, optional): checked between decode steps: if it is cancelled generation stops and the reply is empty, if its deadline passes generation stops with the partial reply so far. Defaults to None.
+        show_progress (bool, optional): print "... generating..." and "finished!" around the generation, as the CLI does. Defaults to True.
+
+    Returns:
+        model_resp (dict): the model response, as a dict with the following keys: out_text (str) the generated text and full_conv (dict) the conversation history. With a token also status (str): "ok", "deadline" or "cancelled".
+    """
+    speaker, responder = get_speaker_names(folder_path, speaker, responder, verbose)
+    cached, store_reply = lookup_response_caches(
+        folder_path,
+        prompt_msg,
+        conversation_history,
+        speaker,
+        responder,
+        dict(kparam=kparam, top_p=top_p, temp=temp, resp_length=resp_length),
+        response_cache=response_cache,
+        semantic_cache=semantic_cache,
+        use_gpu=use_gpu,
+        precision=precision,
+        backend=backend,
+    )
+    if cached is not None:
+        prompt_list = list(conversation_history or []) + make_new_turn(
+            prompt_msg, speaker, responder
+        )
+        model_resp = add_reply_to_history(cached, prompt_list, verbose=verbose)
+        if token is not None:
+            model_resp["status"] = STATUS_OK
+        add_exchange_to_history(
+            conversation_history, prompt_msg, cached, speaker, responder
+        )
+        return model_resp
+
+    if engine is not None:
+        ai = engine.ai
+    else:
+        ai = load_model_or_exit(
+            folder_path,
+            aitextgen_obj,
+            use_gpu=use_gpu,
+            precision=precision,
+            verbose=verbose,
+            backend=backend,
+        )
+
+    prompt_list, _, input_ids = build_prompt(
+        ai,
+        prompt_msg,
+        conversation_history=conversation_history,
+        speaker=speaker,
+        responder=responder,
+        resp_length=resp_length,
+    )
+    pr_len = len(input_ids)  # prompt length in tokens
+    if verbose:
+        print(f"overall prompt ({pr_len} tokens):\n")
+        pp.pprint(prompt_list)
+    # call the model
+    if show_progress:
+        print("\n... generating...")
+    if token is not None and token.get_status() is not None:
+        gen_texts = [""] * n_candidates  # cancelled or expired before it started
+    elif engine is not None:
+        gen_texts = generate_with_engine(
+            engine,
+            input_ids.tolist(),
+            speaker,
+            responder,
+            n_candidates=n_candidates,
+            resp_length=resp_length,
+            kparam=kparam,
+            temp=temp,
+            top_p=top_p,
+            token=token,
+        )
+    else:
+        gen_texts = generate_with_model(
+            ai,
+            input_ids,
+            speaker,
+            responder,
+            n_candidates=n_candidates,
+            resp_length=resp_length,
+            kparam=kparam,
+            temp=temp,
+            top_p=top_p,
+            token=token,
+        )
+    status = None if token is None else token.get_status() or STATUS_OK
+    if verbose:
+        print("\n... generated:\n")
+        pp.pprint(gen_texts)  # for debugging
+
+    if status == STATUS_CANCELLED:
+        bot_resp = ""
+    elif n_candidates > 1:
+        bot_resp = pick_best_candidate(
+            ai, input_ids, gen_texts, speaker, responder, verbose=verbose
+        )
+    else:
+        bot_resp = isolate_reply(gen_texts[0], speaker, responder, verbose=verbose)
+    if status in (None, STATUS_OK):
+        store_reply(bot_resp)  # partial replies are not cached
+    model_resp = add_reply_to_history(bot_resp, prompt_list, verbose=verbose)
+    if status is not None:
+        model_resp["status"] = status
+    if status != STATUS_CANCELLED:
+        add_exchange_to_history(
+            conversation_history, prompt_msg, bot_resp, speaker, responder
+        )
+    if show_progress:
+        print("\nfinished!")
+
+    # return the bot response and the full conversation
+    return model_resp
+
+
+def generate_with_model(
+    ai,
+    input_ids,
+    speaker: str,
+    responder: str,
+    n_candidates: int = 1,
+    resp_length: int = 48,
+    kparam: int = 20,
+    temp: float = 0.4,
+    top_p: float = 0.9,
+    token=None,
+):
+    """
+    generate_with_model - sample n_candidates continuations of a prompt in one model.generate call
+
+    Args:
+        ai (aitextgen): the loaded model
+        input_ids (torch.Tensor): 1-D tensor of the prompt token ids
+        other args: as in query_gpt_model
+
+    Returns:
+        list: the generated text of each candidate (after the prompt)
+    """
+    import torch
+
+    from generation_utils import get_turn_stopping_criteria
+
+    pr_len = len(input_ids)
+    pad_token_id = ai.tokenizer.pad_token_id or ai.tokenizer.eos_token_id
+    input_ids = input_ids.unsqueeze(0)
+    with torch.no_grad():
+        output_ids = ai.model.generate(
+            input_ids=input_ids.to(ai.get_device()),
+            attention_mask=torch.ones_like(input_ids).to(ai.get_device()),
+            top_k=kparam,
+            # the prompt input counts for text length constraints
+            max_length=pr_len + resp_length,
+            min_length=pr_len + min(16, resp_length),
+            temperature=temp,
+            top_p=top_p,
+            do_sample=True,
+            num_return_sequences=n_candidates,
+            pad_token_id=pad_token_id,
+            use_cache=True,
+            # stop as soon as the responder's turn is over, the rest is discarded anyway
+            stopping_criteria=get_turn_stopping_criteria(
+                ai.tokenizer, pr_len, speaker, responder, token=token
+            ),
+        )
+    # only the new tokens are decoded and post-processed, the prompt (and history) is never looked at again
+    return ai.tokenizer.batch_decode(output_ids[:, pr_len:], skip_special_tokens=True)
+
+
+def generate_with_engine(
+    engine,
+    prompt_ids: list,
+    speaker: str,
+    responder: str,
+    n_candidates: int = 1,
+    resp_length: int = 48,
+    kparam: int = 20,
+    temp: float = 0.4,
+    top_p: float = 0.9,
+    token=None,
+):
+    """
+    generate_with_engine - submit n_candidates copies of a prompt to a BatchEngine and wait for them (they are decoded
+    together, and with whatever else the engine is running)
+
+    Args:
+        engine (batch_engine.BatchEngine): the running engine
+        prompt_ids (list): the prompt token ids
+        other args: as in query_gpt_model
+
+    Returns:
+        list: the generated text of each candidate (after the prompt)
+    """
+    requests = [
+        engine.submit(
+            prompt_ids,
+            speaker,
+            responder,
+            resp_length=resp_length,
+            kparam=kparam,
+            temp=temp,
+            top_p=top_p,
+            token=token,
+        )
+        for _ in range(n_candidates)
+    ]
+    return [request.wait() for request in requests]
+
+
+def query_gpt_model_batch(
+    folder_path: str or Path,
+    queries: list,
+    resp_length: int = 48,
+    kparam: int = 20,
+    temp: float = 0.4,
+    top_p: float = 0.9,
+    batch_size: int = 16,
+    aitextgen_obj=None,
+    verbose: bool = False,
+    use_gpu: bool = False,
+    precision: str = "fp32",
+    backend: str = "torch",
+):
+    """
+    query_gpt_model_batch - like query_gpt_model, but for many prompts at once. Prompts are left-padded and generated
+    together in one model.generate call per batch of batch_size, which is much faster on CPU than one call per prompt.
+
+    Args:
+        folder_path (str or Path): the path to the model folder
+        queries (list): a list of dicts, each with key prompt_msg and optionally conversation_history, speaker, responder,
+            kparam, temp, top_p (same meaning as the query_gpt_model arguments, the sampling settings default to the ones
+            below). A plain string is treated as {"prompt_msg": <string>}. Queries with different sampling settings are
+            still generated in the same batch. A TurnHistory as conversation_history gets the message and the reply
+            appended, as in query_gpt_model.
+        resp_length (int, optional): the length of each response in tokens. Defaults to 48.
+        kparam (int, optional): the k parameter for the top_k. Defaults to 20.
+        temp (float, optional): the temperature for the softmax. Defaults to 0.4.
+        top_p (float, optional): the top_p parameter for nucleus sampling. Defaults to 0.9.
+        batch_size (int, optional): how many prompts to generate in one call. Defaults to 16.
+        aitextgen_obj (_type_, optional): a pre-loaded aitextgen object. Defaults to None (use the registry).
+        verbose (bool, optional): Defaults to False.
+        use_gpu (bool, optional): Defaults to False.
+        precision (str, optional): model precision when loading from the registry, "fp32", "int8" or "bf16" (CPU only). Defaults to "fp32".
+        backend (str, optional): "torch" or "onnx". The ONNX export cannot take padded batches, so with "onnx" the prompts are generated one at a time. Defaults to "torch".
+
+    Returns:
+        list: one dict per query, in order, with keys out_text and full_conv (as returned by query_gpt_model) and
+            n_tokens (int) the number of tokens generated for it, up to the end of the responder's turn
+    """
+    import torch
+
+    from generation_utils import get_row_sampling_kwargs, get_turn_stopping_criteria
+
+    ai = load_model_or_exit(
+        folder_path,
+        aitextgen_obj,
+        use_gpu=use_gpu,
+        precision=precision,
+        verbose=verbose,
+        backend=backend,
+    )
+    pad_token_id = ai.tokenizer.pad_token_id or ai.tokenizer.eos_token_id
+    batch_size = 1 if backend == "onnx" else batch_size
+
+    results = []
+    for batch in chunks(queries, batch_size):
+        prompts = []
+        row_sampling = []  # (top_k, top_p, temperature) of each prompt
+        for query in batch:
+            query = {"prompt_msg": query} if isinstance(query, str) else query
+            speaker, responder = get_speaker_names(
+                folder_path, query.get("speaker"), query.get("responder"), verbose
+            )
+            prompt_list, _, ids = build_prompt(
+                ai,
+                query["prompt_msg"],
+                conversation_history=query.get("conversation_history"),
+                speaker=speaker,
+                responder=responder,
+                resp_length=resp_length,
+            )
+            prompts.append((query, prompt_list, ids, speaker, responder))
+            row_sampling.append(
+                (
+                    query.get("kparam", kparam),
+                    query.get("top_p", top_p),
+                    query.get("temp", temp),
+                )
+            )
+
+        input_ids, attention_mask = pad_left([p[2] for p in prompts], pad_token_id)
+        pr_len = input_ids.shape[1]
+        if verbose:
+            print(
+                f"\n... generating {len(prompts)} responses, padded prompt length {pr_len} tokens"
+            )
+        if backend == "onnx":
+            # one prompt per batch, and the ONNX generate loop takes its settings directly
+            sampling = dict(zip(["top_k", "top_p", "temperature"], row_sampling[0]))
+        else:
+            sampling = get_row_sampling_kwargs(*zip(*row_sampling))
+        with torch.no_grad():
+            output_ids = ai.model.generate(
+                input_ids=input_ids.to(ai.get_device()),
+                attention_mask=attention_mask.to(ai.get_device()),
+                max_length=pr_len + resp_length,
+                min_length=pr_len + min(16, resp_length),
+                do_sample=True,
+                pad_token_id=pad_token_id,
+                use_cache=True,
+                stopping_criteria=get_turn_stopping_criteria(
+                    ai.tokenizer,
+                    pr_len,
+                    speakers=[p[3] for p in prompts],
+                    responders=[p[4] for p in prompts],
+                ),
+                **sampling,
+            )
+        new_ids = output_ids[:, pr_len:]
+        gen_texts = ai.tokenizer.batch_decode(new_ids, skip_special_tokens=True)
+        # rows that finished early are padded (pad_token_id is usually eos, which is not counted either)
+        n_decoded = (new_ids != pad_token_id).sum(dim=1).tolist()
+        for (query, prompt_list, _, speaker, responder), text, n in zip(
+            prompts, gen_texts, n_decoded
+        ):
+            bot_resp = isolate_reply(text, speaker, responder, verbose=verbose)
+            model_resp = add_reply_to_history(bot_resp, prompt_list, verbose=verbose)
+            # a row that finished its turn keeps decoding until the whole batch stops, those tokens are not counted
+            turn_end = find_turn_end(text, speaker, responder)
+            if turn_end != -1:
+                n = min(n, count_tokens(ai.tokenizer, text[:turn_end]))
+            model_resp["n_tokens"] = n
+            add_exchange_to_history(
+                query.get("conversation_history"),
+                query["prompt_msg"],
+                bot_resp,
+                speaker,
+                responder,
+            )
+            results.append(model_resp)
+
+    return results
+
+
+def stream_gpt_response(
+    folder_path: str or Path,
+    prompt_msg: str,
+    conversation_history: list = None,
+    speaker: str = None,
+    responder: str = None,
+    resp_length: int = 48,
+    kparam: int = 20,
+    temp: float = 0.4,
+    top_p: float = 0.9,
+    aitextgen_obj=None,
+    verbose: bool = False,
+    use_gpu: bool = False,
+    precision: str = "fp32",
+    backend: str = "torch",
+    response_cache=None,
+    semantic_cache=None,
+    engine=None,
+    token=None,
+):
+    """
+    stream_gpt_response - the streaming version of query_gpt_model: a generator that yields the bot response as tokens
+    are decoded, so a front end can show text before the whole reply is done. Name tags are stripped as they appear and
+    decoding stops at the end of the responder's turn.
+
+    Args:
+        same as query_gpt_model (a TurnHistory is appended to once the reply is finished). With a token, generation stops when it is cancelled (the last value is empty) or its
+        deadline passes (the last value is the partial reply). If the caller stops iterating early, generation stops too.
+
+    Yields:
+        str: the bot response so far. The last value yielded is the final (complete) response.
+    """
+    from conv_session import ConversationSession  # imports this module
+
+    speaker, responder = get_speaker_names(folder_path, speaker, responder, verbose)
+    cached, store_reply = lookup_response_caches(
+        folder_path,
+        prompt_msg,
+        conversation_history,
+        speaker,
+        responder,
+        dict(kparam=kparam, top_p=top_p, temp=temp, resp_length=resp_length),
+        response_cache=response_cache,
+        semantic_cache=semantic_cache,
+        use_gpu=use_gpu,
+        precision=precision,
+        backend=backend,
+    )
+    if cached is not None:
+        add_exchange_to_history(
+            conversation_history, prompt_msg, cached, speaker, responder
+        )
+        yield cached
+        return
+    if engine is not None:
+        _, _, input_ids = build_prompt(
+            engine.ai,
+            prompt_msg,
+            conversation_history=conversation_history,
+            speaker=speaker,
+            responder=responder,
+            resp_length=resp_length,
+        )
+        request = engine.submit(
+            input_ids.tolist(),
+            speaker,
+            responder,
+            resp_length=resp_length,
+            kparam=kparam,
+            temp=temp,
+            top_p=top_p,
+            token=token,
+        )
+        last_partial = ""
+        try:
+            for gen_text in request.stream():
+                partial = isolate_reply(
+                    get_visible_text(gen_text, speaker, responder), speaker, responder
+                )
+                if partial and partial != last_partial:
+                    last_partial = partial
+                    yield partial
+        finally:
+            if not request.done.is_set():
+                request.token.cancel()  # the caller went away, free the batch slot
+        bot_resp = isolate_reply(request.wait(), speaker, responder, verbose=verbose)
+        if request.status == STATUS_OK:
+            store_reply(bot_resp)
+        if request.status != STATUS_CANCELLED:
+            add_exchange_to_history(
+                conversation_history, prompt_msg, bot_resp, speaker, responder
+            )
+        yield bot_resp
+        return
+
+    ai = load_model_or_exit(
+        folder_path,
+        aitextgen_obj,
+        use_gpu=use_gpu,
+        precision=precision,
+        verbose=verbose,
+        backend=backend,
+    )
+    session = ConversationSession(
+        ai,
+        speaker=speaker,
+        responder=responder,
+        resp_length=resp_length,
+        kparam=kparam,
+        temp=temp,
+        top_p=top_p,
+        verbose=verbose,
+    )
+    if isinstance(conversation_history, TurnHistory):
+        # the same window as in build_prompt (token budget, summary), with the cached token ids
+        lines, history_ids = conversation_history.get_window(
+            get_prompt_history_budget(
+                ai, make_new_turn(prompt_msg, speaker, responder), resp_length
+            )
+        )
+        session.load_history(lines, token_ids=history_ids)
+    elif conversation_history:
+        session.load_history(conversation_history)
+    yield from session.stream(prompt_msg, token=token)
+    status = session.last_result.get("status", STATUS_OK)
+    if status == STATUS_OK:
+        store_reply(session.last_result["out_text"])
+    if status != STATUS_CANCELLED:
+        add_exchange_to_history(
+            conversation_history,
+            prompt_msg,
+            session.last_result["out_text"],
+            speaker,
+            responder,
+        )
+
+
 # Set up the parsing of command-line arguments
 def get_parser():
     """
@@ -309,6 +1058,15 @@ def get_parser():
         help="max length of the response (positive integer)",
     )
 
+    parser.add_argument(
+        "-n",
+        "--n-candidates",
+        required=False,
+        type=int,
+        default=1,
+        help="sample this many responses in one batch and return the most likely one (positive integer)",
+    )
+
     parser.add_argument(
         "-v",
         "--verbose",
@@ -331,6 +1089,28 @@ def get_parser():
         action="store_true",
         help="use gpu if available",
     )
+    parser.add_argument(
+        "--precision",
+        required=False,
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="model precision for CPU inference: fp32, int8 (dynamic quantization) or bf16 (if the CPU supports it)",
+    )
+    parser.add_argument(
+        "--backend",
+        required=False,
+        type=str,
+        default="torch",
+        choices=BACKENDS,
+        help="inference backend: torch, or onnx for the ONNX Runtime export made with export_onnx.py",
+    )
+    parser.add_argument(
+        "--no-daemon",
+        default=False,
+        action="store_true",
+        help="always generate in this process, even if inference_daemon.py is running",
+    )
 
     return parser
 
@@ -354,8 +1134,8 @@ if __name__ == "__main__":
 
     st = time.perf_counter()
 
-    resp = query_gpt_model(
-        folder_path=model_loc,
+    query_kwargs = dict(
+        folder_path=str(model_loc),
         prompt_msg=query,
         speaker=spkr,
         responder=rspndr,
@@ -365,7 +1145,20 @@ if __name__ == "__main__":
         resp_length=resp_length,
         verbose=want_verbose,
         use_gpu=use_gpu,
+        n_candidates=args.n_candidates,
+        precision=args.precision,
+        backend=args.backend,
     )
+    # hand the request to the warm inference daemon if one is running, it prints the same output (if it cannot
+    # answer, the reply is generated here)
+    from inference_daemon import query_daemon
+
+    daemon_resp = None if args.no_daemon else query_daemon(**query_kwargs)
+    if daemon_resp is not None:
+        resp, daemon_output = daemon_resp
+        print(daemon_output, end="")
+    else:
+        resp = query_gpt_model(**query_kwargs)
 
     output = resp["out_text"]
     pp.pprint(output, indent=4)
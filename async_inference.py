@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+async_inference.py - an asyncio API for query_gpt_model / stream_gpt_response with a bounded request queue
+
+query_gpt_model blocks until the reply is generated, so an async front end would block its event loop, and a threaded
+one piles up threads that all wait for the model. AsyncInference runs generation in its own executor with
+max_concurrency threads and accepts at most max_queue more requests waiting for one; beyond that a request is rejected
+right away with ServerBusyError, so the front end can tell the user to try again instead of letting the backlog grow.
+Each request can have a timeout: a request that is still queued when it expires is dropped, and one that already started
+has its cancellation token cancelled, so generation stops at the next decode step instead of running on for nobody. The
+same happens when the awaiting task itself is cancelled.
+
+It generates with the model registry in this process, a BatchEngine (engine=...) or a WorkerPool (worker_pool=...), and
+returns the same {"out_text", "full_conv"} dict as query_gpt_model. With a load_shedder (see load_shedding.py), requests
+are degraded (shorter replies, one candidate, the small fallback model in this process) while the queue is deep or
+latency is high.
+
+example:
+    import asyncio
+    from async_inference import AsyncInference, ServerBusyError
+
+    api = AsyncInference("distilgpt2-tiny-conversational", max_queue=8)
+
+    async def handle(message):
+        try:
+            resp = await api.query(message, timeout=30)
+        except ServerBusyError:
+            return "the bot is busy, try again in a minute"
+        return resp["out_text"]
+
+Synchronous front ends (thread per request) can run the API on a background loop from start_event_loop and submit
+with asyncio.run_coroutine_threadsafe, or iterate over api.stream(...) with iterate_threadsafe.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import threading
+import time
+from pathlib import Path
+
+from cancellation import CancellationToken
+
+
+class ServerBusyError(RuntimeError):
+    """ServerBusyError - the request queue is full, the request was not accepted"""
+
+
+def start_event_loop():
+    """
+    start_event_loop - an asyncio event loop running forever in a daemon thread, for submitting coroutines from
+    synchronous code with asyncio.run_coroutine_threadsafe
+
+    Returns:
+        asyncio.AbstractEventLoop: the running loop
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(
+        target=loop.run_forever, name="inference-event-loop", daemon=True
+    ).start()
+    return loop
+
+
+def iterate_threadsafe(async_gen, loop):
+    """
+    iterate_threadsafe - iterate over an async generator from a synchronous thread, running it on loop
+
+    Yields:
+        the values of async_gen
+    """
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(async_gen.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
+
+
+class AsyncInference:
+    """
+    AsyncInference - async query / stream of bot replies, run in a dedicated executor behind a bounded queue
+
+    Args:
+        folder_path (str or Path): the model folder
+        max_queue (int, optional): max requests waiting for a free executor thread, more are rejected with
+            ServerBusyError. Defaults to 16, None for no limit.
+        max_concurrency (int, optional): requests generated at the same time. Defaults to None: 1 with the in-process
+            model (generation already uses all cores), engine.max_batch_size with a BatchEngine, the number of workers
+            with a WorkerPool.
+        timeout (float, optional): default per-request timeout in seconds. Defaults to None (no limit).
+        engine (batch_engine.BatchEngine, optional): generate in this engine. Defaults to None.
+        worker_pool (worker_pool.WorkerPool, optional): generate in these worker processes. Defaults to None.
+        response_cache, semantic_cache (optional): caches passed to every request, see query_gpt_model.
+        load_shedder (load_shedding.LoadShedder, optional): degrade requests under load. Defaults to None.
+        **model_kwargs: use_gpu, precision, backend for the in-process model, see query_gpt_model
+    """
+
+    def __init__(
+        self,
+        folder_path: str or Path,
+        max_queue: int = 16,
+        max_concurrency: int = None,
+        timeout: float = None,
+        engine=None,
+        worker_pool=None,
+        response_cache=None,
+        semantic_cache=None,
+        load_shedder=None,
+        **model_kwargs,
+    ):
+        self.folder_path = str(folder_path)
+        self.engine = engine
+        self.worker_pool = worker_pool
+        self.response_cache = response_cache
+        self.semantic_cache = semantic_cache
+        self.load_shedder = load_shedder
+        self.model_kwargs = model_kwargs
+        if max_concurrency is None:
+            if engine is not None:
+                max_concurrency = engine.max_batch_size
+            elif worker_pool is not None:
+                max_concurrency = worker_pool.n_workers
+            else:
+                max_concurrency = 1
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="inference"
+        )
+        self._lock = threading.Lock()
+        self._pending = 0  # running + queued requests
+        self.stats = {
+            "submitted": 0,
+            "completed": 0,
+            "rejected": 0,
+            "timeouts": 0,
+            "errors": 0,
+            "latency_s_total": 0.0,
+        }
+
+    def _submit(self, fn):
+        """run fn in the executor, or raise ServerBusyError if the queue is full"""
+        with self._lock:
+            if (
+                self.max_queue is not None
+                and self._pending >= self.max_concurrency + self.max_queue
+            ):
+                self.stats["rejected"] += 1
+                raise ServerBusyError(
+                    f"server busy: {self._pending} requests running or queued"
+                )
+            self._pending += 1
+            self.stats["submitted"] += 1
+        future = self._executor.submit(fn)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def _record(self, kind: str, st: float):
+        """count a finished request (completed, timeouts or errors), the load shedder gets the latency of all three"""
+        latency = time.perf_counter() - st
+        with self._lock:
+            self.stats[kind] += 1
+            if kind == "completed":
+                self.stats["latency_s_total"] += latency
+        if self.load_shedder is not None:
+            self.load_shedder.record_latency(latency)
+
+    def get_policy(self):
+        """
+        get_policy - the load shedder's policy for a request admitted now, to pass to query / stream as policy (so the
+        caller can degrade its own post-processing the same way)
+
+        Returns:
+            dict or None: the policy, None without a load shedder
+        """
+        if self.load_shedder is None:
+            return None
+        with self._lock:
+            queue_depth = self._pending
+        return self.load_shedder.get_policy(queue_depth)
+
+    def _degrade(self, kwargs: dict, policy: dict = None):
+        """the request arguments after the load shedder's policy (for the current load if policy is None)"""
+        if self.load_shedder is None:
+            return kwargs
+        return self.load_shedder.apply(policy or self.get_policy(), kwargs)
+
+    def _query(self, prompt_msg: str, folder_path: str = None, **kwargs):
+        # folder_path is only given for the load shedder's fallback model, which runs in this process
+        caches = dict(
+            response_cache=self.response_cache, semantic_cache=self.semantic_cache
+        )
+        if self.worker_pool is not None and folder_path is None:
+            return self.worker_pool.query(prompt_msg, **caches, **kwargs)
+        from ai_single_response import query_gpt_model
+
+        return query_gpt_model(
+            folder_path or self.folder_path,
+            prompt_msg,
+            engine=self.engine if folder_path is None else None,
+            show_progress=False,  # no progress prints on stdout for every request
+            **caches,
+            # per-request settings override the model-level ones
+            **{**self.model_kwargs, **kwargs},
+        )
+
+    def _iter_replies(self, prompt_msg: str, folder_path: str = None, **kwargs):
+        if self.worker_pool is not None and folder_path is None:
+            yield self._query(prompt_msg, **kwargs)["out_text"]
+            return
+        from ai_single_response import stream_gpt_response
+
+        yield from stream_gpt_response(
+            folder_path or self.folder_path,
+            prompt_msg,
+            engine=self.engine if folder_path is None else None,
+            response_cache=self.response_cache,
+            semantic_cache=self.semantic_cache,
+            # per-request settings override the model-level ones
+            **{**self.model_kwargs, **kwargs},
+        )
+
+    async def query(
+        self, prompt_msg: str, timeout: float = None, policy: dict = None, **kwargs
+    ):
+        """
+        query - generate a reply without blocking the event loop
+
+        Args:
+            prompt_msg (str): the prompt message
+            timeout (float, optional): seconds until asyncio.TimeoutError. Defaults to the timeout of the instance.
+            policy (dict, optional): the load shedding policy of the request, from get_policy. Defaults to None (the
+                policy for the current load).
+            **kwargs: the other query_gpt_model arguments (conversation_history, speaker, responder, resp_length, token,
+                ...)
+
+        Raises:
+            ServerBusyError: the request queue is full
+            asyncio.TimeoutError: the reply was not ready in time
+
+        Returns:
+            model_resp (dict): out_text and full_conv, as returned by query_gpt_model
+        """
+        st = time.perf_counter()
+        token = kwargs.setdefault("token", CancellationToken())
+        kwargs = self._degrade(kwargs, policy)
+        future = self._submit(functools.partial(self._query, prompt_msg, **kwargs))
+        try:
+            # on timeout the future is cancelled, which drops it from the queue if it has not started
+            result = await asyncio.wait_for(
+                asyncio.wrap_future(future),
+                self.timeout if timeout is None else timeout,
+            )
+        except asyncio.TimeoutError:
+            token.cancel()  # stop the generation if it has started
+            self._record("timeouts", st)
+            raise
+        except asyncio.CancelledError:
+            token.cancel()
+            raise
+        except Exception:
+            self._record("errors", st)
+            raise
+        self._record("completed", st)
+        return result
+
+    async def stream(
+        self, prompt_msg: str, timeout: float = None, policy: dict = None, **kwargs
+    ):
+        """
+        stream - the async version of stream_gpt_response: an async generator of the bot response so far (the last value
+        is the final response). With a WorkerPool only the final response is yielded.
+
+        Args:
+            prompt_msg (str): the prompt message
+            timeout (float, optional): seconds for the whole reply until asyncio.TimeoutError. Defaults to the timeout of
+                the instance.
+            policy (dict, optional): the load shedding policy of the request, from get_policy. Defaults to None (the
+                policy for the current load).
+            **kwargs: the other stream_gpt_response arguments
+
+        Raises:
+            ServerBusyError: the request queue is full
+            asyncio.TimeoutError: the reply was not finished in time
+        """
+        loop = asyncio.get_running_loop()
+        updates = asyncio.Queue()
+        token = kwargs.setdefault("token", CancellationToken())
+        kwargs = self._degrade(kwargs, policy)
+
+        def produce():
+            try:
+                for partial in self._iter_replies(prompt_msg, **kwargs):
+                    loop.call_soon_threadsafe(updates.put_nowait, ("partial", partial))
+                loop.call_soon_threadsafe(updates.put_nowait, ("done", None))
+            except Exception as e:
+                loop.call_soon_threadsafe(updates.put_nowait, ("error", e))
+
+        st = time.perf_counter()
+        future = self._submit(produce)
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else loop.time() + timeout
+        finished = False  # the producer has sent "done" or "error"
+        try:
+            while True:
+                remaining = None if deadline is None else max(deadline - loop.time(), 0)
+                try:
+                    kind, value = await asyncio.wait_for(updates.get(), remaining)
+                except asyncio.TimeoutError:
+                    self._record("timeouts", st)
+                    raise
+                finished = kind != "partial"
+                if kind == "partial":
+                    yield value
+                elif kind == "error":
+                    self._record("errors", st)
+                    raise value
+                else:
+                    self._record("completed", st)
+                    return
+        finally:
+            if not finished:
+                # timed out, or the consumer stopped iterating: drop it from the queue or stop its generation
+                future.cancel()
+                token.cancel()
+
+    def get_stats(self):
+        """get_stats - request counters, requests running or queued, and the mean latency of completed requests"""
+        with self._lock:
+            completed = self.stats["completed"]
+            stats = {k: v for k, v in self.stats.items() if k != "latency_s_total"}
+            return dict(
+                stats,
+                pending=self._pending,
+                mean_latency_s=round(self.stats["latency_s_total"] / completed, 3)
+                if completed
+                else 0.0,
+            )
+
+    def close(self):
+        """close - stop accepting requests, queued requests are cancelled and running ones finish"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_parser():
+    """
+    get_parser [a helper function for the argparse module]
+
+    Returns: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(
+        description="send a burst of concurrent requests through the async API and report accepted, rejected and timed out requests"
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        required=False,
+        type=str,
+        default="distilgpt2-tiny-conversational",
+        help="folder - with respect to git directory of your repo that has the model files in it (pytorch.bin + "
+        "config.json). You can also pass the huggingface model name (e.g. distilgpt2)",
+    )
+    parser.add_argument(
+        "--n-requests",
+        required=False,
+        type=int,
+        default=16,
+        help="number of requests sent at once",
+    )
+    parser.add_argument(
+        "--max-queue",
+        required=False,
+        type=int,
+        default=4,
+        help="max requests waiting for the model, more are rejected",
+    )
+    parser.add_argument(
+        "--timeout",
+        required=False,
+        type=float,
+        default=None,
+        help="per-request timeout in seconds",
+    )
+    parser.add_argument(
+        "--prompt",
+        required=False,
+        type=str,
+        default="hey, what's up?",
+        help="the prompt for every request",
+    )
+    parser.add_argument(
+        "--fallback-model",
+        required=False,
+        type=str,
+        default=None,
+        help="degrade requests under load (see load_shedding.py), down to this small model",
+    )
+    return parser
+
+
+async def run_burst(api: AsyncInference, prompt_msg: str, n_requests: int):
+    """run_burst - send n_requests at once, returns the results (or exceptions) in order"""
+
+    async def one_request():
+        # the requests are submitted in order, ServerBusyError is raised before the first await
+        return await api.query(prompt_msg)
+
+    return await asyncio.gather(
+        *[one_request() for _ in range(n_requests)], return_exceptions=True
+    )
+
+
+if __name__ == "__main__":
+    from inference_daemon import model_arg_to_path
+
+    args = get_parser().parse_args()
+    shedder = None
+    if args.fallback_model is not None:
+        from load_shedding import LoadShedder
+
+        shedder = LoadShedder(
+            fallback_model=model_arg_to_path(args.fallback_model), verbose=True
+        )
+    api = AsyncInference(
+        model_arg_to_path(args.model),
+        max_queue=args.max_queue,
+        timeout=args.timeout,
+        load_shedder=shedder,
+    )
+    st = time.perf_counter()
+    results = asyncio.run(run_burst(api, args.prompt, args.n_requests))
+    print(f"{args.n_requests} requests in {round(time.perf_counter() - st, 2)} s")
+    for result in results:
+        if isinstance(result, dict):
+            print(f"  reply: {result['out_text']}")
+        else:
+            print(f"  {type(result).__name__}: {result}")
+    print(f"stats: {api.get_stats()}")
+    if shedder is not None:
+        print(f"load shedding: {shedder.get_stats()}")
+    api.close()
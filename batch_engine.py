@@ -0,0 +1,362 @@
+"""
+batch_engine.py - a continuous-batching generation engine for concurrent chat traffic
+
+With one model.generate call per message, concurrent users wait in line and a long reply blocks everyone behind it. A
+BatchEngine runs a single decode loop in a background thread and schedules at the level of decode steps: a new request
+is prefilled and joins the running batch at the next step, and a sequence leaves the batch as soon as its responder turn
+is over (same stopping rules as query_gpt_model), without waiting for the others.
+
+Each sequence has its own sampling parameters (applied to the whole batch in one vectorized step, see
+generation_utils.warp_logits), and its KV cache is a row of the batch cache: caches of different lengths
+are left-padded (masked out with the attention mask, with per-row position ids) when a sequence joins, and padding
+columns that no remaining row needs are dropped when sequences leave.
+
+Front ends use it through query_gpt_model / stream_gpt_response with engine=... (torch backend only, the ONNX export has
+no position_ids input).
+
+example:
+    from batch_engine import BatchEngine
+    from ai_single_response import query_gpt_model
+    from model_registry import get_model
+
+    engine = BatchEngine(get_model("distilgpt2-tiny-conversational"), max_batch_size=8)
+    resp = query_gpt_model("distilgpt2-tiny-conversational", "hey, what's up?", engine=engine)
+"""
+import logging
+import queue
+import threading
+import time
+
+import torch
+import torch.nn.functional as F
+
+from cancellation import STATUS_CANCELLED, STATUS_OK, CancellationToken
+from generation_utils import sample_next_token
+from turn_utils import find_turn_end, has_repetition
+
+
+class GenerationRequest:
+    """
+    GenerationRequest - one sequence in the engine: its prompt, sampling parameters and generated tokens
+
+    Args:
+        prompt_ids (list): the prompt token ids
+        speaker (str): the name of the speaker
+        responder (str): the name of the responder
+        resp_length (int, optional): max new tokens. Defaults to 48.
+        kparam (int, optional): top_k. Defaults to 20.
+        temp (float, optional): temperature. Defaults to 0.4.
+        top_p (float, optional): top_p. Defaults to 0.9.
+        token (cancellation.CancellationToken, optional): stops the request when it is cancelled or expires. Defaults
+            to None (a token without deadline, cancel it with request.token.cancel()).
+    """
+
+    def __init__(
+        self,
+        prompt_ids: list,
+        speaker: str,
+        responder: str,
+        resp_length: int = 48,
+        kparam: int = 20,
+        temp: float = 0.4,
+        top_p: float = 0.9,
+        token: CancellationToken = None,
+    ):
+        self.prompt_ids = list(prompt_ids)
+        self.speaker = speaker
+        self.responder = responder
+        self.resp_length = resp_length
+        self.min_new_tokens = min(16, resp_length)  # as in query_gpt_model
+        self.kparam = kparam
+        self.temp = temp
+        self.top_p = top_p
+        self.gen_ids = []
+        self.text = ""  # the generated text so far
+        self.next_logits = None  # logits for the next token, set by the engine
+        self.token = token or CancellationToken()
+        self.status = None  # "ok", "deadline" or "cancelled" once finished
+        self.error = None
+        self.updates = queue.Queue()  # the text after each token, None when finished
+        self.done = threading.Event()
+        self.submitted = time.perf_counter()
+        self.latency_s = None
+
+    def add_token(self, token_id: int, tokenizer):
+        """
+        add_token - append a sampled token
+
+        Returns:
+            bool: True if the sequence continues, False if it is finished
+        """
+        if token_id == tokenizer.eos_token_id:
+            self.finish()
+            return False
+        self.gen_ids.append(token_id)
+        self.text = tokenizer.decode(self.gen_ids, skip_special_tokens=True)
+        self.updates.put(self.text)
+        if (
+            len(self.gen_ids) >= self.resp_length
+            or has_repetition(self.gen_ids)
+            or find_turn_end(self.text, self.speaker, self.responder) != -1
+        ):
+            self.finish()
+            return False
+        if self.token.get_status() is not None:
+            self.finish(status=self.token.get_status())
+            return False
+        return True
+
+    def finish(self, error: Exception = None, status: str = STATUS_OK):
+        """finish - mark the request as finished, with its status (and an error, if it failed)"""
+        if status == STATUS_CANCELLED:
+            self.text = ""
+        self.status = status
+        self.error = error
+        self.latency_s = time.perf_counter() - self.submitted
+        self.updates.put(None)
+        self.done.set()
+
+    def wait(self, timeout: float = None):
+        """
+        wait - block until the request is finished
+
+        Returns:
+            str: the generated text (after the prompt), partial if the deadline passed, empty if it was cancelled
+        """
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"generation did not finish within {timeout} seconds")
+        if self.error is not None:
+            raise self.error
+        return self.text
+
+    def stream(self):
+        """stream - a generator of the generated text after each new token, ends when the request is finished"""
+        while True:
+            text = self.updates.get()
+            if text is None:
+                break
+            yield text
+        if self.error is not None:
+            raise self.error
+
+
+def left_pad_cache(past_key_values: tuple, attention_mask: torch.Tensor, length: int):
+    """
+    left_pad_cache - left-pad a KV cache and its attention mask along the sequence dimension to length (padding is
+    masked out)
+
+    Returns:
+        tuple: (past_key_values, attention_mask)
+    """
+    pad = length - attention_mask.shape[1]
+    if pad <= 0:
+        return past_key_values, attention_mask
+    past_key_values = tuple(
+        tuple(F.pad(t, (0, 0, pad, 0)) for t in layer) for layer in past_key_values
+    )
+    return past_key_values, F.pad(attention_mask, (pad, 0))
+
+
+class BatchEngine:
+    """
+    BatchEngine - iteration-level scheduling of generation requests over one model, in a background thread
+
+    Args:
+        ai (aitextgen): the loaded model, e.g. from model_registry.get_model
+        max_batch_size (int, optional): max sequences decoded together, more requests wait in the queue. Defaults to 8.
+        verbose (bool, optional): Defaults to False.
+    """
+
+    def __init__(self, ai, max_batch_size: int = 8, verbose: bool = False):
+        self.ai = ai
+        self.model = ai.model
+        self.tokenizer = ai.tokenizer
+        self.device = ai.get_device()
+        self.max_batch_size = max_batch_size
+        self.verbose = verbose
+        self.rows = []  # active requests, row i of the batch cache
+        self.past_key_values = None
+        self.attention_mask = None
+        self.stats = {"requests": 0, "steps": 0, "tokens": 0, "max_batch": 0}
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        # submit and the final drain of the queue on stop, so no request is queued after the drain
+        self._submit_lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name="batch-engine", daemon=True
+        )
+        self._thread.start()
+
+    def submit(
+        self,
+        prompt_ids: list,
+        speaker: str,
+        responder: str,
+        resp_length: int = 48,
+        kparam: int = 20,
+        temp: float = 0.4,
+        top_p: float = 0.9,
+        token: CancellationToken = None,
+    ):
+        """
+        submit - queue a prompt for generation, it joins the running batch at the next decode step. A request whose token
+        is cancelled or expired leaves the batch at the next step (or is dropped before its prefill).
+
+        Returns:
+            GenerationRequest: wait() on it for the generated text, or iterate over stream()
+        """
+        request = GenerationRequest(
+            prompt_ids, speaker, responder, resp_length, kparam, temp, top_p, token
+        )
+        with self._submit_lock:
+            if self._stop.is_set():
+                raise RuntimeError("the batch engine was stopped")
+            self._queue.put(request)
+        return request
+
+    def stop(self, timeout: float = None):
+        """stop - stop the decode loop, requests that are still running or queued fail"""
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def get_stats(self):
+        """get_stats - requests, decode steps, generated tokens, largest batch, and the current batch/queue size"""
+        return dict(self.stats, batch_size=len(self.rows), queued=self._queue.qsize())
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._admit()
+                if self.rows:
+                    self._step()
+            except Exception as e:
+                logging.exception("batch engine step failed")
+                self._fail_all(e)
+        self._fail_all(RuntimeError("the batch engine was stopped"))
+
+    def _fail_all(self, error: Exception):
+        """fail the running requests, and the queued ones too once the engine is stopped"""
+        for request in self.rows:
+            request.finish(error)
+        self.rows = []
+        self.past_key_values = self.attention_mask = None
+        if not self._stop.is_set():
+            return  # after a failed step, the queued requests are still run
+        with self._submit_lock:
+            while True:
+                try:
+                    self._queue.get_nowait().finish(error)
+                except queue.Empty:
+                    break
+
+    def _admit(self):
+        """prefill queued requests into free batch slots (waits for one if the batch is empty)"""
+        while len(self.rows) < self.max_batch_size:
+            try:
+                if self.rows:
+                    request = self._queue.get_nowait()
+                else:
+                    request = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                return
+            if request.token.get_status() is not None:
+                # cancelled or expired while it was queued, no point in a prefill
+                request.finish(status=request.token.get_status())
+                continue
+            try:
+                self._join(request, self._prefill(request))
+            except Exception as e:
+                logging.exception("batch engine prefill failed")
+                request.finish(e)
+            self.stats["requests"] += 1
+
+    def _prefill(self, request: GenerationRequest):
+        input_ids = torch.tensor([request.prompt_ids], device=self.device)
+        with torch.no_grad():
+            out = self.model(input_ids=input_ids, use_cache=True)
+        request.next_logits = out.logits[0, -1]
+        return out.past_key_values
+
+    def _join(self, request: GenerationRequest, past_key_values: tuple):
+        """add a prefilled request to the batch cache as a new row"""
+        mask = torch.ones(
+            (1, len(request.prompt_ids)), dtype=torch.long, device=self.device
+        )
+        if not self.rows:
+            self.past_key_values, self.attention_mask = past_key_values, mask
+        else:
+            length = max(self.attention_mask.shape[1], mask.shape[1])
+            old_past, old_mask = left_pad_cache(
+                self.past_key_values, self.attention_mask, length
+            )
+            new_past, new_mask = left_pad_cache(past_key_values, mask, length)
+            self.past_key_values = tuple(
+                tuple(torch.cat([old, new]) for old, new in zip(old_layer, new_layer))
+                for old_layer, new_layer in zip(old_past, new_past)
+            )
+            self.attention_mask = torch.cat([old_mask, new_mask])
+        self.rows.append(request)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(self.rows))
+
+    def _keep_rows(self, keep: list):
+        """drop finished rows from the batch cache, and padding columns no remaining row needs"""
+        self.rows = [self.rows[i] for i in keep]
+        if not self.rows:
+            self.past_key_values = self.attention_mask = None
+            return
+        idx = torch.tensor(keep, device=self.device)
+        mask = self.attention_mask.index_select(0, idx)
+        n_pad = int((mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+        self.attention_mask = mask[:, n_pad:]
+        self.past_key_values = tuple(
+            tuple(t.index_select(0, idx)[:, :, n_pad:] for t in layer)
+            for layer in self.past_key_values
+        )
+
+    def _sample(self, logits: torch.Tensor):
+        """sample one token per row, each row with its own sampling parameters, in one vectorized step"""
+        next_ids = sample_next_token(
+            logits,
+            top_k=[request.kparam for request in self.rows],
+            top_p=[request.top_p for request in self.rows],
+            temperature=[request.temp for request in self.rows],
+        )
+        return next_ids.tolist()
+
+    def _step(self):
+        """sample the next token for every row, retire finished rows, and run one forward pass for the rest"""
+        logits = torch.stack([request.next_logits for request in self.rows]).float()
+        for i, request in enumerate(self.rows):
+            if len(request.gen_ids) < request.min_new_tokens:
+                logits[i, self.tokenizer.eos_token_id] = -float("inf")
+        next_tokens = self._sample(logits)
+        keep = [
+            i
+            for i, (request, token) in enumerate(zip(self.rows, next_tokens))
+            if request.add_token(token, self.tokenizer)
+        ]
+        self.stats["tokens"] += len(next_tokens)
+        if len(keep) < len(self.rows):
+            self._keep_rows(keep)
+        if not self.rows:
+            return
+
+        input_ids = torch.tensor(
+            [[request.gen_ids[-1]] for request in self.rows], device=self.device
+        )
+        position_ids = self.attention_mask.sum(dim=1, keepdim=True)
+        self.attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+        with torch.no_grad():
+            out = self.model(
+                input_ids=input_ids,
+                past_key_values=self.past_key_values,
+                attention_mask=self.attention_mask,
+                position_ids=position_ids,
+                use_cache=True,
+            )
+        self.past_key_values = out.past_key_values
+        for request, row_logits in zip(self.rows, out.logits[:, -1]):
+            request.next_logits = row_logits
+        self.stats["steps"] += 1
+        if self.verbose and self.stats["steps"] % 50 == 0:
+            print(f"batch engine: {self.get_stats()}")
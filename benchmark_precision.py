@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmark_precision.py - compare fp32, int8 and bf16 CPU inference for a model folder
+
+For each precision the model is loaded through the model registry, and the same prompts (by default, the first utterances
+of the bundled OTTers conversation data) are answered with greedy decoding so the replies are deterministic. Reported per
+precision: load time, weight memory, process RSS growth, generation tokens/s, and how often the reply is identical to the
+fp32 reply.
+
+example:
+    python benchmark_precision.py --model distilgpt2-tiny-conversational --n-prompts 25
+"""
+import argparse
+import logging
+import time
+import warnings
+from pathlib import Path
+
+logging.basicConfig(
+    filename=f"LOGFILE-{Path(__file__).stem}.log",
+    filemode="a",
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+import pandas as pd
+import torch
+
+from ai_single_response import build_prompt, get_speaker_names, isolate_reply
+from generation_utils import get_turn_stopping_criteria
+from model_registry import (
+    PRECISIONS,
+    cpu_supports_bf16,
+    get_model,
+    get_model_key,
+    get_model_stats,
+    unload_model,
+)
+
+warnings.filterwarnings(action="ignore", message=".*gradient_checkpointing*")
+
+_root = Path(__file__).parent
+default_prompts = (
+    _root
+    / "conversation-data"
+    / "OTTers_dataset"
+    / "data"
+    / "in_domain"
+    / "test"
+    / "source.csv"
+)
+
+
+def load_bundled_prompts(prompt_file: str or Path = default_prompts, n: int = 25):
+    """
+    load_bundled_prompts - the first n unique first utterances of an OTTers source.csv file (rows are: index, utterance, utterance)
+    """
+    prompts = []
+    with open(prompt_file, "r", encoding="utf-8") as f:
+        for line in f:
+            parts = [p.strip() for p in line.split(",", 2)]
+            if len(parts) < 2 or not parts[1] or parts[1] in prompts:
+                continue
+            prompts.append(parts[1])
+            if len(prompts) >= n:
+                break
+    return prompts
+
+
+def generate_greedy(ai, folder_path, prompt: str, resp_length: int = 32):
+    """
+    generate_greedy - answer a prompt with greedy decoding
+
+    Returns:
+        tuple: (bot response, number of generated tokens, seconds spent in generate)
+    """
+    speaker, responder = get_speaker_names(folder_path)
+    _, _, input_ids = build_prompt(
+        ai, prompt, speaker=speaker, responder=responder, resp_length=resp_length
+    )
+    pr_len = len(input_ids)
+    pad_token_id = ai.tokenizer.pad_token_id or ai.tokenizer.eos_token_id
+    st = time.perf_counter()
+    with torch.no_grad():
+        output_ids = ai.model.generate(
+            input_ids=input_ids.unsqueeze(0).to(ai.get_device()),
+            attention_mask=torch.ones((1, pr_len), dtype=torch.long).to(
+                ai.get_device()
+            ),
+            max_length=pr_len + resp_length,
+            do_sample=False,
+            pad_token_id=pad_token_id,
+            use_cache=True,
+            stopping_criteria=get_turn_stopping_criteria(
+                ai.tokenizer, pr_len, speaker, responder
+            ),
+        )
+    gen_time = time.perf_counter() - st
+    gen_ids = output_ids[0, pr_len:]
+    gen_text = ai.tokenizer.decode(gen_ids, skip_special_tokens=True)
+    return isolate_reply(gen_text, speaker, responder), len(gen_ids), gen_time
+
+
+def benchmark_precision(
+    folder_path, prompts: list, precision: str = "fp32", resp_length: int = 32
+):
+    """
+    benchmark_precision - load a model at a given precision and answer all prompts
+
+    Returns:
+        tuple: (dict of stats, list of replies)
+    """
+    ai = get_model(folder_path, precision=precision)
+    load_stats = [
+        s
+        for s in get_model_stats()
+        if s["model"] == get_model_key(folder_path)[0] and s["precision"] == precision
+    ][0]
+    generate_greedy(ai, folder_path, prompts[0], resp_length)  # warmup
+    replies, n_tokens, gen_time = [], 0, 0.0
+    for prompt in prompts:
+        reply, n, t = generate_greedy(ai, folder_path, prompt, resp_length)
+        replies.append(reply)
+        n_tokens += n
+        gen_time += t
+    unload_model(folder_path, precision=precision)
+    stats = {
+        "precision": precision,
+        "load_time_s": load_stats["load_time_s"],
+        "param_mb": load_stats["param_mb"],
+        "rss_delta_mb": load_stats["rss_delta_mb"],
+        "tokens_per_s": round(n_tokens / max(gen_time, 1e-9), 1),
+        "s_per_reply": round(gen_time / len(prompts), 3),
+    }
+    return stats, replies
+
+
+def get_parser():
+    """
+    get_parser [a helper function for the argparse module]
+
+    Returns: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(
+        description="benchmark fp32 vs int8 vs bf16 CPU inference for a model"
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        required=False,
+        type=str,
+        default="distilgpt2-tiny-conversational",
+        help="folder - with respect to git directory of your repo that has the model files in it (pytorch.bin + "
+        "config.json). No models? Run the script download_models.py",
+    )
+    parser.add_argument(
+        "--precisions",
+        required=False,
+        nargs="+",
+        default=PRECISIONS,
+        choices=PRECISIONS,
+        help="the precisions to compare (fp32 is always run, as the reference)",
+    )
+    parser.add_argument(
+        "-n",
+        "--n-prompts",
+        required=False,
+        type=int,
+        default=25,
+        help="how many of the bundled prompts to use",
+    )
+    parser.add_argument(
+        "--prompt-file",
+        required=False,
+        type=str,
+        default=str(default_prompts),
+        help="an OTTers-format csv file to take the prompts from",
+    )
+    parser.add_argument(
+        "--resp_length",
+        required=False,
+        type=int,
+        default=32,
+        help="max length of each response (positive integer)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        required=False,
+        type=str,
+        default=None,
+        help="optional path to save the results as a .csv file",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    model_dir = str(args.model)
+    model_loc = Path.cwd() / model_dir if "/" not in model_dir else Path(model_dir)
+    prompts = load_bundled_prompts(args.prompt_file, n=args.n_prompts)
+    precisions = ["fp32"] + [p for p in args.precisions if p != "fp32"]
+    if "bf16" in precisions and not cpu_supports_bf16():
+        print("this CPU has no native bfloat16 support, skipping bf16")
+        precisions.remove("bf16")
+    torch.manual_seed(0)
+
+    results, reference = [], None
+    for precision in precisions:
+        print(f"benchmarking {model_loc.name} at {precision} on {len(prompts)} prompts")
+        stats, replies = benchmark_precision(
+            model_loc, prompts, precision=precision, resp_length=args.resp_length
+        )
+        reference = replies if reference is None else reference
+        stats["reply_agreement"] = round(
+            sum(r == ref for r, ref in zip(replies, reference)) / len(prompts), 3
+        )
+        results.append(stats)
+
+    results_df = pd.DataFrame(results)
+    print(results_df.to_string(index=False))
+    if args.output:
+        results_df.to_csv(args.output, index=False)
+        print(f"saved results to {args.output}")
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bulk_inference.py - answer a JSONL file of prompts with one loaded model, in batches, resumable
+
+Each input line is a JSON record with a prompt and optionally the other query_gpt_model arguments:
+
+    {"id": "q1", "prompt": "hey, what's up?", "history": ["person alpha:\\n", "hi\\n", "\\n", ...],
+     "speaker": "person alpha", "responder": "person beta", "kparam": 20, "temp": 0.4, "top_p": 0.9, "resp_length": 48}
+
+Records are read lazily and generated batch_size at a time with query_gpt_model_batch (records with different sampling
+settings share a batch, records with a different resp_length are generated in a batch of their own). Each result is
+appended to the output JSONL as soon as its batch is done:
+
+    {"id": "q1", "line": 0, "prompt": "hey, what's up?", "response": "...", "n_tokens": 21, "latency_s": 1.9}
+
+latency_s is the time of the record's batch. Records that cannot be parsed get an "error" instead of a response.
+
+After each batch the progress (next input line, output size, tokens and time so far) is saved to <output>.ckpt. A
+killed job started again with the same arguments resumes after the last finished batch; output written after the last
+checkpoint is cut off first, so no record is answered twice. Without a checkpoint for the input, a non-empty output file
+is only overwritten with --overwrite. At the end the total generated tokens/s is reported.
+
+example:
+    python bulk_inference.py --model distilgpt2-tiny-conversational --input prompts.jsonl --output replies.jsonl
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import warnings
+from itertools import groupby
+from pathlib import Path
+
+logging.basicConfig(
+    filename=f"LOGFILE-{Path(__file__).stem}.log",
+    filemode="a",
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+from model_registry import BACKENDS, PRECISIONS
+
+warnings.filterwarnings(action="ignore", message=".*gradient_checkpointing*")
+
+QUERY_KEYS = ["speaker", "responder", "kparam", "temp", "top_p"]
+
+
+def parse_record(line: str, line_no: int):
+    """
+    parse_record - the query_gpt_model_batch query of an input line
+
+    Returns:
+        tuple: (record id, query dict, resp_length or None), raises ValueError for an invalid record
+    """
+    record = json.loads(line)
+    if not isinstance(record, dict) or not str(record.get("prompt", "")).strip():
+        raise ValueError("a record needs a non-empty prompt")
+    query = {"prompt_msg": str(record["prompt"])}
+    if record.get("history"):
+        query["conversation_history"] = list(record["history"])
+    query.update({k: record[k] for k in QUERY_KEYS if record.get(k) is not None})
+    return record.get("id", line_no), query, record.get("resp_length")
+
+
+def read_batches(input_path: str or Path, batch_size: int, start_line: int = 0):
+    """
+    read_batches - read the input file lazily, batch_size lines at a time, starting at start_line
+
+    Yields:
+        tuple: (first line number of the next batch, list of (line number, line))
+    """
+    batch = []
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            if line_no < start_line or not line.strip():
+                continue
+            batch.append((line_no, line))
+            if len(batch) == batch_size:
+                yield line_no + 1, batch
+                batch = []
+    if batch:
+        yield batch[-1][0] + 1, batch
+
+
+def load_checkpoint(ckpt_path: Path, input_path: str or Path):
+    """load_checkpoint - the saved progress for input_path, or None if there is none (or it is for another input)"""
+    if not ckpt_path.exists():
+        return None
+    with open(ckpt_path, "r", encoding="utf-8") as f:
+        ckpt = json.load(f)
+    if ckpt.get("input") != str(Path(input_path).resolve()):
+        logging.warning(
+            f"checkpoint {ckpt_path} is for {ckpt.get('input')}, ignoring it"
+        )
+        return None
+    return ckpt
+
+
+def save_checkpoint(ckpt_path: Path, ckpt: dict):
+    """save_checkpoint - write the progress atomically (a killed job never leaves half a checkpoint)"""
+    tmp_path = ckpt_path.with_suffix(ckpt_path.suffix + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(ckpt, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, ckpt_path)
+
+
+def run_bulk(
+    folder_path: str or Path,
+    input_path: str or Path,
+    output_path: str or Path,
+    batch_size: int = 16,
+    resp_length: int = 48,
+    kparam: int = 20,
+    temp: float = 0.4,
+    top_p: float = 0.9,
+    use_gpu: bool = False,
+    precision: str = "fp32",
+    backend: str = "torch",
+    overwrite: bool = False,
+    verbose: bool = False,
+):
+    """
+    run_bulk - answer every record of input_path and append the results to output_path, resuming from the checkpoint
+
+    Args:
+        folder_path (str or Path): the model folder
+        input_path (str or Path): the input JSONL file
+        output_path (str or Path): the output JSONL file, its checkpoint is <output_path>.ckpt
+        batch_size (int, optional): records generated together. Defaults to 16.
+        resp_length, kparam, temp, top_p: the defaults for records that do not set them, see query_gpt_model
+        use_gpu, precision, backend: how the model is loaded, see query_gpt_model
+        overwrite (bool, optional): start over in a non-empty output file that has no checkpoint for input_path, instead
+            of raising FileExistsError. Defaults to False.
+        verbose (bool, optional): Defaults to False.
+
+    Returns:
+        dict: records, errors, n_tokens and elapsed_s of the whole job (including runs before a resume), and tokens_per_s
+    """
+    from ai_single_response import load_model_or_exit, query_gpt_model_batch
+
+    output_path = Path(output_path)
+    ckpt_path = output_path.with_suffix(output_path.suffix + ".ckpt")
+    ckpt = load_checkpoint(ckpt_path, input_path)
+    if ckpt is None:
+        if output_path.exists() and output_path.stat().st_size > 0 and not overwrite:
+            raise FileExistsError(
+                f"{output_path} is not empty and has no checkpoint for {input_path}, pass overwrite=True (--overwrite) "
+                "to replace it"
+            )
+        ckpt = {
+            "input": str(Path(input_path).resolve()),
+            "next_line": 0,
+            "output_bytes": 0,
+            "records": 0,
+            "errors": 0,
+            "n_tokens": 0,
+            "elapsed_s": 0.0,
+        }
+    else:
+        print(
+            f"resuming at input line {ckpt['next_line']} ({ckpt['records']} records done)"
+        )
+    ai = load_model_or_exit(
+        folder_path, None, use_gpu=use_gpu, precision=precision, backend=backend
+    )
+
+    with open(output_path, "a+b") as out:
+        # drop results written after the checkpoint (everything, when starting over)
+        out.truncate(ckpt["output_bytes"])
+        out.seek(0, os.SEEK_END)
+        for next_line, batch in read_batches(input_path, batch_size, ckpt["next_line"]):
+            st = time.perf_counter()
+            rows, queries = [], []
+            for line_no, line in batch:
+                try:
+                    record_id, query, record_length = parse_record(line, line_no)
+                except ValueError as e:  # json.JSONDecodeError is a ValueError
+                    rows.append({"line": line_no, "error": str(e)})
+                    continue
+                row = {"id": record_id, "line": line_no, "prompt": query["prompt_msg"]}
+                rows.append(row)
+                queries.append((record_length or resp_length, row, query))
+            # one query_gpt_model_batch call per resp_length in the batch
+            queries.sort(key=lambda q: q[0])
+            for length, group in groupby(queries, key=lambda q: q[0]):
+                group = list(group)
+                results = query_gpt_model_batch(
+                    folder_path,
+                    [query for _, _, query in group],
+                    resp_length=length,
+                    kparam=kparam,
+                    temp=temp,
+                    top_p=top_p,
+                    batch_size=len(group),
+                    aitextgen_obj=ai,
+                    verbose=verbose,
+                    backend=backend,
+                )
+                for (_, row, _), result in zip(group, results):
+                    row["response"] = result["out_text"]
+                    row["n_tokens"] = result["n_tokens"]
+            latency = round(time.perf_counter() - st, 3)
+            for row in rows:
+                if "error" not in row:
+                    row["latency_s"] = latency
+                out.write((json.dumps(row) + "\n").encode("utf-8"))
+            out.flush()
+            os.fsync(
+                out.fileno()
+            )  # the results are on disk before the checkpoint says so
+
+            n_errors = sum("error" in row for row in rows)
+            ckpt["next_line"] = next_line
+            ckpt["output_bytes"] = out.tell()
+            ckpt["records"] += len(rows) - n_errors
+            ckpt["errors"] += n_errors
+            ckpt["n_tokens"] += sum(row.get("n_tokens", 0) for row in rows)
+            ckpt["elapsed_s"] += time.perf_counter() - st
+            save_checkpoint(ckpt_path, ckpt)
+            if verbose:
+                print(
+                    f"{ckpt['records']} records, {ckpt['n_tokens']} tokens, "
+                    f"{round(ckpt['n_tokens'] / ckpt['elapsed_s'], 1)} tokens/s"
+                )
+
+    summary = {k: ckpt[k] for k in ["records", "errors", "n_tokens", "elapsed_s"]}
+    summary["tokens_per_s"] = (
+        round(ckpt["n_tokens"] / ckpt["elapsed_s"], 2) if ckpt["elapsed_s"] else 0.0
+    )
+    logging.info(f"bulk inference of {input_path} finished: {summary}")
+    return summary
+
+
+def get_parser():
+    """
+    get_parser [a helper function for the argparse module]
+
+    Returns: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(
+        description="answer a JSONL file of prompts in batches with one loaded model, resumable"
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        required=False,
+        type=str,
+        default="distilgpt2-tiny-conversational",
+        help="folder - with respect to git directory of your repo that has the model files in it (pytorch.bin + "
+        "config.json). You can also pass the huggingface model name (e.g. distilgpt2)",
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        required=True,
+        type=str,
+        help="JSONL file with one record per line (prompt, optional history, speaker, responder, sampling params)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        type=str,
+        help="JSONL file the results are written to (progress is checkpointed to <output>.ckpt)",
+    )
+    parser.add_argument(
+        "--overwrite",
+        default=False,
+        action="store_true",
+        help="replace a non-empty output file that has no checkpoint for this input (otherwise the job refuses to start)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        required=False,
+        type=int,
+        default=16,
+        help="records generated together",
+    )
+    parser.add_argument(
+        "--resp-length",
+        required=False,
+        type=int,
+        default=48,
+        help="the length of a response in tokens, for records that do not set resp_length",
+    )
+    parser.add_argument(
+        "--topk",
+        required=False,
+        type=int,
+        default=20,
+        help="top_k, for records that do not set kparam",
+    )
+    parser.add_argument(
+        "--temp",
+        required=False,
+        type=float,
+        default=0.4,
+        help="temperature, for records that do not set temp",
+    )
+    parser.add_argument(
+        "--topp",
+        required=False,
+        type=float,
+        default=0.9,
+        help="top_p, for records that do not set top_p",
+    )
+    parser.add_argument(
+        "--use_gpu",
+        required=False,
+        action="store_true",
+        help="use gpu if available",
+    )
+    parser.add_argument(
+        "--precision",
+        required=False,
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="model precision for CPU inference: fp32, int8 (dynamic quantization) or bf16 (if the CPU supports it)",
+    )
+    parser.add_argument(
+        "--backend",
+        required=False,
+        type=str,
+        default="torch",
+        choices=BACKENDS,
+        help="inference backend: torch, or onnx for the ONNX Runtime export made with export_onnx.py (one record at a time)",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        default=False,
+        action="store_true",
+        help="pass this argument if you want all the printouts",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    model_dir = str(args.model)
+    model_loc = Path.cwd() / model_dir if "/" not in model_dir else model_dir
+    try:
+        summary = run_bulk(
+            str(model_loc),
+            args.input,
+            args.output,
+            batch_size=args.batch_size,
+            resp_length=args.resp_length,
+            kparam=args.topk,
+            temp=args.temp,
+            top_p=args.topp,
+            use_gpu=args.use_gpu,
+            precision=args.precision,
+            backend=args.backend,
+            overwrite=args.overwrite,
+            verbose=args.verbose,
+        )
+    except FileExistsError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    print(
+        f"{summary['records']} records ({summary['errors']} errors), {summary['n_tokens']} tokens in "
+        f"{round(summary['elapsed_s'], 1)} s: {summary['tokens_per_s']} tokens/s"
+    )
@@ -0,0 +1,72 @@
+"""
+cancellation.py - deadlines and cancellation for generation requests
+
+Once generation has started it runs until the responder's turn is over or resp_length tokens, even if nobody will read
+the reply any more (the user sent a newer message, the client went away, the front end gave up waiting). A
+CancellationToken is passed along with a request (token=... in query_gpt_model, stream_gpt_response, ConversationSession,
+BatchEngine.submit) and is checked between decode steps:
+
+- cancel() stops generation, the request ends with status "cancelled" and an empty reply
+- a deadline (timeout seconds from when the token was created) stops generation with the best partial reply so far and
+  status "deadline"
+
+Partial and cancelled replies are never added to the response caches.
+
+example:
+    from cancellation import CancellationToken
+
+    token = CancellationToken(timeout=10)
+    resp = query_gpt_model("distilgpt2-tiny-conversational", "hey, what's up?", token=token)
+    resp["status"]  # "ok", "deadline" or "cancelled"
+"""
+import threading
+import time
+
+STATUS_OK = "ok"
+STATUS_DEADLINE = "deadline"
+STATUS_CANCELLED = "cancelled"
+
+
+class CancellationToken:
+    """
+    CancellationToken - a cancel flag and an optional deadline for one request. Thread-safe: cancel() can be called from
+    any thread while another one is generating.
+
+    Args:
+        timeout (float, optional): seconds from now until the deadline. Defaults to None (no deadline).
+    """
+
+    def __init__(self, timeout: float = None):
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """cancel - stop the request at the next decode step"""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self):
+        """remaining - seconds until the deadline (0 if it has passed), None if there is no deadline"""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def get_status(self):
+        """
+        get_status - why generation should stop, checked between decode steps
+
+        Returns:
+            str or None: STATUS_CANCELLED, STATUS_DEADLINE, or None if generation may go on
+        """
+        if self.cancelled:
+            return STATUS_CANCELLED
+        if self.expired:
+            return STATUS_DEADLINE
+        return None
@@ -0,0 +1,265 @@
+"""
+chat_memory.py - persistent per-chat conversation memory for the bots, in SQLite
+
+A ChatMemory gives each chat a TurnHistory (turn_history.py) that can be passed straight to query_gpt_model /
+stream_gpt_response as conversation_history, so the bot remembers the conversation, also across restarts.
+
+- storage: one SQLite database in WAL mode, a row per turn; only the last max_turns turns of a chat are kept
+- hot cache: the histories of at most max_chats recently active chats are kept in memory, least recently used first
+  out; chats idle for more than idle_s are dropped from memory too (they are reloaded from the database when needed)
+- writes: every turn is queued as it is appended to a history (so also when its chat has left the hot cache, or the turn
+  was compacted away, in the meantime) and written by a background thread in one transaction every flush_interval_s,
+  so the reply does not wait for the disk
+
+example:
+    from ai_single_response import query_gpt_model
+    from chat_memory import ChatMemory
+    from model_registry import get_model
+
+    memory = ChatMemory("chat_memory.db", get_model("distilgpt2-tiny-conversational").tokenizer)
+    history = memory.get_history(chat_id=42)
+    # the message and the reply are appended to the history, and queued for the database
+    query_gpt_model("distilgpt2-tiny-conversational", "hey, what's up?", conversation_history=history)
+    memory.close()
+"""
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from turn_history import TurnHistory
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    chat_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    speaker TEXT NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (chat_id, seq)
+)
+"""
+
+
+class ChatMemory:
+    """
+    ChatMemory - SQLite-backed conversation histories per chat, with an LRU hot cache and batched background writes.
+    Thread-safe.
+
+    Args:
+        db_path (str or Path): the SQLite database file (created if it does not exist)
+        tokenizer: the tokenizer of the model the histories are used with
+        max_turns (int, optional): turns kept per chat, in memory and in the database. Defaults to 32.
+        max_tokens (int, optional): max history tokens in a prompt, see TurnHistory. Defaults to None.
+        compact_at (int, optional): compact older turns into a summary above this many tokens, see TurnHistory.
+            Defaults to None.
+        summary_tokens (int, optional): the token allowance of the summary. Defaults to 96.
+        max_chats (int, optional): max chats in the hot cache. Defaults to 1000.
+        idle_s (float, optional): seconds without a message after which a chat leaves the hot cache. Defaults to 1800.
+        flush_interval_s (float, optional): seconds between two batched writes. Defaults to 1.
+        verbose (bool, optional): Defaults to False.
+    """
+
+    def __init__(
+        self,
+        db_path: str or Path,
+        tokenizer,
+        max_turns: int = 32,
+        max_tokens: int = None,
+        compact_at: int = None,
+        summary_tokens: int = 96,
+        max_chats: int = 1000,
+        idle_s: float = 1800,
+        flush_interval_s: float = 1.0,
+        verbose: bool = False,
+    ):
+        self.db_path = str(db_path)
+        self.tokenizer = tokenizer
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.compact_at = compact_at
+        self.summary_tokens = summary_tokens
+        self.max_chats = max_chats
+        self.idle_s = idle_s
+        self.flush_interval_s = flush_interval_s
+        self.verbose = verbose
+        # the writer thread and the request threads share the connection, serialized by _db_lock
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # with WAL, NORMAL only syncs at checkpoints: a crash may lose the last turns, not corrupt the database
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(SCHEMA)
+        self._conn.commit()
+        self._db_lock = threading.Lock()
+        # chat_id -> {"history", "last_used"}, least recently used first
+        self._chats = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = []  # (chat_id, seq, speaker, text) rows to write
+        self._pending_chats = set()
+        # chat_id -> the seq of its next turn, for the chats in the hot cache or with turns not written yet. Turns are
+        # numbered here, not by the histories: a chat reloaded while an evicted copy still gets a reply must not reuse
+        # the seqs of turns that are queued
+        self._next_seq = {}
+        self._flush_lock = threading.Lock()  # one flush at a time
+        self.stats = {"loads": 0, "evictions": 0, "flushes": 0, "rows_written": 0}
+        self._stop = threading.Event()
+        self._writer = threading.Thread(
+            target=self._run_writer, name="chat-memory-writer", daemon=True
+        )
+        self._writer.start()
+
+    def get_history(self, chat_id: int):
+        """
+        get_history - the TurnHistory of a chat, from the hot cache or loaded from the database
+
+        Returns:
+            TurnHistory: pass it to query_gpt_model, the turns appended to it are saved
+        """
+        with self._lock:
+            entry = self._chats.get(chat_id)
+            if entry is not None:
+                self._chats.move_to_end(chat_id)
+                entry["last_used"] = time.monotonic()
+                return entry["history"]
+            needs_flush = chat_id in self._pending_chats
+        if needs_flush:
+            self.flush()  # it was evicted before its last turns were written
+        history, next_seq = self._load(chat_id)
+        with self._lock:
+            entry = self._chats.get(chat_id)
+            if entry is None:  # not loaded by another thread in the meantime
+                entry = {"history": history, "last_used": time.monotonic()}
+                self._chats[chat_id] = entry
+                self._next_seq[chat_id] = max(self._next_seq.get(chat_id, 0), next_seq)
+                self.stats["loads"] += 1
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+                self.stats["evictions"] += 1
+            return entry["history"]
+
+    def _load(self, chat_id: int):
+        """the history of a chat from the database, and the seq after its last turn"""
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT seq, speaker, text FROM turns WHERE chat_id = ? ORDER BY seq DESC LIMIT ?",
+                (chat_id, self.max_turns),
+            ).fetchall()
+        history = TurnHistory(
+            self.tokenizer,
+            max_turns=self.max_turns,
+            max_tokens=self.max_tokens,
+            compact_at=self.compact_at,
+            summary_tokens=self.summary_tokens,
+        )
+        for _, speaker, text in reversed(rows):
+            history.append(speaker, text)
+        next_seq = rows[0][0] + 1 if rows else 0
+        history.n_appended = next_seq
+        # from now on, appended turns are queued for the database
+        history.on_append = lambda seq, speaker, text: self._queue(
+            chat_id, speaker, text
+        )
+        return history, next_seq
+
+    def _get_db_next_seq(self, chat_id: int):
+        with self._db_lock:
+            (max_seq,) = self._conn.execute(
+                "SELECT MAX(seq) FROM turns WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+        return 0 if max_seq is None else max_seq + 1
+
+    def _queue(self, chat_id: int, speaker: str, text: str):
+        """number a turn and queue it for the background writer"""
+        with self._lock:
+            seq = self._next_seq.get(chat_id)
+            if seq is None:
+                # not cached and nothing queued (e.g. a reply finished after its chat was evicted and written): the
+                # database is up to date
+                seq = self._get_db_next_seq(chat_id)
+            self._next_seq[chat_id] = seq + 1
+            self._pending.append((chat_id, seq, speaker, text))
+            self._pending_chats.add(chat_id)
+
+    def forget(self, chat_id: int):
+        """forget - delete a chat's history, in memory and in the database"""
+        with self._lock:
+            entry = self._chats.pop(chat_id, None)
+            if entry is not None:
+                # a reply still being generated for the chat is not saved
+                entry["history"].on_append = None
+            self._pending = [row for row in self._pending if row[0] != chat_id]
+            self._pending_chats.discard(chat_id)
+            self._next_seq.pop(chat_id, None)
+        with self._db_lock:
+            self._conn.execute("DELETE FROM turns WHERE chat_id = ?", (chat_id,))
+            self._conn.commit()
+
+    def flush(self):
+        """flush - write the queued turns in one transaction, and drop turns beyond max_turns of the chats written to"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+                chats, self._pending_chats = self._pending_chats, set()
+            if not rows:
+                return
+            with self._db_lock:
+                with self._conn:  # one transaction
+                    self._conn.executemany(
+                        "INSERT INTO turns (chat_id, seq, speaker, text) VALUES (?, ?, ?, ?)",
+                        rows,
+                    )
+                    self._conn.executemany(
+                        "DELETE FROM turns WHERE chat_id = ? AND seq < "
+                        "(SELECT MAX(seq) FROM turns WHERE chat_id = ?) - ? + 1",
+                        [(chat_id, chat_id, self.max_turns) for chat_id in chats],
+                    )
+            with self._lock:
+                self.stats["flushes"] += 1
+                self.stats["rows_written"] += len(rows)
+                # everything queued before this flush is written: chats that are neither cached nor queued again are
+                # numbered from the database next time
+                for chat_id in list(self._next_seq):
+                    if (
+                        chat_id not in self._chats
+                        and chat_id not in self._pending_chats
+                    ):
+                        del self._next_seq[chat_id]
+
+    def evict_idle(self):
+        """evict_idle - drop the chats idle for more than idle_s from the hot cache"""
+        cutoff = time.monotonic() - self.idle_s
+        with self._lock:
+            idle = [
+                chat_id
+                for chat_id, entry in self._chats.items()
+                if entry["last_used"] < cutoff
+            ]
+            for chat_id in idle:
+                del self._chats[chat_id]
+            self.stats["evictions"] += len(idle)
+        if idle and self.verbose:
+            print(f"chat memory: evicted {len(idle)} idle chats")
+
+    def _run_writer(self):
+        while not self._stop.wait(self.flush_interval_s):
+            try:
+                self.flush()
+                self.evict_idle()
+            except Exception:
+                logging.exception("chat memory flush failed")
+
+    def get_stats(self):
+        """get_stats - chats in memory, queued rows, and load/eviction/write counters"""
+        with self._lock:
+            return dict(
+                self.stats, hot_chats=len(self._chats), pending_rows=len(self._pending)
+            )
+
+    def close(self):
+        """close - stop the writer, write the queued turns and close the database"""
+        self._stop.set()
+        self._writer.join()
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
@@ -0,0 +1,119 @@
+"""
+compaction.py - extractive compaction of old conversation turns
+
+When a long conversation no longer fits in the prompt, the oldest turns are dropped and the bot forgets what was said in
+them (names, places, what the user does). A TurnCompactor keeps the most salient sentences of the turns that age out of
+a TurnHistory and puts them back in front of the prompt, as short turns of their original speakers, under a fixed token
+allowance. The prompt length (and so the prefill cost) stays flat while some long-range context is kept.
+
+Salience is cheap lexical scoring: a sentence scores by the content words it shares with the whole conversation so far
+(words that keep coming up are what the conversation is about), normalized by its length. The compactor is incremental:
+a turn's sentences are split and tokenized once, when the turn ages out, and only a bounded pool of candidates is
+re-ranked.
+
+Used through TurnHistory(..., compact_at=..., summary_tokens=...), see turn_history.py.
+"""
+import math
+import re
+from collections import Counter, namedtuple
+
+STOP_WORDS = frozenset(
+    """a about after again all also am an and any are as at be because been but by can could did do does doing don't
+    for from get got had has have he her here hers him his how i i'm if in into is it it's its just know like me more
+    my no not now of oh ok okay on one or our out really said say see she so some than that that's the their them then
+    there they this to too up us very was we well were what when where which who why will with would yeah yes you
+    you're your""".split()
+)
+
+Sentence = namedtuple("Sentence", ["order", "speaker", "text", "words", "token_ids"])
+
+
+def split_sentences(text: str):
+    """split_sentences - split a turn's text into sentences (on . ! ? and line breaks)"""
+    return [s.strip() for s in re.split(r"(?<=[.!?])\s+|\n+", text) if s.strip()]
+
+
+def get_content_words(text: str):
+    """get_content_words - the lowercased words of text without stop words and very short words"""
+    return [
+        w
+        for w in re.findall(r"[a-z0-9']+", text.lower())
+        if len(w) > 2 and w not in STOP_WORDS
+    ]
+
+
+class TurnCompactor:
+    """
+    TurnCompactor - an extractive summary of the turns that aged out of a conversation history
+
+    Args:
+        tokenize_turn (callable): (speaker, text) -> the token ids of the turn in the prompt, TurnHistory.tokenize_turn
+        summary_tokens (int, optional): the token allowance of the summary. Defaults to 96.
+        max_candidates (int, optional): sentences kept as candidates, the lowest scoring are dropped. Defaults to 64.
+        min_words (int, optional): sentences with fewer content words are not candidates. Defaults to 2.
+    """
+
+    def __init__(
+        self,
+        tokenize_turn,
+        summary_tokens: int = 96,
+        max_candidates: int = 64,
+        min_words: int = 2,
+    ):
+        self.tokenize_turn = tokenize_turn
+        self.summary_tokens = summary_tokens
+        self.max_candidates = max_candidates
+        self.min_words = min_words
+        # content words of every turn seen, aged out or not
+        self.word_counts = Counter()
+        self.candidates = []
+        self.summary = []  # the selected sentences, in conversation order
+        self.n_tokens = 0  # tokens of the summary
+        self._order = 0
+
+    def observe(self, text: str):
+        """observe - count the content words of a new turn (this is what makes words salient)"""
+        self.word_counts.update(get_content_words(text))
+
+    def score(self, sentence: Sentence):
+        """score - the salience of a sentence: log-weighted counts of its distinct content words, length-normalized"""
+        words = set(sentence.words)
+        total = sum(math.log1p(self.word_counts[w]) for w in words)
+        return total / math.sqrt(len(sentence.words))
+
+    def add_turn(self, speaker: str, text: str):
+        """
+        add_turn - add the sentences of a turn that aged out of the history, and update the summary
+
+        Args:
+            speaker (str): the speaker of the turn
+            text (str): the text of the turn
+        """
+        for sentence in split_sentences(text):
+            words = get_content_words(sentence)
+            if len(words) < self.min_words:
+                continue
+            token_ids = self.tokenize_turn(speaker, sentence)
+            self.candidates.append(
+                Sentence(self._order, speaker, sentence, words, token_ids)
+            )
+            self._order += 1
+        self._update_summary()
+
+    def _update_summary(self):
+        """re-rank the candidates and fill the allowance with the best ones"""
+        ranked = sorted(self.candidates, key=self.score, reverse=True)
+        self.candidates = ranked[: self.max_candidates]
+        selected, n_tokens = [], 0
+        for sentence in self.candidates:
+            if n_tokens + len(sentence.token_ids) <= self.summary_tokens:
+                selected.append(sentence)
+                n_tokens += len(sentence.token_ids)
+        self.summary = sorted(selected, key=lambda s: s.order)
+        self.n_tokens = n_tokens
+
+    def clear(self):
+        """clear - forget the summary and the word counts"""
+        self.word_counts.clear()
+        self.candidates, self.summary = [], []
+        self.n_tokens = 0
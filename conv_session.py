@@ -0,0 +1,301 @@
+"""
+conv_session.py - a conversation with a GPT model that keeps the transformer KV cache between turns
+
+query_gpt_model rebuilds the prompt from the whole history every turn, and the model re-encodes all of it. A
+ConversationSession keeps the past_key_values of the conversation so far, so each turn only runs the new tokens (the last
+reply + the user message + the responder tag) through the model. When the conversation no longer fits in the token budget,
+the oldest turns are dropped and the cache is rebuilt from the remaining window.
+
+example:
+    from conv_session import ConversationSession
+    from model_registry import get_model
+
+    session = ConversationSession(get_model("distilgpt2-tiny-conversational"))
+    print(session.respond("hey, what's up?")["out_text"])
+    print(session.respond("what are you doing today?")["out_text"])
+"""
+import logging
+
+import torch
+
+from ai_single_response import isolate_reply
+from cancellation import STATUS_CANCELLED, STATUS_OK
+from generation_utils import sample_next_token
+from token_budget import count_tokens, get_context_window, trim_history_to_tokens
+from turn_utils import find_turn_end, get_visible_text, has_repetition
+
+
+class ConversationSession:
+    """
+    ConversationSession - an ongoing conversation with a model, keeping its KV cache between turns
+
+    Args:
+        ai (aitextgen): the loaded model, e.g. from model_registry.get_model
+        speaker (str, optional): the name of the speaker. Defaults to "person alpha".
+        responder (str, optional): the name of the responder. Defaults to "person beta".
+        max_context_tokens (int, optional): token budget for history + new turn + response. Defaults to the model's context window.
+        resp_length (int, optional): the max length of each response in tokens. Defaults to 48.
+        kparam (int, optional): the k parameter for the top_k. Defaults to 20.
+        temp (float, optional): the temperature for the softmax. Defaults to 0.4.
+        top_p (float, optional): the top_p parameter for nucleus sampling. Defaults to 0.9.
+        verbose (bool, optional): Defaults to False.
+    """
+
+    def __init__(
+        self,
+        ai,
+        speaker: str = "person alpha",
+        responder: str = "person beta",
+        max_context_tokens: int = None,
+        resp_length: int = 48,
+        kparam: int = 20,
+        temp: float = 0.4,
+        top_p: float = 0.9,
+        verbose: bool = False,
+    ):
+        self.ai = ai
+        self.model = ai.model
+        self.tokenizer = ai.tokenizer
+        self.device = ai.get_device()
+        self.speaker = speaker
+        self.responder = responder
+        context_window = get_context_window(ai.model)
+        self.max_context_tokens = min(
+            max_context_tokens or context_window, context_window
+        )
+        self.resp_length = resp_length
+        self.kparam = kparam
+        self.temp = temp
+        self.top_p = top_p
+        self.verbose = verbose
+        self.stats = {"turns": 0, "prefill_tokens": 0, "rebuilds": 0}
+        self.reset()
+
+    def reset(self):
+        """reset - forget the conversation and the cache"""
+        self.history = (
+            []
+        )  # conversation as lines, same format as query_gpt_model's full_conv
+        self.past_key_values = None
+        self.cache_len = 0  # number of tokens in past_key_values
+        self.pending_text = ""  # history text not yet in the cache (the last reply)
+        self.pending_ids = (
+            []
+        )  # token ids of history not yet in the cache, they go before pending_text
+        self.last_result = None
+
+    def _encode(self, text: str):
+        return self.tokenizer(text)["input_ids"]
+
+    def _forward(self, ids: list):
+        """run ids through the model on top of the cache, returns the logits of the last position"""
+        input_ids = torch.tensor([ids], dtype=torch.long, device=self.device)
+        with torch.no_grad():
+            out = self.model(
+                input_ids=input_ids,
+                past_key_values=self.past_key_values,
+                use_cache=True,
+            )
+        self.past_key_values = out.past_key_values
+        self.cache_len += len(ids)
+        return out.logits[0, -1]
+
+    def _crop_cache(self, length: int):
+        """drop everything after the first length tokens from the cache"""
+        self.past_key_values = tuple(
+            tuple(t[:, :, :length] for t in layer) for layer in self.past_key_values
+        )
+        self.cache_len = length
+
+    def _prefill(self, new_turn: list, resp_length: int):
+        """
+        put the new turn (and the pending reply) into the cache, rebuilding from a trimmed window if it does not fit.
+        Returns the logits for the first response token.
+        """
+        new_turn_text = "".join(new_turn)
+        new_ids = self.pending_ids + self._encode(self.pending_text + new_turn_text)
+        self.pending_text = ""
+        self.pending_ids = []
+        if self.cache_len + len(new_ids) + resp_length <= self.max_context_tokens:
+            self.stats["prefill_tokens"] += len(new_ids)
+            return self._forward(new_ids)
+
+        # sliding window: keep the most recent whole turns that fit, re-encode them once
+        budget = (
+            self.max_context_tokens
+            - resp_length
+            - count_tokens(self.tokenizer, new_turn_text)
+        )
+        self.history = trim_history_to_tokens(
+            self.history, self.tokenizer, max_tokens=max(budget, 0)
+        )
+        window_ids = self._encode("".join(self.history) + new_turn_text)
+        window_ids = window_ids[-(self.max_context_tokens - resp_length) :]
+        logging.info(
+            f"session cache rebuilt: {len(self.history)} history lines, {len(window_ids)} tokens"
+        )
+        self.stats["rebuilds"] += 1
+        self.stats["prefill_tokens"] += len(window_ids)
+        self.past_key_values = None
+        self.cache_len = 0
+        return self._forward(window_ids)
+
+    def _iter_decode(
+        self,
+        logits,
+        resp_length: int,
+        kparam: int,
+        temp: float,
+        top_p: float,
+        token=None,
+    ):
+        """
+        sample up to resp_length tokens, stopping at the end of the responder's turn (or when token is cancelled or
+        expires). Yields the generated text so far after every token.
+        """
+        gen_ids = []
+        for _ in range(resp_length):
+            if token is not None and token.get_status() is not None:
+                break
+            next_id = sample_next_token(
+                logits, top_k=kparam, top_p=top_p, temperature=temp
+            )
+            if next_id == self.tokenizer.eos_token_id:
+                break
+            gen_ids.append(next_id)
+            text = self.tokenizer.decode(gen_ids, skip_special_tokens=True)
+            yield text
+            if find_turn_end(text, self.speaker, self.responder) != -1:
+                break
+            if has_repetition(gen_ids) or len(gen_ids) == resp_length:
+                break
+            logits = self._forward([next_id])
+
+    def load_history(self, conversation_history: list, token_ids: list = None):
+        """
+        load_history - start the session from an existing conversation (a list of lines, as in query_gpt_model). It is
+        put in the cache with the next turn, trimmed to the token budget if needed.
+
+        Args:
+            conversation_history (list): the conversation as lines
+            token_ids (list, optional): the token ids of the lines, if they are known (e.g. from TurnHistory.get_window),
+                so they are not tokenized again. Defaults to None.
+        """
+        self.reset()
+        self.history = list(conversation_history)
+        if token_ids is not None:
+            self.pending_ids = list(token_ids)
+        else:
+            self.pending_text = "".join(self.history)
+
+    def stream(
+        self,
+        prompt_msg: str,
+        resp_length: int = None,
+        kparam: int = None,
+        temp: float = None,
+        top_p: float = None,
+        token=None,
+    ):
+        """
+        stream - like respond, but a generator that yields the reply as it is decoded. Speaker tags and everything after
+        the end of the responder's turn are stripped from the partial replies. The last value yielded is always the final
+        reply, and the full result dict is then available as self.last_result.
+
+        Args:
+            prompt_msg (str): the message to respond to
+            resp_length, kparam, temp, top_p (optional): override the session's settings for this turn
+            token (cancellation.CancellationToken, optional): stop decoding when it is cancelled (the reply is empty) or
+                its deadline passes (the reply is what was decoded so far). Defaults to None.
+
+        Yields:
+            str: the bot response so far
+        """
+        resp_length = self.resp_length if resp_length is None else resp_length
+        new_turn = [
+            self.speaker.lower() + ":" + "\n",
+            prompt_msg.lower() + "\n",
+            "\n",
+            self.responder.lower() + ":" + "\n",
+        ]
+        logits = self._prefill(new_turn, resp_length)
+        prompt_len = self.cache_len
+        gen_text = ""
+        last_partial = ""
+        finished = False
+        try:
+            for gen_text in self._iter_decode(
+                logits,
+                resp_length=resp_length,
+                kparam=self.kparam if kparam is None else kparam,
+                temp=self.temp if temp is None else temp,
+                top_p=self.top_p if top_p is None else top_p,
+                token=token,
+            ):
+                partial = isolate_reply(
+                    get_visible_text(gen_text, self.speaker, self.responder),
+                    self.speaker,
+                    self.responder,
+                )
+                if partial and partial != last_partial:
+                    last_partial = partial
+                    yield partial
+            finished = True
+        finally:
+            # the raw generated tokens are dropped from the cache, the cleaned up reply goes in with the next turn
+            self._crop_cache(prompt_len)
+            if not finished:
+                # the caller stopped iterating (or decoding failed): the message is in the cache, so it goes in the
+                # history too, without a reply (as a cancelled one)
+                self.history.extend(new_turn + ["\n", "\n"])
+                self.pending_text = "\n" + "\n"
+        status = None if token is None else token.get_status() or STATUS_OK
+        bot_resp = isolate_reply(
+            gen_text, self.speaker, self.responder, verbose=self.verbose
+        )
+        if status == STATUS_CANCELLED:
+            bot_resp = ""  # the message stays in the conversation, without a reply
+        self.history.extend(new_turn + [bot_resp + "\n", "\n"])
+        self.pending_text = bot_resp + "\n" + "\n"
+        self.stats["turns"] += 1
+        if self.verbose:
+            print(f"session stats: {self.stats}, cache length {self.cache_len}")
+        self.last_result = {
+            "out_text": bot_resp,
+            "full_conv": dict(enumerate(self.history)),
+        }
+        if status is not None:
+            self.last_result["status"] = status
+        yield bot_resp
+
+    def respond(
+        self,
+        prompt_msg: str,
+        resp_length: int = None,
+        kparam: int = None,
+        temp: float = None,
+        top_p: float = None,
+        token=None,
+    ):
+        """
+        respond - add prompt_msg to the conversation (said by the speaker) and generate the responder's reply
+
+        Args:
+            prompt_msg (str): the message to respond to
+            resp_length, kparam, temp, top_p (optional): override the session's settings for this turn
+            token (cancellation.CancellationToken, optional): see stream. Defaults to None.
+
+        Returns:
+            dict: out_text (str) the bot response and full_conv (dict) the conversation history, as in query_gpt_model
+            (and status with a token)
+        """
+        for _ in self.stream(
+            prompt_msg,
+            resp_length=resp_length,
+            kparam=kparam,
+            temp=temp,
+            top_p=top_p,
+            token=token,
+        ):
+            pass
+        return self.last_result
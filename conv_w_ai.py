@@ -22,10 +22,10 @@ logging.basicConfig(
     level=logging.INFO,
 )
 
-from aitextgen import aitextgen
-
-from ai_single_response import query_gpt_model
-from utils import get_timestamp, shorten_list
+from ai_single_response import get_speaker_names, query_gpt_model
+from model_registry import PRECISIONS, get_model
+from turn_history import TurnHistory
+from utils import get_timestamp
 
 warnings.filterwarnings(action="ignore", message=".*gradient_checkpointing*")
 
@@ -42,6 +42,9 @@ def converse_w_ai(
     top_p: float = 0.9,
     verbose: bool = False,
     use_gpu: bool = False,
+    use_kv_cache: bool = True,
+    precision: str = "fp32",
+    compact_at: int = None,
 ):
     """
     converse_w_ai - a helper function for the aitextgen module calling query_gpt_model
@@ -52,17 +55,22 @@ def converse_w_ai(
         speaker (str, optional): Who the prompt is from (to the bot). Primarily relevant to bots trained on multi-individual chat data. Defaults to None.
         responder (str, optional): who the responder is. Primarily relevant to bots trained on multi-individual chat data. Defaults to "person beta".
         resp_length (int, optional): the length of the response in tokens. Defaults to 48.
-        max_context_length (int, optional): the maximum length of the context _in characters_. Defaults to 512.
+        max_context_length (int, optional): the maximum length of the conversation history _in tokens_. Defaults to 512.
         kparam (int, optional): the k parameter for the top_k. Defaults to 40.
         temp (float, optional): the temperature for the softmax. Defaults to 0.7.
         top_p (float, optional): the top_p parameter for nucleus sampling. Defaults to 0.9.
         verbose (bool, optional): Defaults to False.
         use_gpu (bool, optional): Defaults to False.
+        use_kv_cache (bool, optional): keep the model's KV cache between turns (ConversationSession) so each turn only processes the new tokens. If False, the prompt is rebuilt from the history every turn with query_gpt_model. Defaults to True.
+        precision (str, optional): model precision, "fp32", "int8" or "bf16" (CPU only). Defaults to "fp32".
+        compact_at (int, optional): condense older turns into a short extractive summary once the history has more than this many tokens (see compaction.py). Only without the KV cache (use_kv_cache=False), else ValueError. Defaults to None.
 
     Returns:
         [list]: [a list of strings, each string is a response]
     """
 
+    if use_kv_cache and compact_at is not None:
+        raise ValueError("compact_at needs use_kv_cache=False (--no-kv-cache)")
     if verbose:
         print(f"initializing conversation... {get_timestamp()}")
     start_msg = (
@@ -75,9 +83,8 @@ def converse_w_ai(
         mpath.stem
     )  # only want the base name of the model folder for check below
     try:
-        ai = aitextgen(
-            model_folder=folder_path,
-            to_gpu=use_gpu,
+        ai = get_model(
+            folder_path, use_gpu=use_gpu, precision=precision, verbose=verbose
         )
     except Exception as e:
         print(f"Unable to initialize aitextgen model: {e}")
@@ -87,6 +94,26 @@ def converse_w_ai(
         sys.exit(1)
     prompt_msg = start_msg if start_msg is not None else None
     conversation = {}
+    if use_kv_cache:
+        from conv_session import ConversationSession  # imports torch
+
+        speaker, responder = get_speaker_names(folder_path, speaker, responder)
+        session = ConversationSession(
+            ai,
+            speaker=speaker,
+            responder=responder,
+            max_context_tokens=max_context_length + resp_length,
+            resp_length=resp_length,
+            kparam=kparam,
+            temp=temp,
+            top_p=top_p,
+            verbose=verbose,
+        )
+    else:
+        # the conversation so far, kept and trimmed to max_context_length tokens by whole turns
+        history = TurnHistory(
+            ai.tokenizer, max_tokens=max_context_length, compact_at=compact_at
+        )
     # start conversation
     print(
         f"Entering chat room with GPT Model {mpath_base}. CTRL+C to exit, or type 'exit' to end conversation"
@@ -104,34 +131,31 @@ def converse_w_ai(
                 f"exiting conversation loop based on {prompt_msg} input - {get_timestamp()}"
             )
             break
-        # safeguard against max_input_length (ai-textgen does not support this)
-        current_history = list(conversation.values())
-        conversation_history = shorten_list(
-            current_history, max_chars=max_context_length, no_blanks=True
-        )
-        model_outputs = query_gpt_model(
-            folder_path=folder_path,
-            prompt_msg=prompt_msg,
-            conversation_history=conversation_history
-            if len(conversation_history) > 0
-            else None,
-            speaker=speaker,
-            responder=responder,
-            resp_length=resp_length,
-            kparam=kparam,
-            temp=temp,
-            top_p=top_p,
-            aitextgen_obj=ai,
-            verbose=verbose,
-            use_gpu=use_gpu,
-        )
+        if use_kv_cache:
+            model_outputs = session.respond(prompt_msg)
+        else:
+            # the message and the reply are appended to history
+            model_outputs = query_gpt_model(
+                folder_path=folder_path,
+                prompt_msg=prompt_msg,
+                conversation_history=history,
+                speaker=speaker,
+                responder=responder,
+                resp_length=resp_length,
+                kparam=kparam,
+                temp=temp,
+                top_p=top_p,
+                aitextgen_obj=ai,
+                verbose=verbose,
+                use_gpu=use_gpu,
+            )
         bot_resp = model_outputs["out_text"]
         conversation = model_outputs["full_conv"]
         pp.pprint(bot_resp, indent=4)
 
         prompt_msg = None
 
-    return list(conversation.values())
+    return list(conversation.values()) if use_kv_cache else list(history)
 
 
 # Set up the parsing of command-line arguments
@@ -209,13 +233,21 @@ def get_parser():
         action="store_true",
         help="use gpu if available",
     )
+    parser.add_argument(
+        "--precision",
+        required=False,
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="model precision for CPU inference: fp32, int8 (dynamic quantization) or bf16 (if the CPU supports it)",
+    )
 
     parser.add_argument(
         "--max-context-length",
         required=False,
         type=int,
         default=512,
-        help="the maximum length of the context _in characters_. Defaults to 512",
+        help="the maximum length of the conversation history _in tokens_. Defaults to 512",
     )
     parser.add_argument(
         "--resp-length",
@@ -225,6 +257,20 @@ def get_parser():
         help="the length of the response in tokens. Defaults to 48",
     )
 
+    parser.add_argument(
+        "--no-kv-cache",
+        default=False,
+        action="store_true",
+        help="rebuild the prompt from the history every turn instead of keeping the model's KV cache between turns",
+    )
+    parser.add_argument(
+        "--compact-at",
+        required=False,
+        type=int,
+        default=None,
+        help="with --no-kv-cache: above this many tokens of history, older turns are condensed into a short summary",
+    )
+
     parser.add_argument(
         "-rt",
         "--time",
@@ -245,7 +291,10 @@ def get_parser():
 
 if __name__ == "__main__":
     # parse the command line arguments
-    args = get_parser().parse_args()
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.compact_at is not None and not args.no_kv_cache:
+        parser.error("--compact-at only works with --no-kv-cache")
     query = args.prompt
     model_dir = str(args.model)
     model_loc = Path.cwd() / model_dir
@@ -269,8 +318,13 @@ if __name__ == "__main__":
         kparam=k_results,
         temp=my_temp,
         top_p=my_top_p,
+        resp_length=args.resp_length,
+        max_context_length=args.max_context_length,
         verbose=want_verbose,
+        use_kv_cache=not args.no_kv_cache,
+        precision=args.precision,
         use_gpu=use_gpu,
+        compact_at=args.compact_at,
     )
 
     # print the runtime / transcript
@@ -21,10 +21,16 @@ import logging
 import argparse
 import time
 import warnings
+from functools import lru_cache
 from pathlib import Path
 from transformers import pipeline
 from datetime import datetime
 from ai_single_response import query_gpt_model
+from batch_engine import BatchEngine
+from model_registry import PRECISIONS, get_model, print_model_stats
+from response_cache import ResponseCache
+from semantic_cache import SemanticCache
+from worker_pool import WorkerPool
 
 logging.basicConfig(
     filename=f"LOGFILE-{Path(__file__).stem}.log",
@@ -40,8 +46,13 @@ warnings.filterwarnings(action="ignore", message=".*gradient_checkpointing*")
 
 cwd = Path.cwd()
 my_cwd = str(cwd.resolve())  # string so it can be passed to os.path() objects
+response_cache = None  # a ResponseCache if the app is run with --response-cache
+semantic_cache = None  # a SemanticCache if the app is run with --semantic-cache
+engine = None  # a BatchEngine if the app is run with --batch-engine
+worker_pool = None  # a WorkerPool if the app is run with --workers
 
 
+@lru_cache(maxsize=1024)  # cached replies come back often, correct each one once
 def gramformer_correct(corrector, qphrase: str):
     """
     gramformer_correct - correct a string using a text2textgen pipeline model from transformers
@@ -92,14 +103,27 @@ def ask_gpt(message: str, sender: str = ""):
     else:
         prompt_speaker = None  # fallback
 
-    resp = query_gpt_model(
-        folder_path=model_loc,
+    query_kwargs = dict(
         prompt_msg=prompt,
         speaker=prompt_speaker,
         kparam=150,  # top k responses
         temp=0.75,  # temperature
         top_p=0.65,  # nucleus sampling
+        response_cache=response_cache,
+        semantic_cache=semantic_cache,
     )
+    # gradio 2.x Interface functions return one output, so the reply is not streamed here (see telegram_bot.py)
+    if worker_pool is not None:
+        resp = worker_pool.query(**query_kwargs)
+    else:
+        resp = query_gpt_model(
+            folder_path=model_loc,
+            aitextgen_obj=get_model(
+                model_loc, precision=model_precision
+            ),  # shared, loaded once on startup
+            engine=engine,
+            **query_kwargs,
+        )
     bot_resp = gramformer_correct(
         corrector, qphrase=resp["out_text"]
     )  # correct grammar
@@ -108,6 +132,14 @@ def ask_gpt(message: str, sender: str = ""):
     )  # remove trailing punctuation to seem more natural
     rt = round(time.time() - st, 2)
     print(f"took {rt} sec to respond")
+    if response_cache is not None:
+        print(f"response cache: {response_cache.get_stats()}")
+    if semantic_cache is not None:
+        print(f"semantic cache: {semantic_cache.get_stats()}")
+    if engine is not None:
+        print(f"batch engine: {engine.get_stats()}")
+    if worker_pool is not None:
+        print(f"worker pool: {worker_pool.get_stats()}")
 
     return bot_resp
 
@@ -163,6 +195,68 @@ def get_parser():
         help="text2text generation model ID from huggingface for the model to correct grammar",
     )
 
+    parser.add_argument(
+        "--precision",
+        required=False,
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="model precision for CPU inference: fp32, int8 (dynamic quantization) or bf16 (if the CPU supports it)",
+    )
+    parser.add_argument(
+        "--response-cache",
+        default=False,
+        action="store_true",
+        help="answer repeated messages from a pool of earlier replies instead of generating every time",
+    )
+    parser.add_argument(
+        "--cache-pool-size",
+        required=False,
+        type=int,
+        default=3,
+        help="with --response-cache or --semantic-cache: replies generated per message before they are reused",
+    )
+    parser.add_argument(
+        "--semantic-cache",
+        default=False,
+        action="store_true",
+        help="also answer near-duplicates of earlier messages (e.g. 'hey whats up' / 'hey, what's up?') from the cache",
+    )
+    parser.add_argument(
+        "--semantic-threshold",
+        required=False,
+        type=float,
+        default=0.8,
+        help="with --semantic-cache: min similarity (0-1) between two messages to reuse the replies",
+    )
+    parser.add_argument(
+        "--batch-engine",
+        default=False,
+        action="store_true",
+        help="answer concurrent messages in one shared decode batch (continuous batching) instead of one at a time",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        required=False,
+        type=int,
+        default=8,
+        help="with --batch-engine: max messages decoded together, more wait for a free slot",
+    )
+    parser.add_argument(
+        "--workers",
+        required=False,
+        type=int,
+        default=0,
+        help="answer messages in this many forked worker processes that share the model weights (0: in this process)",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        required=False,
+        type=int,
+        default=None,
+        help="with --workers: intra-op threads of each worker (default: the cores divided between the workers)",
+    )
+
     return parser
 
 
@@ -171,6 +265,13 @@ if __name__ == "__main__":
     default_model = str(args.model)
     model_loc = cwd.parent / default_model
     model_loc = str(model_loc.resolve())
+    model_precision = args.precision
+    if args.response_cache:
+        response_cache = ResponseCache(pool_size=args.cache_pool_size)
+    if args.semantic_cache:
+        semantic_cache = SemanticCache(
+            threshold=args.semantic_threshold, pool_size=args.cache_pool_size
+        )
     gram_model = args.gram_model
 
     # init items for the pipeline
@@ -198,13 +299,31 @@ if __name__ == "__main__":
             "doesn't make sense",
             "bad/offensive response",
         ],
-        enable_queue=True,  # allows for dealing with multiple users simultaneously
+        # the queue answers one request at a time, the batch engine and worker pool need concurrent requests
+        enable_queue=not (args.batch_engine or args.workers > 0),
         theme="darkhuggingface",
     )
 
     corrector = pipeline("text2text-generation", model=gram_model, device=-1)
     print("Finished loading the gramformer model - ", datetime.now())
     print(f"using model stored here: \n {model_loc} \n")
+    if args.workers > 0:
+        # forked before anything runs on the model in this process, see worker_pool.py
+        worker_pool = WorkerPool(
+            model_loc,
+            n_workers=args.workers,
+            threads_per_worker=args.threads_per_worker,
+            precision=model_precision,
+        )
+    get_model(
+        model_loc, precision=model_precision, verbose=True
+    )  # load before the first message arrives
+    print_model_stats()
+    if args.batch_engine:
+        engine = BatchEngine(
+            get_model(model_loc, precision=model_precision),
+            max_batch_size=args.max_batch_size,
+        )
 
     # launch the gradio interface and start the server
     iface.launch(share=True)
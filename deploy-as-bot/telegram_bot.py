@@ -5,9 +5,10 @@ you need to have your own token to create and run one - this script loads and re
 
 creating a bot: https://www.codementor.io/@karandeepbatra/part-1-how-to-create-a-telegram-bot-in-python-in-under-10-minutes-19yfdv4wrq
 
-# TODO: add conversation flow + context from previous messages
+with --memory-db, each chat's conversation is kept (in SQLite, see chat_memory.py) and passed to the model as context
 """
 import argparse
+import asyncio
 import os
 import sys
 from os.path import dirname
@@ -17,6 +18,8 @@ sys.path.append(dirname(dirname(os.path.abspath(__file__))))
 import logging
 import time
 import warnings
+from functools import lru_cache
+from pathlib import Path
 
 logging.basicConfig(
     filename=f"LOGFILE-{Path(__file__).stem}.log",
@@ -26,14 +29,31 @@ logging.basicConfig(
 )
 
 
-from symspellpy import SymSpell
 from telegram.ext import CommandHandler
 from telegram.ext import Filters, MessageHandler
 from telegram.ext import Updater
-from pathlib import Path
 from transformers import pipeline
 
-from ai_single_response import query_gpt_model
+from ai_single_response import (
+    add_exchange_to_history,
+    get_speaker_names,
+    stream_gpt_response,
+)
+from async_inference import (
+    AsyncInference,
+    ServerBusyError,
+    iterate_threadsafe,
+    start_event_loop,
+)
+from batch_engine import BatchEngine
+from cancellation import CancellationToken
+from chat_memory import ChatMemory
+from load_shedding import LoadShedder
+from model_registry import PRECISIONS, get_model, print_model_stats
+from response_cache import ResponseCache
+from semantic_cache import SemanticCache
+from spell_correct import get_corrector
+from worker_pool import WorkerPool
 from utils import remove_trailing_punctuation, DisableLogger
 
 with DisableLogger():
@@ -41,30 +61,22 @@ with DisableLogger():
 
 warnings.filterwarnings(action="ignore", message=".*gradient_checkpointing*")
 cwd = Path.cwd()
+STREAM_EDIT_INTERVAL = 1.0  # seconds between edits of the reply message while streaming
+response_cache = None  # a ResponseCache if the bot is run with --response-cache
+semantic_cache = None  # a SemanticCache if the bot is run with --semantic-cache
+engine = None  # a BatchEngine if the bot is run with --batch-engine
+worker_pool = None  # a WorkerPool if the bot is run with --workers
+# an AsyncInference if the bot is run with --max-queue or --load-shedding
+inference_api = None
+api_loop = None  # the event loop inference_api runs on
+load_shedder = None  # a LoadShedder if the bot is run with --load-shedding
+chat_memory = None  # a ChatMemory if the bot is run with --memory-db
+reply_deadline = None  # seconds, set with --deadline: a reply that takes longer is sent as it is so far
+chat_tokens = {}  # chat id -> the CancellationToken of the reply being generated
 my_cwd = str(cwd.resolve())  # string so it can be passed to os.path() objects
 
 
-def symspell_correct(speller, qphrase: str):
-    """
-    symspell_correct corrects a string using symspellpy
-
-    Args:
-        speller (symspellpy.SymSpell): [symspellpy SymSpell class object, already instantiated]
-        qphrase (str): [text to be corrected]
-
-    Returns:
-        [str]: [corrected text]
-    """
-    suggestions = speller.lookup_compound(
-        clean(qphrase), max_edit_distance=2, ignore_non_words=True
-    )
-    if len(suggestions) < 1:
-        return qphrase
-    else:
-        first_result = suggestions[0]
-        return first_result._term
-
-
+@lru_cache(maxsize=1024)  # cached replies come back often, correct each one once
 def gramformer_correct(corrector, qphrase: str):
     """
     gramformer_correct - correct a string using a text2textgen pipeline model from transformers
@@ -102,10 +114,34 @@ def help(update, context):
     )
 
 
+def forget(update, context):
+    """Forget the conversation so far when the command /forget is issued."""
+    if chat_memory is None:
+        update.message.reply_text("the bot does not remember conversations")
+        return
+    chat_memory.forget(update.effective_chat.id)
+    update.message.reply_text("ok, starting over")
+
+
 def echo(update, context):
     context.bot.send_message(chat_id=update.effective_chat.id, text=update.message.text)
 
 
+def edit_reply(context, message, text: str, shown_text: str):
+    """
+    edit_reply - edit a message the bot already sent to show text, if it is different from what is shown
+
+    Returns:
+        str: the text now shown in the message
+    """
+    if not text.strip() or text == shown_text:
+        return shown_text  # telegram rejects empty edits and edits that change nothing
+    context.bot.edit_message_text(
+        chat_id=message.chat_id, message_id=message.message_id, text=text
+    )
+    return text
+
+
 def ask_gpt(update, context):
     """
     ask_gpt - queries the relevant gpt2 model and interfaces with Telegram
@@ -130,34 +166,119 @@ def ask_gpt(update, context):
     except:
         # there was some issue getting that info, whatever
         prompt_speaker = None
-    context.bot.send_message(
+    status_msg = context.bot.send_message(
         chat_id=update.effective_chat.id,
         text="... neurons are working ...",  # confirms receipt / running to user
     )
-    resp = query_gpt_model(
-        folder_path=model_loc,
+    # a newer message from the same chat cancels the reply still being generated for an older one
+    token = CancellationToken(timeout=reply_deadline)
+    previous_token = chat_tokens.get(update.effective_chat.id)
+    chat_tokens[update.effective_chat.id] = token
+    if previous_token is not None:
+        previous_token.cancel()
+    # stream the reply into the status message as it is generated
+    shown_text = status_msg.text
+    last_edit = 0
+    raw_resp = ""
+    history = None
+    if chat_memory is not None:
+        history = chat_memory.get_history(update.effective_chat.id)
+    # in this process the history is passed as it is and the reply is appended to it, worker processes get its lines
+    in_process = worker_pool is None
+    query_kwargs = dict(
         prompt_msg=prompt,
+        conversation_history=history
+        if in_process or history is None
+        else list(history),
         speaker=prompt_speaker,
         kparam=125,
         temp=0.75,
         top_p=0.65,  # can be changed based on hyperparam desires
+        token=token,
     )
+    caches = dict(response_cache=response_cache, semantic_cache=semantic_cache)
+    policy = None  # the load shedding policy this message was admitted under
+    if inference_api is not None:
+        policy = inference_api.get_policy()
+        # bounded queue: when the bot is overloaded the message is turned away right away
+        replies = iterate_threadsafe(
+            inference_api.stream(**query_kwargs, policy=policy), api_loop
+        )
+    elif worker_pool is not None:
+        # a worker answers with the whole reply, there is nothing to stream
+        replies = [worker_pool.query(**query_kwargs, **caches)["out_text"]]
+    else:
+        replies = stream_gpt_response(
+            folder_path=model_loc,
+            aitextgen_obj=get_model(
+                model_loc, precision=model_precision
+            ),  # shared, loaded once on bot start
+            engine=engine,
+            **query_kwargs,
+            **caches,
+        )
+    try:
+        for raw_resp in replies:
+            # telegram rate-limits message edits, so only update every STREAM_EDIT_INTERVAL seconds
+            if time.time() - last_edit > STREAM_EDIT_INTERVAL:
+                shown_text = edit_reply(
+                    context, status_msg, raw_resp + " ...", shown_text
+                )
+                last_edit = time.time()
+    except (ServerBusyError, asyncio.TimeoutError) as e:
+        print(f"could not answer: {type(e).__name__}: {e}")
+        edit_reply(
+            context,
+            status_msg,
+            "the bot is busy right now, please try again in a minute",
+            shown_text,
+        )
+        return
+    finally:
+        if chat_tokens.get(update.effective_chat.id) is token:
+            del chat_tokens[update.effective_chat.id]
+    if token.cancelled:
+        # superseded by a newer message, which gets its own reply
+        context.bot.delete_message(
+            chat_id=status_msg.chat_id, message_id=status_msg.message_id
+        )
+        return
+    if chat_memory is not None and not in_process:
+        # in this process the reply was appended to the history already (and queued for the database)
+        speaker, responder = get_speaker_names(model_loc, prompt_speaker, None)
+        add_exchange_to_history(history, prompt, raw_resp, speaker, responder)
     # now, actually respond from model
-    if use_gramformer:
-        bot_resp = gramformer_correct(corrector, qphrase=resp["out_text"])
+    if policy is not None and policy["skip_gramformer"]:
+        bot_resp = raw_resp  # under load, the correction is skipped
+    elif use_gramformer:
+        bot_resp = gramformer_correct(corrector, qphrase=raw_resp)
     else:
-        bot_resp = symspell_correct(sym_spell, qphrase=resp["out_text"])
+        bot_resp = get_corrector().correct(raw_resp)  # memoized
     bot_resp = remove_trailing_punctuation(
         bot_resp
     )  # remove trailing punctuation to seem more natural
+    edit_reply(context, status_msg, bot_resp, shown_text)
     rt = round(time.time() - st, 2)
     print(f"took {rt} sec to respond")
-    context.bot.send_message(chat_id=update.effective_chat.id, text=bot_resp)
+    if response_cache is not None:
+        print(f"response cache: {response_cache.get_stats()}")
+    if semantic_cache is not None:
+        print(f"semantic cache: {semantic_cache.get_stats()}")
+    if engine is not None:
+        print(f"batch engine: {engine.get_stats()}")
+    if worker_pool is not None:
+        print(f"worker pool: {worker_pool.get_stats()}")
+    if inference_api is not None:
+        print(f"inference queue: {inference_api.get_stats()}")
+    if load_shedder is not None:
+        print(f"load shedding: {load_shedder.get_stats()}")
+    if chat_memory is not None:
+        print(f"chat memory: {chat_memory.get_stats()}")
 
 
 def error(update, context):
     """Log Errors caused by Updates."""
-    logger.warning('Update "%s" caused error "%s"', update, context.error)
+    logging.warning('Update "%s" caused error "%s"', update, context.error)
 
 
 def unknown(update, context):
@@ -168,14 +289,6 @@ def unknown(update, context):
     )
 
 
-dictionary_path = (
-    r"../symspell_rsc/frequency_dictionary_en_82_765.txt"  # from repo root
-)
-bigram_path = (
-    r"symspell_rsc/frequency_bigramdictionary_en_243_342.txt"  # from repo root
-)
-
-
 def get_parser():
     """
     get_parser - a helper function for the argparse module
@@ -210,6 +323,137 @@ def get_parser():
         help="text2text generation model ID from huggingface for the model to correct grammar",
     )
 
+    parser.add_argument(
+        "--precision",
+        required=False,
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="model precision for CPU inference: fp32, int8 (dynamic quantization) or bf16 (if the CPU supports it)",
+    )
+    parser.add_argument(
+        "--response-cache",
+        default=False,
+        action="store_true",
+        help="answer repeated messages from a pool of earlier replies instead of generating every time",
+    )
+    parser.add_argument(
+        "--cache-pool-size",
+        required=False,
+        type=int,
+        default=3,
+        help="with --response-cache or --semantic-cache: replies generated per message before they are reused",
+    )
+    parser.add_argument(
+        "--semantic-cache",
+        default=False,
+        action="store_true",
+        help="also answer near-duplicates of earlier messages (e.g. 'hey whats up' / 'hey, what's up?') from the cache",
+    )
+    parser.add_argument(
+        "--semantic-threshold",
+        required=False,
+        type=float,
+        default=0.8,
+        help="with --semantic-cache: min similarity (0-1) between two messages to reuse the replies",
+    )
+    parser.add_argument(
+        "--batch-engine",
+        default=False,
+        action="store_true",
+        help="answer concurrent messages in one shared decode batch (continuous batching) instead of one at a time",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        required=False,
+        type=int,
+        default=8,
+        help="with --batch-engine: max messages decoded together, more wait for a free slot",
+    )
+    parser.add_argument(
+        "--workers",
+        required=False,
+        type=int,
+        default=0,
+        help="answer messages in this many forked worker processes that share the model weights (0: in this process)",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        required=False,
+        type=int,
+        default=None,
+        help="with --workers: intra-op threads of each worker (default: the cores divided between the workers)",
+    )
+    parser.add_argument(
+        "--max-queue",
+        required=False,
+        type=int,
+        default=0,
+        help="max messages waiting for the model, more are answered with a 'busy' message (0: no limit)",
+    )
+    parser.add_argument(
+        "--request-timeout",
+        required=False,
+        type=float,
+        default=None,
+        help="with --max-queue: seconds after which a message gets the 'busy' message instead of a reply",
+    )
+    parser.add_argument(
+        "--deadline",
+        required=False,
+        type=float,
+        default=None,
+        help="seconds to generate a reply, after that the reply is sent as it is so far",
+    )
+    parser.add_argument(
+        "--load-shedding",
+        default=False,
+        action="store_true",
+        help="under load, shorten replies, skip the grammar correction and then switch to --fallback-model",
+    )
+    parser.add_argument(
+        "--target-latency",
+        required=False,
+        type=float,
+        default=10,
+        help="with --load-shedding: reply time (p90, seconds) above which replies are degraded",
+    )
+    parser.add_argument(
+        "--fallback-model",
+        required=False,
+        type=str,
+        default="distilgpt2-tiny-conversational",
+        help="with --load-shedding: the small model used under heavy load",
+    )
+    parser.add_argument(
+        "--memory-db",
+        required=False,
+        type=str,
+        default=None,
+        help="SQLite file to keep each chat's conversation in, so replies have context (default: no memory)",
+    )
+    parser.add_argument(
+        "--memory-turns",
+        required=False,
+        type=int,
+        default=32,
+        help="with --memory-db: turns kept per chat",
+    )
+    parser.add_argument(
+        "--memory-tokens",
+        required=False,
+        type=int,
+        default=512,
+        help="with --memory-db: max tokens of conversation history in a prompt",
+    )
+    parser.add_argument(
+        "--compact-at",
+        required=False,
+        type=int,
+        default=None,
+        help="with --memory-db: above this many tokens of history, older turns are condensed into a short summary",
+    )
+
     return parser
 
 
@@ -218,6 +462,14 @@ if __name__ == "__main__":
     default_model = str(args.model)
     model_loc = cwd.parent / default_model
     model_loc = str(model_loc.resolve())
+    model_precision = args.precision
+    reply_deadline = args.deadline
+    if args.response_cache:
+        response_cache = ResponseCache(pool_size=args.cache_pool_size)
+    if args.semantic_cache:
+        semantic_cache = SemanticCache(
+            threshold=args.semantic_threshold, pool_size=args.cache_pool_size
+        )
     gram_model = args.gram_model
     print(f"using model stored here: \n {model_loc} \n")
     # get token
@@ -225,7 +477,50 @@ if __name__ == "__main__":
     my_vars = dict(env_var)
     my_token = my_vars["GPTFRIEND_BOT"]
 
+    if args.workers > 0:
+        # forked before anything runs on the model in this process, see worker_pool.py
+        worker_pool = WorkerPool(
+            model_loc,
+            n_workers=args.workers,
+            threads_per_worker=args.threads_per_worker,
+            precision=model_precision,
+        )
     # load on bot start so does not have to reload
+    get_model(model_loc, precision=model_precision, verbose=True)
+    print_model_stats()
+    if args.memory_db is not None:
+        chat_memory = ChatMemory(
+            args.memory_db,
+            get_model(model_loc, precision=model_precision).tokenizer,
+            max_turns=args.memory_turns,
+            max_tokens=args.memory_tokens,
+            compact_at=args.compact_at,
+        )
+    if args.batch_engine:
+        engine = BatchEngine(
+            get_model(model_loc, precision=model_precision),
+            max_batch_size=args.max_batch_size,
+        )
+    if args.load_shedding:
+        load_shedder = LoadShedder(
+            max_queue_depth=args.max_queue or 4,
+            target_latency_s=args.target_latency,
+            fallback_model=str((cwd.parent / args.fallback_model).resolve()),
+            verbose=True,
+        )
+    if args.max_queue > 0 or args.load_shedding:
+        api_loop = start_event_loop()
+        inference_api = AsyncInference(
+            model_loc,
+            max_queue=args.max_queue or None,
+            load_shedder=load_shedder,
+            timeout=args.request_timeout,
+            engine=engine,
+            worker_pool=worker_pool,
+            response_cache=response_cache,
+            semantic_cache=semantic_cache,
+            precision=model_precision,
+        )
     use_gramformer = args.use_gramformer
 
     if use_gramformer:
@@ -233,9 +528,9 @@ if __name__ == "__main__":
         corrector = pipeline("text2text-generation", model=gram_model, device=-1)
     else:
         print("using default SymSpell..")
-        sym_spell = SymSpell(max_dictionary_edit_distance=2, prefix_length=7)
-        sym_spell.load_dictionary(dictionary_path, term_index=0, count_index=1)
-        sym_spell.load_bigram_dictionary(bigram_path, term_index=0, count_index=2)
+        get_corrector(
+            verbose=True
+        ).load()  # the shared corrector, loaded now rather than on the first message
 
     updater = Updater(token=my_token, use_context=True)
 
@@ -246,7 +541,18 @@ if __name__ == "__main__":
     help_handler = CommandHandler("help", help)
     dispatcher.add_handler(help_handler)
 
-    gpt_handler = MessageHandler(Filters.text & (~Filters.command), ask_gpt)
+    forget_handler = CommandHandler("forget", forget)
+    dispatcher.add_handler(forget_handler)
+
+    # with the batch engine, worker pool or queue, messages are handled in threads so that they can be generated concurrently
+    gpt_handler = MessageHandler(
+        Filters.text & (~Filters.command),
+        ask_gpt,
+        run_async=args.batch_engine
+        or args.workers > 0
+        or args.max_queue > 0
+        or args.load_shedding,
+    )
     dispatcher.add_handler(gpt_handler)
 
     unknown_handler = MessageHandler(Filters.command, unknown)
@@ -258,3 +564,5 @@ if __name__ == "__main__":
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
+    if chat_memory is not None:
+        chat_memory.close()  # write the last turns
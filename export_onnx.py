@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+export_onnx.py - export a model folder to ONNX (with past key values) for fast CPU inference with ONNX Runtime
+
+The model is exported with the transformers.onnx "causal-lm-with-past" feature, so the graph takes the KV cache as input and
+returns the updated cache, and each decode step only runs the newest token. The export (model.onnx + config + tokenizer
+files) is saved to <model folder>/onnx, where the registry looks for it when a script is run with --backend onnx.
+
+requires: pip install onnx onnxruntime
+
+example:
+    python export_onnx.py --model distilgpt2-tiny-conversational
+    python ai_single_response.py --model distilgpt2-tiny-conversational --prompt "hey, what's up?" --backend onnx
+"""
+import argparse
+import logging
+import warnings
+from pathlib import Path
+
+logging.basicConfig(
+    filename=f"LOGFILE-{Path(__file__).stem}.log",
+    filemode="a",
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers.onnx import FeaturesManager, export, validate_model_outputs
+
+from onnx_backend import ONNX_FILENAME, ONNX_SUBFOLDER
+
+warnings.filterwarnings(action="ignore", message=".*gradient_checkpointing*")
+
+ONNX_FEATURE = "causal-lm-with-past"
+
+
+def export_model(
+    folder_path: str or Path,
+    output_dir: str or Path = None,
+    opset: int = None,
+    validate: bool = True,
+    atol: float = 1e-4,
+    verbose: bool = False,
+):
+    """
+    export_model - export a model folder to ONNX with past key values as inputs/outputs
+
+    Args:
+        folder_path (str or Path): the path to the model folder
+        output_dir (str or Path, optional): where to save the export. Defaults to <folder_path>/onnx.
+        opset (int, optional): the ONNX opset. Defaults to None (the default for the model type).
+        validate (bool, optional): check the ONNX outputs against the PyTorch model. Defaults to True.
+        atol (float, optional): the tolerance for the validation. Defaults to 1e-4.
+        verbose (bool, optional): Defaults to False.
+
+    Returns:
+        Path: the path to the exported .onnx file
+    """
+    folder_path = Path(folder_path)
+    output_dir = Path(output_dir) if output_dir else folder_path / ONNX_SUBFOLDER
+    output_dir.mkdir(parents=True, exist_ok=True)
+    onnx_path = output_dir / ONNX_FILENAME
+
+    tokenizer = AutoTokenizer.from_pretrained(folder_path)
+    model = AutoModelForCausalLM.from_pretrained(folder_path)
+    model.config.use_cache = True
+    model.eval()
+    _, model_onnx_config = FeaturesManager.check_supported_model_or_raise(
+        model, feature=ONNX_FEATURE
+    )
+    onnx_config = model_onnx_config(model.config)
+    opset = opset or onnx_config.default_onnx_opset
+    if verbose:
+        print(f"exporting {folder_path.name} to {onnx_path} with opset {opset}")
+
+    onnx_inputs, onnx_outputs = export(tokenizer, model, onnx_config, opset, onnx_path)
+    logging.info(
+        f"exported {folder_path} to {onnx_path}, inputs {onnx_inputs}, outputs {onnx_outputs}"
+    )
+    if validate:
+        validate_model_outputs(
+            onnx_config, tokenizer, model, onnx_path, onnx_outputs, atol
+        )
+        if verbose:
+            print(f"ONNX outputs match the PyTorch model (atol {atol})")
+
+    # the backend loads the config and tokenizer from the export folder
+    model.config.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    return onnx_path
+
+
+def get_parser():
+    """
+    get_parser [a helper function for the argparse module]
+
+    Returns: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(
+        description="export a model folder to ONNX for inference with ONNX Runtime"
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        required=False,
+        type=str,
+        default="distilgpt2-tiny-conversational",
+        help="folder - with respect to git directory of your repo that has the model files in it (pytorch.bin + "
+        "config.json). No models? Run the script download_models.py",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        required=False,
+        type=str,
+        default=None,
+        help="where to save the export (default: <model folder>/onnx)",
+    )
+    parser.add_argument(
+        "--opset",
+        required=False,
+        type=int,
+        default=None,
+        help="ONNX opset version (default: the default for the model type)",
+    )
+    parser.add_argument(
+        "--no-validate",
+        default=False,
+        action="store_true",
+        help="skip checking the ONNX outputs against the PyTorch model",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        default=False,
+        action="store_true",
+        help="pass this argument if you want all the printouts",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    model_dir = str(args.model)
+    model_loc = Path.cwd() / model_dir if "/" not in model_dir else Path(model_dir)
+    onnx_path = export_model(
+        model_loc,
+        output_dir=args.output_dir,
+        opset=args.opset,
+        validate=not args.no_validate,
+        verbose=args.verbose,
+    )
+    print(f"saved ONNX model to {onnx_path}")
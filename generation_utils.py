@@ -0,0 +1,331 @@
+"""
+generation_utils.py - helpers that run inside the model's decode loop
+
+get_bot_response throws away everything after the responder's turn, so any tokens decoded after that point are wasted.
+TurnEndCriteria stops model.generate as soon as every sequence in the batch has finished the responder's turn, using the
+same rules as get_bot_response (a line with a foreign "name:" tag, a line with the speaker's name) plus a blank-line turn
+separator and a repetition check (see turn_utils.py).
+
+sample_next_token implements the same temperature / top_k / top_p sampling as model.generate for code that runs its own
+decode loop (e.g. ConversationSession, which keeps the KV cache between turns). The sampling parameters can also be given
+per row, so a batch of sequences with different settings is sampled in one vectorized step (BatchEngine), or generated
+in one model.generate call with RowSamplingWarper (query_gpt_model_batch).
+"""
+import torch
+from transformers import (
+    LogitsProcessor,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
+
+from turn_utils import find_turn_end, has_repetition
+
+
+def get_row_params(value, default, logits: torch.Tensor, dtype=torch.float32):
+    """
+    get_row_params - a sampling parameter as a column tensor of shape (batch, 1): a number applies to every row, a list
+    or tensor of shape (batch,) gives one value per row
+    """
+    value = default if value is None else value
+    value = torch.as_tensor(value, dtype=dtype, device=logits.device)
+    return value.expand(logits.size(0)).unsqueeze(-1)
+
+
+def top_k_top_p_filter(logits: torch.Tensor, top_k=0, top_p=1.0):
+    """
+    top_k_top_p_filter - mask logits outside the top_k tokens and outside the top_p nucleus with -inf
+
+    Args:
+        logits (torch.Tensor): logits of shape (batch, vocab)
+        top_k (int or list, optional): keep only the k most likely tokens, 0 to disable. One value per row for
+            sequences with different settings. Defaults to 0.
+        top_p (float or list, optional): keep the smallest set of tokens with cumulative probability >= top_p. One value
+            per row for sequences with different settings. Defaults to 1.0.
+
+    Returns:
+        torch.Tensor: the filtered logits
+    """
+    vocab_size = logits.size(-1)
+    top_k = get_row_params(top_k, 0, logits, dtype=torch.long)
+    top_k = top_k.masked_fill(top_k <= 0, vocab_size).clamp(max=vocab_size)
+    if (top_k < vocab_size).any():
+        # one topk call for the largest k, then each row's own kth largest logit
+        kth_largest = torch.topk(logits, int(top_k.max()))[0].gather(-1, top_k - 1)
+        logits = logits.masked_fill(logits < kth_largest, -float("inf"))
+    top_p = get_row_params(top_p, 1.0, logits)
+    if (top_p < 1.0).any():
+        top_p = top_p.masked_fill(top_p >= 1.0, float("inf"))  # rows without top_p
+        sorted_logits, sorted_idx = torch.sort(logits, descending=True)
+        cum_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        sorted_remove = cum_probs > top_p
+        # shift right so the token that crosses top_p is kept, always keep the most likely token
+        sorted_remove[..., 1:] = sorted_remove[..., :-1].clone()
+        sorted_remove[..., 0] = False
+        remove = sorted_remove.scatter(-1, sorted_idx, sorted_remove)
+        logits = logits.masked_fill(remove, -float("inf"))
+    return logits
+
+
+def warp_logits(logits: torch.Tensor, top_k=20, top_p=0.9, temperature=0.4):
+    """
+    warp_logits - apply temperature, then top_k, then top_p (the order model.generate uses). Each parameter is a number
+    for the whole batch or one value per row, so sequences with different settings are processed together.
+
+    Args:
+        logits (torch.Tensor): logits of shape (batch, vocab)
+        top_k (int or list, optional): Defaults to 20.
+        top_p (float or list, optional): Defaults to 0.9.
+        temperature (float or list, optional): Defaults to 0.4.
+
+    Returns:
+        torch.Tensor: the warped logits (float32)
+    """
+    temperature = get_row_params(temperature, 1.0, logits).clamp(min=1e-5)
+    logits = logits.float() / temperature
+    return top_k_top_p_filter(logits, top_k=top_k, top_p=top_p)
+
+
+def sample_next_token(logits: torch.Tensor, top_k=20, top_p=0.9, temperature=0.4):
+    """
+    sample_next_token - sample the next token from the logits of the last position, in the same order model.generate
+    applies its warpers (temperature, then top_k, then top_p)
+
+    Args:
+        logits (torch.Tensor): logits of shape (vocab,) or (batch, vocab)
+        top_k (int or list, optional): a number, or one value per row. Defaults to 20.
+        top_p (float or list, optional): a number, or one value per row. Defaults to 0.9.
+        temperature (float or list, optional): a number, or one value per row. Defaults to 0.4.
+
+    Returns:
+        int or torch.Tensor: the sampled token id (an int for 1-D logits, else a tensor of shape (batch,))
+    """
+    single = logits.dim() == 1
+    logits = logits.unsqueeze(0) if single else logits
+    logits = warp_logits(logits, top_k=top_k, top_p=top_p, temperature=temperature)
+    next_ids = torch.multinomial(logits.softmax(dim=-1), num_samples=1).squeeze(-1)
+    return next_ids[0].item() if single else next_ids
+
+
+class RowSamplingWarper(LogitsProcessor):
+    """
+    RowSamplingWarper - per-row temperature / top_k / top_p for model.generate, so prompts with different sampling
+    settings can be generated in one batch. Pass temperature=1.0, top_k=0 and top_p=1.0 to generate so that its own
+    warpers are off, and this processor does all the warping.
+
+    Args:
+        top_k (list): top_k for each row
+        top_p (list): top_p for each row
+        temperature (list): temperature for each row
+    """
+
+    def __init__(self, top_k: list, top_p: list, temperature: list):
+        self.top_k = list(top_k)
+        self.top_p = list(top_p)
+        self.temperature = list(temperature)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        return warp_logits(
+            scores, top_k=self.top_k, top_p=self.top_p, temperature=self.temperature
+        )
+
+
+def get_row_sampling_kwargs(top_k: list, top_p: list, temperature: list):
+    """
+    get_row_sampling_kwargs - model.generate keyword arguments that sample each row of the batch with its own settings
+
+    Returns:
+        dict: top_k, top_p and temperature that turn generate's own warpers off, and a RowSamplingWarper
+    """
+    return dict(
+        top_k=0,
+        top_p=1.0,
+        temperature=1.0,
+        logits_processor=LogitsProcessorList(
+            [RowSamplingWarper(top_k, top_p, temperature)]
+        ),
+    )
+
+
+class TurnEndCriteria(StoppingCriteria):
+    """
+    TurnEndCriteria - stop generation once every sequence has finished the responder's turn
+
+    Args:
+        tokenizer: the model's tokenizer
+        prompt_length (int): the (padded) prompt length in tokens, generated tokens start after it
+        speakers (list): the speaker name for each row in the batch
+        responders (list): the responder name for each row in the batch
+        ngram (int, optional): n-gram size for the repetition check. Defaults to 4.
+        max_repeats (int, optional): occurrences of the last n-gram that count as a loop. Defaults to 3.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        prompt_length: int,
+        speakers: list,
+        responders: list,
+        ngram: int = 4,
+        max_repeats: int = 3,
+    ):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.speakers = speakers
+        self.responders = responders
+        self.ngram = ngram
+        self.max_repeats = max_repeats
+        self.done = [False] * len(speakers)
+
+    def row_is_done(self, row: int, gen_ids: list):
+        """row_is_done - check a single row's generated ids for the end of the responder's turn"""
+        if self.tokenizer.eos_token_id in gen_ids:
+            return True
+        if has_repetition(gen_ids, self.ngram, self.max_repeats):
+            return True
+        text = self.tokenizer.decode(gen_ids, skip_special_tokens=True)
+        return find_turn_end(text, self.speakers[row], self.responders[row]) != -1
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ):
+        # rows are repeated if num_return_sequences > 1
+        n_per_row = max(input_ids.shape[0] // len(self.speakers), 1)
+        if len(self.done) != input_ids.shape[0]:
+            self.done = [False] * input_ids.shape[0]
+        for i in range(input_ids.shape[0]):
+            if self.done[i]:
+                continue
+            gen_ids = input_ids[i, self.prompt_length :].tolist()
+            self.done[i] = self.row_is_done(i // n_per_row, gen_ids)
+        return all(self.done)
+
+
+class CancellationCriteria(StoppingCriteria):
+    """
+    CancellationCriteria - stop generation when the request's CancellationToken is cancelled or its deadline has passed
+
+    Args:
+        token (cancellation.CancellationToken): the request's token
+    """
+
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ):
+        return self.token.get_status() is not None
+
+
+def get_turn_stopping_criteria(
+    tokenizer, prompt_length: int, speakers: list, responders: list, token=None
+):
+    """
+    get_turn_stopping_criteria - a StoppingCriteriaList with a TurnEndCriteria, to pass as model.generate(stopping_criteria=...)
+
+    Args:
+        tokenizer: the model's tokenizer
+        prompt_length (int): the (padded) prompt length in tokens
+        speakers (list or str): the speaker name, or one per row in the batch
+        responders (list or str): the responder name, or one per row in the batch
+        token (cancellation.CancellationToken, optional): also stop when it is cancelled or expires. Defaults to None.
+    """
+    speakers = [speakers] if isinstance(speakers, str) else list(speakers)
+    responders = [responders] if isinstance(responders, str) else list(responders)
+    criteria = [TurnEndCriteria(tokenizer, prompt_length, speakers, responders)]
+    if token is not None:
+        criteria.append(CancellationCriteria(token))
+    return StoppingCriteriaList(criteria)
+
+
+def score_replies(model, prompt_ids: torch.Tensor, reply_ids: list):
+    """
+    score_replies - length-normalised log-likelihood of each candidate reply given the prompt. The prompt is run through
+    the model once, its KV cache is shared by all candidates, and the candidates are scored together in one batched forward.
+
+    Args:
+        model (transformers.PreTrainedModel): the model, i.e. aitextgen.model
+        prompt_ids (torch.Tensor): 1-D tensor of prompt token ids
+        reply_ids (list): a list of token id lists, one per candidate (may be empty)
+
+    Returns:
+        list: the mean log-probability per reply token for each candidate, -inf for empty candidates
+    """
+    device = model.device
+    n = len(reply_ids)
+    max_len = max((len(ids) for ids in reply_ids), default=0)
+    if max_len == 0:
+        return [-float("inf")] * n
+
+    replies = torch.zeros((n, max_len), dtype=torch.long)
+    reply_mask = torch.zeros((n, max_len), dtype=torch.long)
+    for i, ids in enumerate(reply_ids):
+        replies[i, : len(ids)] = torch.tensor(ids, dtype=torch.long)
+        reply_mask[i, : len(ids)] = 1
+    replies, reply_mask = replies.to(device), reply_mask.to(device)
+
+    with torch.no_grad():
+        prompt_out = model(input_ids=prompt_ids.unsqueeze(0).to(device), use_cache=True)
+        past = tuple(
+            tuple(t.expand(n, *t.shape[1:]) for t in layer)
+            for layer in prompt_out.past_key_values
+        )
+        attention_mask = torch.cat(
+            [
+                torch.ones((n, len(prompt_ids)), dtype=torch.long, device=device),
+                reply_mask,
+            ],
+            dim=1,
+        )
+        reply_out = model(
+            input_ids=replies, past_key_values=past, attention_mask=attention_mask
+        )
+    # the logits predicting reply token t are at position t-1 (the last prompt position for t=0)
+    logits = torch.cat(
+        [
+            prompt_out.logits[:, -1:].expand(n, 1, -1),
+            reply_out.logits[:, :-1],
+        ],
+        dim=1,
+    )
+    token_logprobs = (
+        logits.float().log_softmax(dim=-1).gather(-1, replies.unsqueeze(-1)).squeeze(-1)
+    )
+    token_logprobs = token_logprobs * reply_mask
+    lengths = reply_mask.sum(dim=1)
+    scores = token_logprobs.sum(dim=1) / lengths.clamp(min=1)
+    return [
+        score.item() if length > 0 else -float("inf")
+        for score, length in zip(scores, lengths)
+    ]
+
+
+def get_reply_penalty(
+    reply: str, raw_text: str, speaker: str, responder: str, tag_penalty: float = 1.0
+):
+    """
+    get_reply_penalty - penalty subtracted from a candidate's score for replies that are broken: empty (-inf), or
+    polluted with name tags (the speaker's/responder's name in the reply, or name tags before any reply text)
+
+    Args:
+        reply (str): the cleaned up candidate reply
+        raw_text (str): the raw generated text the reply was taken from
+        speaker (str): the name of the speaker
+        responder (str): the name of the responder
+        tag_penalty (float, optional): penalty per problem found. Defaults to 1.0.
+
+    Returns:
+        float: the penalty (>= 0)
+    """
+    if not reply.strip():
+        return float("inf")
+    penalty = 0.0
+    reply_lower = reply.lower()
+    for name in [speaker.lower(), responder.lower()]:
+        if name in reply_lower:
+            penalty += tag_penalty
+    first_line = raw_text.strip().split("\n")[0].lower()
+    if ":" in first_line:
+        penalty += tag_penalty  # the model started with another name tag
+    return penalty
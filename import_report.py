@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+import_report.py - report how long it takes to import the repo's scripts, broken down per top-level package
+
+Each module is imported in a fresh interpreter with python -X importtime, and the time spent importing every module is
+summed per top-level package (torch, transformers, pandas, ...), wherever in the import tree it was pulled in. Use it to check that a change did not make `--help` slow again:
+the scripts only import torch / aitextgen / cleantext when a response is generated, and --with-deps shows what that
+costs on top.
+
+example:
+    python import_report.py ai_single_response conv_w_ai --with-deps
+"""
+import argparse
+import subprocess
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+HEAVY_DEPS = ["torch", "transformers", "aitextgen", "cleantext"]
+DEFAULT_MODULES = ["ai_single_response", "conv_w_ai"]
+
+
+def parse_importtime(stderr: str):
+    """
+    parse_importtime - sum the self import time of every module in python -X importtime output per top-level package, so
+    the package times add up to the total import time
+
+    Args:
+        stderr (str): the stderr of a python -X importtime run
+
+    Returns:
+        dict: package name -> import time in seconds
+    """
+    per_package = defaultdict(float)
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|", 2)
+        per_package[name.strip().split(".")[0]] += int(self_us) / 1e6
+    return dict(per_package)
+
+
+def get_import_times(modules: list, cwd: str or Path = None):
+    """
+    get_import_times - import modules in a fresh interpreter and time the import of every package
+
+    Args:
+        modules (list): module names to import, in order
+        cwd (str or Path, optional): where to run the interpreter. Defaults to the repo root.
+
+    Returns:
+        dict: package name -> import time in seconds
+    """
+    cwd = cwd or Path(__file__).parent
+    statement = "; ".join(f"import {m}" for m in modules)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=str(cwd),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        last_line = result.stderr.strip().splitlines()[-1]
+        raise ImportError(f"importing {modules} failed: {last_line}")
+    return parse_importtime(result.stderr)
+
+
+def print_import_report(module: str, times: dict, top: int = 10):
+    """print_import_report - print the total import time of a module and its slowest packages"""
+    total = sum(times.values())
+    print(f"\n{module}: {round(total, 3)} s to import")
+    for package, seconds in sorted(times.items(), key=lambda x: -x[1])[:top]:
+        print(
+            f"    {package:<30} {round(seconds, 3):>8} s  {round(100 * seconds / total):>3}%"
+        )
+
+
+def get_parser():
+    """
+    get_parser [a helper function for the argparse module]
+
+    Returns: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(
+        description="report the import time of the repo's scripts per top-level package"
+    )
+    parser.add_argument(
+        "modules",
+        nargs="*",
+        default=DEFAULT_MODULES,
+        help=f"the modules to report on (default: {' '.join(DEFAULT_MODULES)})",
+    )
+    parser.add_argument(
+        "--with-deps",
+        default=False,
+        action="store_true",
+        help=f"also import the dependencies loaded on first generation ({', '.join(HEAVY_DEPS)})",
+    )
+    parser.add_argument(
+        "--top",
+        required=False,
+        type=int,
+        default=10,
+        help="how many packages to list per module",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    for module in args.modules:
+        to_import = [module] + (HEAVY_DEPS if args.with_deps else [])
+        try:
+            times = get_import_times(to_import)
+        except ImportError as e:
+            print(f"\n{module}: {e}")
+            continue
+        label = f"{module} + {', '.join(HEAVY_DEPS)}" if args.with_deps else module
+        print_import_report(label, times, top=args.top)
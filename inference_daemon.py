@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+inference_daemon.py - a long-lived local process that keeps models loaded and answers query_gpt_model requests over a
+Unix socket
+
+Every `python ai_single_response.py --prompt ...` run has to load the model before it can generate, which takes much longer
+than the generation itself. While the daemon is running, ai_single_response.py hands its request to the daemon (same
+arguments, same printed output) and only pays for generation; if no daemon is running it generates in-process as before.
+
+Requests are handled one at a time (generation already uses all CPU cores) and models are kept in the model registry,
+so each model folder is loaded once, on its first request or at startup with --preload.
+
+example:
+    python inference_daemon.py --preload distilgpt2-tiny-conversational &
+    python ai_single_response.py --prompt "hey, what's up?"
+    python inference_daemon.py --stop
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+logging.basicConfig(
+    filename=f"LOGFILE-{Path(__file__).stem}.log",
+    filemode="a",
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+DEFAULT_SOCKET = os.environ.get(
+    "AI_MSGBOT_SOCKET", str(Path(tempfile.gettempdir()) / "ai-msgbot.sock")
+)
+
+
+def send_request(request: dict, socket_path: str = DEFAULT_SOCKET, timeout=None):
+    """
+    send_request - send one request to the daemon and wait for its response
+
+    Args:
+        request (dict): the request, with key cmd ("query", "ping" or "stop") and for queries kwargs for query_gpt_model
+        socket_path (str, optional): the daemon's socket. Defaults to DEFAULT_SOCKET.
+        timeout (float, optional): seconds to wait for the response. Defaults to None (wait for as long as it takes).
+
+    Returns:
+        dict or None: the response, or None if no daemon is listening on socket_path
+    """
+    if not Path(socket_path).exists():
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as f:
+                line = f.readline()
+    except (ConnectionRefusedError, FileNotFoundError):
+        return None  # stale socket file, the daemon is not running
+    except OSError as e:
+        logging.warning(f"inference daemon connection failed: {e}")
+        return None  # e.g. the daemon died while answering
+    try:
+        return json.loads(line) if line else None
+    except ValueError:
+        logging.warning("inference daemon sent an incomplete response")
+        return None
+
+
+def query_daemon(socket_path: str = DEFAULT_SOCKET, **kwargs):
+    """
+    query_daemon - run query_gpt_model in the daemon
+
+    Args:
+        socket_path (str, optional): the daemon's socket. Defaults to DEFAULT_SOCKET.
+        **kwargs: the query_gpt_model arguments (JSON serializable, folder_path as a string). A folder_path that
+            exists here is sent as an absolute path, the daemon runs in another working directory.
+
+    Returns:
+        tuple or None: (model_resp, printed output) - the query_gpt_model return value and what it printed, or None if no
+        daemon is running or it could not answer (then generate in-process)
+    """
+    folder_path = kwargs.get("folder_path")
+    if folder_path is not None and Path(folder_path).exists():
+        kwargs = dict(kwargs, folder_path=str(Path(folder_path).resolve()))
+    response = send_request({"cmd": "query", "kwargs": kwargs}, socket_path)
+    if response is None:
+        return None
+    if not response["ok"]:
+        logging.warning(f"inference daemon error: {response['error']}")
+        print(
+            f"inference daemon error: {response['error']}, generating in this process"
+        )
+        return None
+    result = response["result"]
+    # JSON object keys are strings, full_conv is keyed by line number
+    result["full_conv"] = {int(k): v for k, v in result["full_conv"].items()}
+    return result, response["stdout"]
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """RequestHandler - handles one JSON request per connection"""
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            response = self.server.handle_request_dict(request)
+        except Exception as e:
+            logging.exception("inference daemon request failed")
+            response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class InferenceDaemon(socketserver.UnixStreamServer):
+    """
+    InferenceDaemon - a Unix socket server that answers query_gpt_model requests with the models in the registry
+
+    Args:
+        socket_path (str): the path of the Unix socket to listen on
+        verbose (bool, optional): Defaults to False.
+    """
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET, verbose: bool = False):
+        self.socket_path = socket_path
+        self.verbose = verbose
+        self.stats = {"requests": 0, "errors": 0, "busy_s": 0.0}
+        self.started = time.time()
+        if Path(socket_path).exists():
+            if send_request({"cmd": "ping"}, socket_path, timeout=5) is not None:
+                raise RuntimeError(
+                    f"an inference daemon is already running on {socket_path}"
+                )
+            # left over from a daemon that did not shut down cleanly
+            os.remove(socket_path)
+        old_umask = os.umask(0o177)  # the socket is only usable by this user
+        try:
+            super().__init__(socket_path, RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def handle_request_dict(self, request: dict):
+        """handle_request_dict - run one request, returns the response dict"""
+        cmd = request.get("cmd")
+        if cmd == "ping":
+            return {"ok": True, "stats": self.get_stats()}
+        if cmd == "stop":
+            # shutdown() waits for serve_forever to return, so it has to be called from another thread
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return {"ok": True}
+        if cmd != "query":
+            raise ValueError(f"unknown command {cmd}")
+
+        from ai_single_response import query_gpt_model
+
+        st = time.perf_counter()
+        stdout = io.StringIO()
+        try:
+            # requests are handled one at a time, so redirecting stdout only captures this request's printouts
+            with contextlib.redirect_stdout(stdout):
+                result = query_gpt_model(**request["kwargs"])
+        except BaseException as e:
+            self.stats["errors"] += 1
+            if isinstance(e, SystemExit):
+                # load_model_or_exit could not load the model, it printed why
+                raise RuntimeError(
+                    stdout.getvalue().strip() or "model could not be loaded"
+                )
+            raise
+        finally:
+            self.stats["requests"] += 1
+            self.stats["busy_s"] += time.perf_counter() - st
+        if self.verbose:
+            print(
+                f"answered request {self.stats['requests']} in {round(time.perf_counter() - st, 2)} s"
+            )
+        return {"ok": True, "result": result, "stdout": stdout.getvalue()}
+
+    def get_stats(self):
+        """get_stats - request counts, time spent generating and uptime"""
+        return dict(
+            self.stats,
+            busy_s=round(self.stats["busy_s"], 2),
+            uptime_s=round(time.time() - self.started, 1),
+        )
+
+    def server_close(self):
+        super().server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.socket_path)
+
+
+def run_daemon(
+    socket_path: str = DEFAULT_SOCKET,
+    preload: list = None,
+    precision: str = "fp32",
+    use_gpu: bool = False,
+    verbose: bool = False,
+):
+    """
+    run_daemon - load the preload models and serve requests until stopped (inference_daemon.py --stop, SIGTERM or Ctrl+C)
+
+    Args:
+        socket_path (str, optional): the Unix socket to listen on. Defaults to DEFAULT_SOCKET.
+        preload (list, optional): model folders to load before accepting requests. Defaults to None.
+        precision (str, optional): precision of the preloaded models. Defaults to "fp32".
+        use_gpu (bool, optional): load the preloaded models to the GPU. Defaults to False.
+        verbose (bool, optional): Defaults to False.
+    """
+    from model_registry import get_model, print_model_stats
+
+    for folder in preload or []:
+        get_model(folder, use_gpu=use_gpu, precision=precision, verbose=True)
+    print_model_stats()
+
+    server = InferenceDaemon(socket_path, verbose=verbose)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"inference daemon listening on {socket_path}")
+    logging.info(f"inference daemon listening on {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info(f"inference daemon stopped, stats: {server.get_stats()}")
+        print(f"inference daemon stopped, stats: {server.get_stats()}")
+
+
+def model_arg_to_path(model_dir: str):
+    """model_arg_to_path - resolve a --model argument the way the scripts do (relative to the current directory)"""
+    return str(Path.cwd() / model_dir if "/" not in model_dir else Path(model_dir))
+
+
+def get_parser():
+    """
+    get_parser [a helper function for the argparse module]
+
+    Returns: argparse.ArgumentParser
+    """
+    from model_registry import PRECISIONS
+
+    parser = argparse.ArgumentParser(
+        description="keep models loaded and answer ai_single_response.py requests over a Unix socket"
+    )
+    parser.add_argument(
+        "--socket",
+        required=False,
+        type=str,
+        default=DEFAULT_SOCKET,
+        help="path of the Unix socket (default: $AI_MSGBOT_SOCKET or <tmp dir>/ai-msgbot.sock)",
+    )
+    parser.add_argument(
+        "--preload",
+        required=False,
+        nargs="*",
+        default=["distilgpt2-tiny-conversational"],
+        help="model folders to load at startup, others are loaded on their first request",
+    )
+    parser.add_argument(
+        "--precision",
+        required=False,
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="precision of the preloaded models",
+    )
+    parser.add_argument(
+        "--use_gpu",
+        required=False,
+        action="store_true",
+        help="load the preloaded models to the gpu",
+    )
+    parser.add_argument(
+        "--status",
+        default=False,
+        action="store_true",
+        help="print the stats of the running daemon and exit",
+    )
+    parser.add_argument(
+        "--stop",
+        default=False,
+        action="store_true",
+        help="stop the running daemon and exit",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        default=False,
+        action="store_true",
+        help="pass this argument if you want all the printouts",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    if args.status or args.stop:
+        response = send_request(
+            {"cmd": "stop" if args.stop else "ping"}, args.socket, timeout=10
+        )
+        if response is None:
+            print(f"no inference daemon running on {args.socket}")
+            sys.exit(1)
+        print("stopping inference daemon" if args.stop else response["stats"])
+        sys.exit(0)
+
+    run_daemon(
+        socket_path=args.socket,
+        preload=[model_arg_to_path(m) for m in args.preload],
+        precision=args.precision,
+        use_gpu=args.use_gpu,
+        verbose=args.verbose,
+    )
@@ -0,0 +1,220 @@
+"""
+load_shedding.py - graceful degradation of reply quality under load
+
+Every request generates up to resp_length tokens with the full model, however many are waiting, so under a burst the
+queue grows and the tail latency explodes. A LoadShedder watches the number of requests in flight and the recent request
+latency and, under pressure, moves one step at a time down a ladder of cheaper policies:
+
+    level 0  full           as requested
+    level 1  short_replies  resp_length halved (at least min_resp_length), a single candidate
+    level 2  no_grammar     ... and the gramformer correction is skipped (the front end checks skip_gramformer in
+                            the policy the request was admitted under, see AsyncInference.get_policy)
+    level 3  small_model    ... and the reply is generated in-process by the small fallback model
+
+Pressure is the larger of queue_depth / max_queue_depth and p90 latency / target_latency_s. The level goes up when the
+pressure is >= 1 (at most once every step_interval_s) and back down when it has been below recover_pressure for
+recover_s, so quality comes back when the load drops without flapping. Every decision is counted per level and every
+level change is logged, see get_stats.
+
+example:
+    from async_inference import AsyncInference
+    from load_shedding import LoadShedder
+
+    shedder = LoadShedder(max_queue_depth=4, target_latency_s=8, fallback_model="distilgpt2-tiny-conversational")
+    api = AsyncInference("GPT2_trivNatQAdailydia_774M_175Ksteps", load_shedder=shedder)
+    print(shedder.get_stats())
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+DEGRADATION_LEVELS = [
+    dict(
+        name="full",
+        resp_length_factor=1.0,
+        max_candidates=None,
+        skip_gramformer=False,
+        use_fallback_model=False,
+    ),
+    dict(
+        name="short_replies",
+        resp_length_factor=0.5,
+        max_candidates=1,
+        skip_gramformer=False,
+        use_fallback_model=False,
+    ),
+    dict(
+        name="no_grammar",
+        resp_length_factor=0.5,
+        max_candidates=1,
+        skip_gramformer=True,
+        use_fallback_model=False,
+    ),
+    dict(
+        name="small_model",
+        resp_length_factor=0.5,
+        max_candidates=1,
+        skip_gramformer=True,
+        use_fallback_model=True,
+    ),
+]
+
+
+class LoadShedder:
+    """
+    LoadShedder - picks a degradation level from the queue depth and recent latency, with hysteresis. Thread-safe.
+
+    Args:
+        max_queue_depth (int, optional): requests in flight at which the pressure is 1. Defaults to 4.
+        target_latency_s (float, optional): p90 request latency at which the pressure is 1. Defaults to 10.
+        fallback_model (str, optional): the model folder of the last level. Defaults to None (the last level is
+            no_grammar).
+        min_resp_length (int, optional): resp_length is never shrunk below this. Defaults to 16.
+        recover_pressure (float, optional): the level goes down when the pressure stays below this. Defaults to 0.5.
+        step_interval_s (float, optional): min seconds between two level increases. Defaults to 2.
+        recover_s (float, optional): seconds of low pressure before the level goes down one step. Defaults to 10.
+        latency_window_s (float, optional): latencies older than this are ignored. Defaults to 60.
+        verbose (bool, optional): print level changes. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        max_queue_depth: int = 4,
+        target_latency_s: float = 10,
+        fallback_model: str = None,
+        min_resp_length: int = 16,
+        recover_pressure: float = 0.5,
+        step_interval_s: float = 2,
+        recover_s: float = 10,
+        latency_window_s: float = 60,
+        verbose: bool = False,
+    ):
+        self.max_queue_depth = max(int(max_queue_depth), 1)
+        self.target_latency_s = target_latency_s
+        self.fallback_model = None if fallback_model is None else str(fallback_model)
+        self.levels = DEGRADATION_LEVELS[: 4 if self.fallback_model else 3]
+        self.min_resp_length = min_resp_length
+        self.recover_pressure = recover_pressure
+        self.step_interval_s = step_interval_s
+        self.recover_s = recover_s
+        self.latency_window_s = latency_window_s
+        self.verbose = verbose
+        self.level = 0
+        self.pressure = 0.0
+        self._latencies = deque(maxlen=256)  # (time, latency_s)
+        self._last_change = 0.0
+        self._low_since = None  # when the pressure went below recover_pressure
+        self._lock = threading.Lock()
+        self.stats = {"level_ups": 0, "level_downs": 0}
+        self.stats.update({f"requests_{level['name']}": 0 for level in self.levels})
+
+    @property
+    def policy(self):
+        """the policy of the current level (without counting a decision)"""
+        return dict(self.levels[self.level], level=self.level)
+
+    def record_latency(self, latency_s: float):
+        """record_latency - add the latency of a finished (or timed out) request"""
+        with self._lock:
+            self._latencies.append((time.monotonic(), latency_s))
+
+    def get_p90_latency(self):
+        """get_p90_latency - p90 of the latencies in the window, 0 if there are none"""
+        cutoff = time.monotonic() - self.latency_window_s
+        with self._lock:
+            recent = [lat for t, lat in self._latencies if t >= cutoff]
+        return float(np.percentile(recent, 90)) if recent else 0.0
+
+    def get_policy(self, queue_depth: int):
+        """
+        get_policy - update the level for the current load and return its policy, for one request
+
+        Args:
+            queue_depth (int): requests running or waiting (not counting this one)
+
+        Returns:
+            dict: name, level, resp_length_factor, max_candidates, skip_gramformer, use_fallback_model
+        """
+        p90 = self.get_p90_latency()
+        now = time.monotonic()
+        with self._lock:
+            self.pressure = max(
+                queue_depth / self.max_queue_depth, p90 / self.target_latency_s
+            )
+            old_level = self.level
+            if self.pressure >= 1.0:
+                self._low_since = None
+                if (
+                    self.level < len(self.levels) - 1
+                    and now - self._last_change >= self.step_interval_s
+                ):
+                    self.level += 1
+                    self.stats["level_ups"] += 1
+            elif self.pressure < self.recover_pressure and self.level > 0:
+                if self._low_since is None:
+                    self._low_since = now
+                elif now - max(self._low_since, self._last_change) >= self.recover_s:
+                    self.level -= 1
+                    self.stats["level_downs"] += 1
+                    self._low_since = now
+            else:
+                self._low_since = None
+            if self.level != old_level:
+                self._last_change = now
+                msg = (
+                    f"load shedding: {self.levels[old_level]['name']} -> {self.levels[self.level]['name']} "
+                    f"(queue depth {queue_depth}, p90 latency {round(p90, 2)} s)"
+                )
+                logging.info(msg)
+                if self.verbose:
+                    print(msg)
+            policy = self.policy
+            self.stats[f"requests_{policy['name']}"] += 1
+        return policy
+
+    def apply(self, policy: dict, kwargs: dict):
+        """
+        apply - the query_gpt_model / stream_gpt_response arguments of a request, degraded according to policy
+
+        Args:
+            policy (dict): from get_policy
+            kwargs (dict): the request arguments (resp_length, n_candidates, ... if given)
+
+        Returns:
+            dict: a copy of kwargs with resp_length and n_candidates capped, and folder_path set to the fallback model
+                if the policy uses it
+        """
+        kwargs = dict(kwargs)
+        if policy["resp_length_factor"] < 1.0:
+            resp_length = kwargs.get("resp_length", 48)
+            kwargs["resp_length"] = max(
+                int(resp_length * policy["resp_length_factor"]),
+                min(self.min_resp_length, resp_length),
+            )
+        if policy["max_candidates"] is not None and "n_candidates" in kwargs:
+            kwargs["n_candidates"] = min(
+                kwargs["n_candidates"], policy["max_candidates"]
+            )
+        if policy["use_fallback_model"]:
+            kwargs["folder_path"] = self.fallback_model
+        return kwargs
+
+    def get_stats(self):
+        """
+        get_stats - the current level and pressure, p90 latency, level changes, and requests served at each level
+
+        Returns:
+            dict
+        """
+        p90 = self.get_p90_latency()
+        with self._lock:
+            return dict(
+                self.stats,
+                level=self.level,
+                level_name=self.levels[self.level]["name"],
+                pressure=round(self.pressure, 3),
+                p90_latency_s=round(p90, 3),
+            )
@@ -0,0 +1,265 @@
+"""
+model_registry.py - a process-wide registry of loaded aitextgen models
+
+Loading a GPT model from disk takes several seconds (much longer for the 774M and 1.3B models), so it should happen once
+per process and not once per message. Every caller (query_gpt_model, converse_w_ai, the deploy-as-bot scripts) asks the
+registry for a model folder and gets back the same aitextgen instance.
+
+Models can be loaded at a lower precision for CPU inference: "int8" (dynamic int8 quantization of the linear layers) or
+"bf16" (bfloat16 weights and activations, only if the CPU supports it). See benchmark_precision.py for a comparison.
+With backend="onnx" the ONNX Runtime export of the model folder is loaded instead (see export_onnx.py and onnx_backend.py).
+
+example:
+    from model_registry import get_model, print_model_stats
+
+    ai = get_model("distilgpt2-tiny-conversational", precision="int8")
+    print_model_stats()
+"""
+import logging
+import threading
+import time
+import warnings
+from pathlib import Path
+
+warnings.filterwarnings(action="ignore", message=".*gradient_checkpointing*")
+
+# torch and aitextgen are imported inside the functions that need them, so that importing the registry (e.g. for
+# PRECISIONS in a script's argument parser) does not take seconds
+
+PRECISIONS = ["fp32", "int8", "bf16"]
+BACKENDS = ["torch", "onnx"]
+
+_models = {}  # model key -> aitextgen object
+_model_stats = {}  # model key -> dict of load stats
+_registry_lock = threading.Lock()  # guards _key_locks
+_key_locks = {}  # model key -> threading.Lock, so different models can load in parallel
+
+
+def get_rss_mb():
+    """
+    get_rss_mb - the resident set size of the current process in MB. Requires psutil (optional), returns None if it is not installed.
+    """
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return round(psutil.Process().memory_info().rss / 2**20, 1)
+
+
+def get_model_key(
+    folder_path: str or Path,
+    use_gpu: bool = False,
+    precision: str = "fp32",
+    backend: str = "torch",
+):
+    """
+    get_model_key - the registry key for a model folder. Paths that exist are resolved so that "./model" and "model" share an entry.
+
+    Returns:
+        tuple: (model location as a string, use_gpu, precision, backend)
+    """
+    mpath = Path(folder_path)
+    model_id = str(mpath.resolve()) if mpath.exists() else str(folder_path)
+    return (model_id, bool(use_gpu), precision, backend)
+
+
+def cpu_supports_bf16():
+    """
+    cpu_supports_bf16 - True if the CPU has native bfloat16 instructions (AVX512-BF16 or AMX). Only checked on Linux,
+    elsewhere returns False.
+    """
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def conv1d_to_linear(model):
+    """
+    conv1d_to_linear - replace the transformers Conv1D layers of GPT-2 with equivalent torch.nn.Linear layers (in place),
+    so that torch dynamic quantization (which only handles nn.Linear) applies to them. GPT-Neo already uses nn.Linear.
+    """
+    import torch
+
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if type(child).__name__ != "Conv1D":
+                continue
+            n_in, n_out = child.weight.shape  # Conv1D stores the transposed weight
+            linear = torch.nn.Linear(n_in, n_out)
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, child_name, linear)
+    return model
+
+
+def set_precision(ai, precision: str = "fp32"):
+    """
+    set_precision - convert a loaded (CPU) aitextgen model to a lower precision in place
+
+    Args:
+        ai (aitextgen): the loaded model
+        precision (str, optional): one of "fp32", "int8", "bf16". Defaults to "fp32".
+
+    Returns:
+        str: the precision actually used (bf16 falls back to fp32 if the CPU does not support it)
+    """
+    import torch
+
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}, got {precision}")
+    if precision == "int8":
+        conv1d_to_linear(ai.model)
+        ai.model = torch.quantization.quantize_dynamic(
+            ai.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    elif precision == "bf16":
+        if not cpu_supports_bf16():
+            warnings.warn(
+                "this CPU has no native bfloat16 support, loading the model in fp32 instead"
+            )
+            return "fp32"
+        ai.model = ai.model.to(torch.bfloat16)
+    return precision
+
+
+def get_param_mb(model):
+    """get_param_mb - the memory used by the weights of a torch model (including quantized weights), in MB"""
+    import torch
+
+    seen = set()
+    n_bytes = 0
+    tensors = list(model.state_dict().values())
+    while tensors:
+        t = tensors.pop()
+        if isinstance(t, (tuple, list)):
+            tensors.extend(t)  # packed params of quantized layers
+            continue
+        if not isinstance(t, torch.Tensor) or (t.data_ptr(), t.numel()) in seen:
+            continue  # tied weights (e.g. lm_head and wte) are only counted once
+        seen.add((t.data_ptr(), t.numel()))
+        n_bytes += t.numel() * t.element_size()
+    return round(n_bytes / 2**20, 1)
+
+
+def get_model(
+    folder_path: str or Path,
+    use_gpu: bool = False,
+    precision: str = "fp32",
+    verbose: bool = False,
+    backend: str = "torch",
+):
+    """
+    get_model - return the aitextgen object for folder_path, loading it on the first call. Thread-safe: if two threads ask
+    for the same model at the same time, one loads it and the other waits for and then reuses that instance.
+
+    Args:
+        folder_path (str or Path): the path to the model folder
+        use_gpu (bool, optional): load the model to the GPU. Defaults to False.
+        precision (str, optional): "fp32", or for CPU inference "int8" or "bf16" (see set_precision). Defaults to "fp32".
+        verbose (bool, optional): Defaults to False.
+        backend (str, optional): "torch", or "onnx" to load the ONNX Runtime export of the model (CPU, fp32). Defaults to "torch".
+
+    Returns:
+        aitextgen or onnx_backend.OnnxTextGen: the loaded model
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"backend must be one of {BACKENDS}, got {backend}")
+    if backend == "onnx":
+        use_gpu, precision = False, "fp32"
+    precision = "fp32" if use_gpu else precision  # low precision modes are for CPU
+    key = get_model_key(folder_path, use_gpu, precision, backend)
+    ai = _models.get(key)
+    if ai is not None:
+        return ai
+
+    with _registry_lock:
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+
+    with key_lock:
+        ai = _models.get(key)  # another thread may have loaded it while we waited
+        if ai is not None:
+            return ai
+
+        rss_before = get_rss_mb()
+        st = time.perf_counter()
+        if backend == "onnx":
+            from onnx_backend import OnnxTextGen  # onnxruntime is optional
+
+            ai = OnnxTextGen(folder_path)
+            used_precision, param_mb = precision, ai.model.get_file_mb()
+        else:
+            from aitextgen import aitextgen
+
+            ai = aitextgen(
+                model_folder=str(folder_path),
+                to_gpu=use_gpu,
+            )
+            used_precision = set_precision(ai, precision)
+            ai.model.eval()
+            param_mb = get_param_mb(ai.model)
+        load_time = round(time.perf_counter() - st, 2)
+        rss_after = get_rss_mb()
+
+        stats = {
+            "model": key[0],
+            "use_gpu": key[1],
+            "precision": used_precision,
+            "backend": backend,
+            "load_time_s": load_time,
+            "param_mb": param_mb,
+            "rss_delta_mb": round(rss_after - rss_before, 1)
+            if rss_before is not None
+            else None,
+            "rss_mb": rss_after,
+        }
+        _model_stats[key] = stats
+        _models[key] = ai
+        logging.info(f"loaded model into registry: {stats}")
+        if verbose:
+            print(f"loaded {Path(key[0]).name} in {load_time} seconds")
+
+    return ai
+
+
+def is_loaded(
+    folder_path: str or Path, use_gpu: bool = False, precision="fp32", backend="torch"
+):
+    """is_loaded - True if the model for folder_path is already in the registry"""
+    return get_model_key(folder_path, use_gpu, precision, backend) in _models
+
+
+def unload_model(
+    folder_path: str or Path, use_gpu: bool = False, precision="fp32", backend="torch"
+):
+    """
+    unload_model - drop a model from the registry so its memory can be freed (callers holding a reference keep it alive)
+
+    Returns:
+        bool: True if the model was in the registry
+    """
+    key = get_model_key(folder_path, use_gpu, precision, backend)
+    with _registry_lock:
+        _model_stats.pop(key, None)
+        return _models.pop(key, None) is not None
+
+
+def get_model_stats():
+    """
+    get_model_stats - load stats for every model in the registry
+
+    Returns:
+        list: a list of dicts with keys model, use_gpu, precision, backend, load_time_s, param_mb, rss_delta_mb, rss_mb
+    """
+    return [dict(s) for s in _model_stats.values()]
+
+
+def print_model_stats():
+    """print_model_stats - print a one-line summary of each loaded model"""
+    for s in get_model_stats():
+        rss = f", process RSS +{s['rss_delta_mb']} MB" if s["rss_delta_mb"] else ""
+        print(
+            f"{Path(s['model']).name} ({s['backend']}, {s['precision']}): loaded in {s['load_time_s']} s, weights {s['param_mb']} MB{rss}"
+        )
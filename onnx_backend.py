@@ -0,0 +1,211 @@
+"""
+onnx_backend.py - run an exported model (see export_onnx.py) with ONNX Runtime instead of PyTorch
+
+OnnxTextGen mimics the parts of an aitextgen object that the rest of the repo uses (.model, .tokenizer, .get_device()),
+and OnnxGPTModel mimics the parts of a transformers causal LM that are used: calling it with input_ids/past_key_values
+returns logits + the new past_key_values, and .generate() supports the same sampling arguments (top_k, top_p, temperature,
+min_length/max_length, stopping_criteria) that query_gpt_model passes to model.generate. So query_gpt_model, the KV-cache
+ConversationSession and the response post-processing work unchanged with either backend.
+
+Requires onnxruntime (pip install onnxruntime), which is imported only when an ONNX model is loaded.
+"""
+import logging
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from transformers import AutoConfig, AutoTokenizer
+
+from generation_utils import sample_next_token
+
+ONNX_SUBFOLDER = "onnx"  # export_onnx.py saves to <model folder>/onnx by default
+ONNX_FILENAME = "model.onnx"
+
+
+def get_onnx_dir(folder_path: str or Path):
+    """get_onnx_dir - where the ONNX export of a model folder lives (the folder itself if it already has a model.onnx)"""
+    folder_path = Path(folder_path)
+    if (folder_path / ONNX_FILENAME).exists():
+        return folder_path
+    return folder_path / ONNX_SUBFOLDER
+
+
+class OnnxGPTModel:
+    """
+    OnnxGPTModel - an ONNX Runtime session for a GPT model exported with past key values, with the call/generate interface
+    of a transformers causal LM
+
+    Args:
+        onnx_path (str or Path): path to the .onnx file
+        config (transformers.PretrainedConfig): the model config
+        n_threads (int, optional): intra-op threads for ONNX Runtime. Defaults to None (ORT default).
+    """
+
+    def __init__(self, onnx_path: str or Path, config, n_threads: int = None):
+        import onnxruntime as ort
+
+        sess_options = ort.SessionOptions()
+        sess_options.graph_optimization_level = (
+            ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        if n_threads:
+            sess_options.intra_op_num_threads = n_threads
+        self.session = ort.InferenceSession(
+            str(onnx_path), sess_options, providers=["CPUExecutionProvider"]
+        )
+        self.onnx_path = Path(onnx_path)
+        self.config = config
+        self.device = torch.device("cpu")
+        self.n_layers = getattr(config, "n_layer", None) or config.num_layers
+        n_heads = getattr(config, "n_head", None) or config.num_heads
+        self.past_shape = (n_heads, config.hidden_size // n_heads)
+        self.output_names = [o.name for o in self.session.get_outputs()]
+        past_types = [
+            i.type
+            for i in self.session.get_inputs()
+            if i.name.startswith("past_key_values")
+        ]
+        self.past_dtype = (
+            np.float16
+            if past_types and past_types[0] == "tensor(float16)"
+            else np.float32
+        )
+
+    def eval(self):
+        return self
+
+    def get_file_mb(self):
+        """get_file_mb - size of the ONNX model file(s) in MB"""
+        files = [self.onnx_path] + list(self.onnx_path.parent.glob("*.onnx_data"))
+        return round(sum(f.stat().st_size for f in files if f.exists()) / 2**20, 1)
+
+    def __call__(
+        self,
+        input_ids: torch.Tensor,
+        past_key_values: tuple = None,
+        attention_mask: torch.Tensor = None,
+        use_cache: bool = True,
+        **kwargs,
+    ):
+        """
+        run the model on input_ids on top of past_key_values
+
+        Returns:
+            SimpleNamespace: with logits (torch.Tensor) and past_key_values (tuple of (key, value) torch.Tensor per layer)
+        """
+        batch_size, seq_len = input_ids.shape
+        past_len = 0 if past_key_values is None else past_key_values[0][0].shape[2]
+        if attention_mask is None:
+            attention_mask = torch.ones((batch_size, past_len + seq_len))
+        feed = {
+            "input_ids": input_ids.cpu().numpy().astype(np.int64),
+            "attention_mask": attention_mask.cpu().numpy().astype(np.int64),
+        }
+        for i in range(self.n_layers):
+            for j, name in enumerate(["key", "value"]):
+                if past_key_values is None:
+                    past = np.zeros(
+                        (batch_size, self.past_shape[0], 0, self.past_shape[1]),
+                        dtype=self.past_dtype,
+                    )
+                else:
+                    past = np.ascontiguousarray(
+                        past_key_values[i][j].cpu().numpy(), dtype=self.past_dtype
+                    )
+                feed[f"past_key_values.{i}.{name}"] = past
+        outputs = dict(zip(self.output_names, self.session.run(None, feed)))
+        present = tuple(
+            (
+                torch.from_numpy(outputs[f"present.{i}.key"]),
+                torch.from_numpy(outputs[f"present.{i}.value"]),
+            )
+            for i in range(self.n_layers)
+        )
+        return SimpleNamespace(
+            logits=torch.from_numpy(outputs["logits"]).float(),
+            past_key_values=present,
+        )
+
+    def generate(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor = None,
+        max_length: int = 256,
+        min_length: int = 0,
+        top_k: int = 50,
+        top_p: float = 1.0,
+        temperature: float = 1.0,
+        do_sample: bool = True,
+        num_return_sequences: int = 1,
+        pad_token_id: int = None,
+        eos_token_id: int = None,
+        stopping_criteria=None,
+        **kwargs,
+    ):
+        """
+        generate - sample a continuation of input_ids, with the same arguments and return value as model.generate
+
+        The exported graph has no position_ids input, so left-padded batches are not supported (rows must have the same
+        prompt length, e.g. one prompt with num_return_sequences > 1).
+
+        Returns:
+            torch.Tensor: the prompt + generated token ids, shape (batch * num_return_sequences, <= max_length)
+        """
+        if attention_mask is not None and (attention_mask == 0).any():
+            raise ValueError(
+                "the ONNX backend does not support padded batches, generate one prompt at a time"
+            )
+        eos_token_id = (
+            eos_token_id if eos_token_id is not None else self.config.eos_token_id
+        )
+        pad_token_id = pad_token_id if pad_token_id is not None else eos_token_id
+        sequences = input_ids.cpu().repeat_interleave(num_return_sequences, dim=0)
+        finished = torch.zeros(sequences.shape[0], dtype=torch.bool)
+
+        out = self(sequences)
+        while sequences.shape[1] < max_length:
+            logits = out.logits[:, -1]
+            if min_length and sequences.shape[1] < min_length:
+                logits[:, eos_token_id] = -float("inf")
+            if do_sample:
+                next_tokens = sample_next_token(
+                    logits, top_k=top_k, top_p=top_p, temperature=temperature
+                )
+            else:
+                next_tokens = logits.argmax(dim=-1)
+            next_tokens = next_tokens.masked_fill(finished, pad_token_id)
+            sequences = torch.cat([sequences, next_tokens.unsqueeze(-1)], dim=1)
+            finished |= next_tokens == eos_token_id
+            if finished.all():
+                break
+            if stopping_criteria is not None and stopping_criteria(sequences, None):
+                break
+            out = self(next_tokens.unsqueeze(-1), past_key_values=out.past_key_values)
+        return sequences
+
+
+class OnnxTextGen:
+    """
+    OnnxTextGen - an exported model + its tokenizer, usable wherever the repo expects an aitextgen object
+
+    Args:
+        folder_path (str or Path): the model folder (its onnx/ subfolder is used) or the ONNX export folder itself
+        n_threads (int, optional): intra-op threads for ONNX Runtime. Defaults to None.
+    """
+
+    def __init__(self, folder_path: str or Path, n_threads: int = None):
+        onnx_dir = get_onnx_dir(folder_path)
+        onnx_path = onnx_dir / ONNX_FILENAME
+        if not onnx_path.exists():
+            raise FileNotFoundError(
+                f"no ONNX export found at {onnx_path}, run export_onnx.py --model {folder_path} first"
+            )
+        config = AutoConfig.from_pretrained(onnx_dir)
+        self.tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+        self.tokenizer.padding_side = "left"
+        self.model = OnnxGPTModel(onnx_path, config, n_threads=n_threads)
+        logging.info(f"loaded ONNX model from {onnx_path}")
+
+    def get_device(self):
+        return "cpu"
@@ -0,0 +1,184 @@
+"""
+response_cache.py - an in-memory cache of bot responses for repeated prompts
+
+Bots get the same openers ("hi", "how are you", "what's up") over and over, and each one costs a full generation. A
+ResponseCache keeps a small pool of sampled replies per (model, normalized prompt, history, speaker/responder, sampling
+params) key: the first pool_size requests for a key generate as usual and add their reply to the pool, after that a request
+is answered with a random reply from the pool without touching the model, so answers still vary.
+
+Entries are evicted least recently used first when the cache has more than max_entries keys or uses more than max_mb of
+memory, and expire ttl_s seconds after they were created.
+
+example:
+    from ai_single_response import query_gpt_model
+    from response_cache import ResponseCache
+
+    cache = ResponseCache(pool_size=3)
+    resp = query_gpt_model("distilgpt2-tiny-conversational", "hi", response_cache=cache)
+    print(cache.get_stats())
+"""
+import hashlib
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+ENTRY_OVERHEAD_BYTES = 256  # rough size of an entry's dict, list and key tuple
+
+
+def normalize_prompt(prompt_msg: str):
+    """normalize_prompt - lowercase, collapse whitespace and strip surrounding punctuation, so "Hi!" and "hi" share a key"""
+    prompt_msg = re.sub(r"\s+", " ", str(prompt_msg).lower())
+    return prompt_msg.strip(" ?!.,;:")
+
+
+def hash_history(conversation_history: list = None):
+    """
+    hash_history - a short hash of the conversation history lines. The trimmed history in the prompt is computed
+    deterministically from these lines (for a given model and resp_length), so equal hashes mean equal prompts.
+    """
+    if not conversation_history:
+        return ""
+    history = "".join(str(line) for line in conversation_history)
+    return hashlib.sha1(history.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    ResponseCache - LRU + TTL cache of reply pools, with a memory cap and hit/miss counters. Thread-safe.
+
+    Args:
+        pool_size (int, optional): replies generated per key before the cache starts answering. Defaults to 3.
+        max_entries (int, optional): max number of keys. Defaults to 4096.
+        max_mb (float, optional): memory cap for the cached replies in MB. Defaults to 32.
+        ttl_s (float, optional): seconds after which an entry expires. Defaults to 3600.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 3,
+        max_entries: int = 4096,
+        max_mb: float = 32,
+        ttl_s: float = 3600,
+    ):
+        self.pool_size = max(int(pool_size), 1)
+        self.max_entries = max_entries
+        self.max_bytes = int(max_mb * 2**20)
+        self.ttl_s = ttl_s
+        # key -> {"replies", "created", "size"}, least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.n_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    @staticmethod
+    def make_key(
+        model_id: str,
+        prompt_msg: str,
+        conversation_history: list = None,
+        speaker: str = None,
+        responder: str = None,
+        kparam: int = None,
+        top_p: float = None,
+        temp: float = None,
+        resp_length: int = None,
+    ):
+        """
+        make_key - the cache key for a request
+
+        Args:
+            model_id (str): the model, e.g. model_registry.get_model_key(...) as a string
+            prompt_msg (str): the prompt message (normalized with normalize_prompt)
+            conversation_history (list, optional): the history lines passed to the query (hashed). Defaults to None.
+            speaker, responder, kparam, top_p, temp, resp_length (optional): the other query arguments
+
+        Returns:
+            tuple: the key
+        """
+        return (
+            str(model_id),
+            normalize_prompt(prompt_msg),
+            hash_history(conversation_history),
+            speaker,
+            responder,
+            kparam,
+            top_p,
+            temp,
+            resp_length,
+        )
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.n_bytes -= entry["size"]
+
+    def get(self, key):
+        """
+        get - a random reply from the pool for key, if the pool is full
+
+        Returns:
+            str or None: a cached reply, or None on a miss (then generate and put the reply)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry["created"] > self.ttl_s:
+                self._drop(key)
+                self.stats["expirations"] += 1
+                entry = None
+            if entry is None or len(entry["replies"]) < self.pool_size:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return random.choice(entry["replies"])
+
+    def put(self, key, reply: str):
+        """put - add a generated reply to the pool for key (empty replies are not cached)"""
+        if not reply or not reply.strip():
+            return
+        reply_bytes = len(reply.encode("utf-8"))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {
+                    "replies": [],
+                    "created": time.time(),
+                    "size": ENTRY_OVERHEAD_BYTES + len(repr(key)),
+                }
+                self._entries[key] = entry
+                self.n_bytes += entry["size"]
+            if len(entry["replies"]) < self.pool_size:
+                entry["replies"].append(reply)
+                entry["size"] += reply_bytes
+                self.n_bytes += reply_bytes
+            self._entries.move_to_end(key)
+            while self._entries and (
+                len(self._entries) > self.max_entries or self.n_bytes > self.max_bytes
+            ):
+                self._drop(next(iter(self._entries)))  # least recently used
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        """clear - drop all entries (the counters are kept)"""
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        """
+        get_stats - hit/miss/eviction counters, hit rate, number of entries and memory used
+
+        Returns:
+            dict
+        """
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(
+                self.stats,
+                hit_rate=round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+                entries=len(self._entries),
+                mb=round(self.n_bytes / 2**20, 3),
+            )
@@ -0,0 +1,194 @@
+"""
+semantic_cache.py - a near-duplicate prompt cache for single-turn bot requests
+
+The exact-match ResponseCache (response_cache.py) only helps if a prompt is repeated word for word. A SemanticCache also
+answers paraphrases ("hey whats up" / "hey, what's up?"): prompts are embedded as hashed character n-gram TF-IDF vectors,
+and a request is answered from the pool of its nearest stored prompt if their cosine similarity is above a threshold.
+
+Vectors are kept in a fixed-size numpy matrix (capacity x n_features, 16 MB with the defaults), so a lookup is two
+matrix-vector products. IDF weights come from the stored prompts and are applied at lookup time, so they stay current as
+the index changes. When the index is full the least recently used prompt is replaced.
+
+example:
+    from semantic_cache import SemanticCache
+
+    cache = SemanticCache(threshold=0.8)
+    cache.put("hey, what's up?", namespace="model-a", reply="not much, you?")
+    cache.get("hey whats up", namespace="model-a")  # -> "not much, you?" (with pool_size=1)
+"""
+import random
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+
+
+def get_char_ngrams(text: str, ngram_range: tuple = (2, 4)):
+    """
+    get_char_ngrams - the character n-grams of a normalized prompt (lowercase, letters/digits/spaces only, padded with
+    spaces so word starts and ends are n-grams too)
+    """
+    text = re.sub(r"[^a-z0-9 ]+", "", str(text).lower())
+    text = " " + re.sub(r"\s+", " ", text).strip() + " "
+    return [
+        text[i : i + n]
+        for n in range(ngram_range[0], ngram_range[1] + 1)
+        for i in range(len(text) - n + 1)
+    ]
+
+
+def hash_ngram_counts(text: str, n_features: int = 2**11, ngram_range=(2, 4)):
+    """
+    hash_ngram_counts - term frequencies of the character n-grams of text, hashed into n_features buckets
+
+    Returns:
+        np.ndarray: float32 vector of shape (n_features,)
+    """
+    vec = np.zeros(n_features, dtype=np.float32)
+    for gram in get_char_ngrams(text, ngram_range):
+        vec[zlib.crc32(gram.encode("utf-8")) % n_features] += 1
+    return vec
+
+
+class SemanticCache:
+    """
+    SemanticCache - approximate prompt -> reply pool cache with a similarity threshold and LRU eviction. Thread-safe.
+
+    Args:
+        threshold (float, optional): min cosine similarity for a hit. Defaults to 0.8.
+        capacity (int, optional): max number of stored prompts. Defaults to 1024.
+        pool_size (int, optional): replies generated per stored prompt before it starts answering. Defaults to 3.
+        n_features (int, optional): hash buckets for the n-grams. Defaults to 2048.
+        ngram_range (tuple, optional): min and max n-gram length. Defaults to (2, 4).
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.8,
+        capacity: int = 1024,
+        pool_size: int = 3,
+        n_features: int = 2**11,
+        ngram_range: tuple = (2, 4),
+    ):
+        self.threshold = threshold
+        self.capacity = capacity
+        self.pool_size = max(int(pool_size), 1)
+        self.n_features = n_features
+        self.ngram_range = ngram_range
+        self._tf = np.zeros((capacity, n_features), dtype=np.float32)
+        self._tf_sq = np.zeros((capacity, n_features), dtype=np.float32)
+        self._df = np.zeros(n_features, dtype=np.float32)  # stored prompts per bucket
+        self._last_used = np.full(capacity, -np.inf)  # -inf = empty slot
+        self._slots = [None] * capacity  # slot -> {"prompt", "namespace", "replies"}
+        self.n_stored = 0
+        self._lock = threading.Lock()
+        self.stats = {"lookups": 0, "hits": 0, "evictions": 0, "lookup_ms_total": 0.0}
+        self.last_lookup_ms = 0.0
+
+    def __len__(self):
+        return self.n_stored
+
+    def _embed(self, prompt_msg: str):
+        return hash_ngram_counts(prompt_msg, self.n_features, self.ngram_range)
+
+    def _nearest(self, tf: np.ndarray, namespace):
+        """the slot most similar to tf in namespace and its cosine similarity, or (None, 0.0)"""
+        if self.n_stored == 0 or not tf.any():
+            return None, 0.0
+        idf_sq = (np.log((1 + self.n_stored) / (1 + self._df)) + 1) ** 2
+        dots = self._tf @ (tf * idf_sq)
+        norms = np.sqrt(self._tf_sq @ idf_sq) * np.sqrt((tf**2) @ idf_sq)
+        sims = np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+        in_namespace = np.array(
+            [
+                slot is not None and slot["namespace"] == namespace
+                for slot in self._slots
+            ]
+        )
+        sims[~in_namespace] = 0.0
+        slot = int(np.argmax(sims))
+        return (slot, float(sims[slot])) if sims[slot] > 0 else (None, 0.0)
+
+    def get(self, prompt_msg: str, namespace=None):
+        """
+        get - a random reply from the pool of the most similar stored prompt, if it is similar enough and its pool is full
+
+        Args:
+            prompt_msg (str): the prompt
+            namespace (optional): only prompts stored with the same namespace (model, speaker, sampling params) match
+
+        Returns:
+            str or None: a cached reply, or None on a miss
+        """
+        st = time.perf_counter()
+        tf = self._embed(prompt_msg)
+        with self._lock:
+            slot, sim = self._nearest(tf, namespace)
+            reply = None
+            if slot is not None and sim >= self.threshold:
+                entry = self._slots[slot]
+                if len(entry["replies"]) >= self.pool_size:
+                    reply = random.choice(entry["replies"])
+                    self._last_used[slot] = time.time()
+            self.last_lookup_ms = (time.perf_counter() - st) * 1000
+            self.stats["lookups"] += 1
+            self.stats["hits"] += reply is not None
+            self.stats["lookup_ms_total"] += self.last_lookup_ms
+        return reply
+
+    def put(self, prompt_msg: str, namespace=None, reply: str = ""):
+        """
+        put - add a generated reply: to the pool of the most similar stored prompt if it is above the threshold, else as a
+        new prompt (replacing the least recently used one if the index is full). Empty replies are not cached.
+        """
+        if not reply or not reply.strip():
+            return
+        tf = self._embed(prompt_msg)
+        if not tf.any():
+            return
+        with self._lock:
+            slot, sim = self._nearest(tf, namespace)
+            if slot is not None and sim >= self.threshold:
+                replies = self._slots[slot]["replies"]
+                if len(replies) < self.pool_size:
+                    replies.append(reply)
+                self._last_used[slot] = time.time()
+                return
+            slot = int(np.argmin(self._last_used))
+            if self._slots[slot] is not None:
+                self._df -= self._tf[slot] > 0
+                self.stats["evictions"] += 1
+            else:
+                self.n_stored += 1
+            self._tf[slot] = tf
+            self._tf_sq[slot] = tf**2
+            self._df += tf > 0
+            self._last_used[slot] = time.time()
+            self._slots[slot] = {
+                "prompt": prompt_msg,
+                "namespace": namespace,
+                "replies": [reply],
+            }
+
+    def get_stats(self):
+        """
+        get_stats - lookups, hits, hit rate, evictions, mean and last lookup latency, stored prompts
+
+        Returns:
+            dict
+        """
+        with self._lock:
+            lookups = self.stats["lookups"]
+            return {
+                "lookups": lookups,
+                "hits": self.stats["hits"],
+                "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+                "evictions": self.stats["evictions"],
+                "mean_lookup_ms": round(self.stats["lookup_ms_total"] / lookups, 3)
+                if lookups
+                else 0.0,
+                "last_lookup_ms": round(self.last_lookup_ms, 3),
+                "entries": len(self),
+            }
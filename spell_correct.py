@@ -0,0 +1,188 @@
+"""
+spell_correct.py - a shared SymSpell spelling corrector, loaded once per process
+
+Building a SymSpell index from symspell_rsc/frequency_dictionary_en_82_765.txt (82k words, plus the delete index for
+edit distance 2) takes seconds, and it used to happen on every utils.correct_phrase_load call and separately in each
+bot. get_corrector() returns one SpellCorrector per process that:
+
+- loads on first use (thread-safe), from a pickle snapshot of the precomputed index next to the dictionary if there is
+  one that is newer than the dictionary, else from the text file, and then writes the snapshot for the next start
+- uses the bigram dictionary if it exists (it is not shipped with the repo), else compound lookups run on unigrams only
+- memoizes corrections per phrase in an LRU cache: bot replies and cached responses repeat a lot
+
+example:
+    from spell_correct import get_corrector
+
+    get_corrector().correct("whereis th elove hehad dated forImuch of thepast")
+"""
+import logging
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+
+from utils import clean
+
+SYMSPELL_DIR = Path(__file__).resolve().parent / "symspell_rsc"
+DICTIONARY_PATH = SYMSPELL_DIR / "frequency_dictionary_en_82_765.txt"
+BIGRAM_PATH = SYMSPELL_DIR / "frequency_bigramdictionary_en_243_342.txt"
+
+
+class SpellCorrector:
+    """
+    SpellCorrector - SymSpell compound correction with a lazily loaded, snapshotted index and an LRU cache
+
+    Args:
+        dictionary_path (str or Path, optional): the unigram frequency dictionary. Defaults to DICTIONARY_PATH.
+        bigram_path (str or Path, optional): the bigram frequency dictionary, skipped if it does not exist. Defaults to
+            BIGRAM_PATH.
+        max_edit_distance (int, optional): max edit distance per word. Defaults to 2.
+        prefix_length (int, optional): SymSpell prefix length. Defaults to 7.
+        cache_size (int, optional): corrections memoized. Defaults to 4096.
+        snapshot (bool, optional): load / save the index as a pickle next to the dictionary. Defaults to True.
+        verbose (bool, optional): Defaults to False.
+    """
+
+    def __init__(
+        self,
+        dictionary_path: str or Path = DICTIONARY_PATH,
+        bigram_path: str or Path = BIGRAM_PATH,
+        max_edit_distance: int = 2,
+        prefix_length: int = 7,
+        cache_size: int = 4096,
+        snapshot: bool = True,
+        verbose: bool = False,
+    ):
+        self.dictionary_path = Path(dictionary_path)
+        self.bigram_path = Path(bigram_path)
+        self.max_edit_distance = max_edit_distance
+        self.prefix_length = prefix_length
+        self.snapshot_path = (
+            self.dictionary_path.with_name(
+                f"{self.dictionary_path.stem}_d{max_edit_distance}_p{prefix_length}.pickle"
+            )
+            if snapshot
+            else None
+        )
+        self.verbose = verbose
+        self.has_bigrams = False
+        self.load_s = None
+        self._sym_spell = None
+        self._lock = threading.Lock()
+        self.correct = lru_cache(maxsize=cache_size)(self._correct)
+
+    def _snapshot_is_current(self):
+        return (
+            self.snapshot_path is not None
+            and self.snapshot_path.exists()
+            and self.snapshot_path.stat().st_mtime
+            >= self.dictionary_path.stat().st_mtime
+            and (
+                not self.bigram_path.exists()
+                or self.snapshot_path.stat().st_mtime
+                >= self.bigram_path.stat().st_mtime
+            )
+        )
+
+    def load(self):
+        """
+        load - build or load the SymSpell index if it is not loaded yet (called by correct on first use)
+
+        Returns:
+            symspellpy.SymSpell: the loaded instance
+        """
+        with self._lock:
+            if self._sym_spell is not None:
+                return self._sym_spell
+            from symspellpy import SymSpell
+
+            st = time.perf_counter()
+            sym_spell = SymSpell(
+                max_dictionary_edit_distance=self.max_edit_distance,
+                prefix_length=self.prefix_length,
+            )
+            loaded = False
+            if self._snapshot_is_current():
+                try:
+                    loaded = sym_spell.load_pickle(
+                        str(self.snapshot_path), compressed=False
+                    )
+                except Exception as e:
+                    logging.warning(f"could not load {self.snapshot_path}: {e}")
+            if not loaded:
+                sym_spell = SymSpell(
+                    max_dictionary_edit_distance=self.max_edit_distance,
+                    prefix_length=self.prefix_length,
+                )
+                # term_index is the column of the term and count_index is the column of the term frequency
+                sym_spell.load_dictionary(
+                    str(self.dictionary_path), term_index=0, count_index=1
+                )
+            has_bigram_file = self.bigram_path.exists()
+            parsed_bigrams = False
+            if has_bigram_file and not sym_spell.bigrams:
+                # built from the dictionary, or a snapshot saved before the bigram file was there
+                sym_spell.load_bigram_dictionary(
+                    str(self.bigram_path), term_index=0, count_index=2
+                )
+                parsed_bigrams = True
+            elif not has_bigram_file:
+                logging.info(
+                    f"no bigram dictionary at {self.bigram_path}, compound correction uses unigrams only"
+                )
+            if self.snapshot_path is not None and (not loaded or parsed_bigrams):
+                # saved after the bigrams are loaded, so the next start does not parse the bigram file again
+                try:
+                    sym_spell.save_pickle(str(self.snapshot_path), compressed=False)
+                except OSError as e:
+                    logging.warning(f"could not save {self.snapshot_path}: {e}")
+            self.has_bigrams = bool(sym_spell.bigrams)
+            self.load_s = round(time.perf_counter() - st, 3)
+            msg = f"spell corrector loaded in {self.load_s} s ({'snapshot' if loaded else 'dictionary'}, bigrams: {self.has_bigrams})"
+            logging.info(msg)
+            if self.verbose:
+                print(msg)
+            self._sym_spell = sym_spell
+            return sym_spell
+
+    def _correct(self, phrase: str):
+        """correct a phrase (memoized as correct)"""
+        suggestions = self.load().lookup_compound(
+            clean(phrase),
+            max_edit_distance=self.max_edit_distance,
+            ignore_non_words=True,
+        )
+        if len(suggestions) < 1:
+            return phrase
+        return suggestions[0].term
+
+    def get_stats(self):
+        """get_stats - load time, whether bigrams are used, and the hits/misses of the correction cache"""
+        info = self.correct.cache_info()
+        return {
+            "loaded": self._sym_spell is not None,
+            "load_s": self.load_s,
+            "bigrams": self.has_bigrams,
+            "cache_hits": info.hits,
+            "cache_misses": info.misses,
+            "cache_size": info.currsize,
+        }
+
+
+_corrector = None
+_corrector_lock = threading.Lock()
+
+
+def get_corrector(**kwargs):
+    """
+    get_corrector - the process-wide SpellCorrector (created on the first call, with kwargs; the index itself is loaded
+    on the first correction, or with get_corrector().load())
+
+    Returns:
+        SpellCorrector
+    """
+    global _corrector
+    with _corrector_lock:
+        if _corrector is None:
+            _corrector = SpellCorrector(**kwargs)
+        return _corrector
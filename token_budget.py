@@ -0,0 +1,129 @@
+"""
+token_budget.py - tokenizer-aware budgeting of prompts and conversation history
+
+The models have a fixed context window (1024 tokens for GPT-2), and the prompt + the generated response must fit in it.
+Budgets here are counted in tokens with the model's own tokenizer, not in characters, so history can be trimmed to exactly
+what fits and generation can be capped at exactly resp_length new tokens.
+
+History is handled as a list of lines in the same "script" format used everywhere else in the repo:
+
+    person alpha:
+    hi, how are you?
+
+    person beta:
+    good thanks
+
+and trimming always drops whole turns (name line + text lines + blank separator), oldest first.
+"""
+import logging
+
+DEFAULT_CONTEXT_WINDOW = 1024  # GPT-2 / GPT-Neo
+
+
+def get_context_window(model):
+    """
+    get_context_window - the maximum number of tokens (prompt + response) a model can attend to
+
+    Args:
+        model (transformers.PreTrainedModel): the model, i.e. aitextgen.model
+
+    Returns:
+        int: the context window in tokens
+    """
+    config = model.config
+    for attr in ["n_positions", "max_position_embeddings", "n_ctx"]:
+        window = getattr(config, attr, None)
+        if window:
+            return int(window)
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def count_tokens(tokenizer, text: str):
+    """count_tokens - the number of tokens in text for a given tokenizer"""
+    if not text:
+        return 0
+    return len(tokenizer(text)["input_ids"])
+
+
+def split_turns(lines: list):
+    """
+    split_turns - group a list of script lines into turns. A turn is a name line ("speaker:"), its text lines, and the
+    blank separator line that follows them (if any).
+
+    Args:
+        lines (list): list of strings, one line each
+
+    Returns:
+        list: a list of turns, each a list of lines
+    """
+    turns = []
+    current = []
+    has_text = False
+    for line in lines:
+        stripped = str(line).strip()
+        if stripped.endswith(":") and has_text:
+            # a new name line without a blank separator before it
+            turns.append(current)
+            current, has_text = [], False
+        current.append(line)
+        if not stripped:
+            turns.append(current)
+            current, has_text = [], False
+        elif not stripped.endswith(":"):
+            has_text = True
+    if current:
+        turns.append(current)
+    return turns
+
+
+def trim_history_to_tokens(history: list, tokenizer, max_tokens: int, verbose=False):
+    """
+    trim_history_to_tokens - keep the most recent whole turns of history that fit in max_tokens
+
+    Args:
+        history (list): the conversation history as a list of lines
+        tokenizer: the tokenizer of the model the history will be passed to
+        max_tokens (int): the token budget for the history
+        verbose (bool, optional): Defaults to False.
+
+    Returns:
+        list: the trimmed history as a list of lines (a new list, history is not modified)
+    """
+    if not history or max_tokens <= 0:
+        return []
+    kept = []
+    total_tokens = 0
+    for turn in reversed(split_turns(history)):
+        n_tokens = count_tokens(tokenizer, "".join(str(line) for line in turn))
+        if total_tokens + n_tokens > max_tokens:
+            logging.info(
+                f"history turn with {n_tokens} tokens puts total over {max_tokens}, dropping it and older turns"
+            )
+            break
+        total_tokens += n_tokens
+        kept.append(turn)
+    trimmed = [line for turn in reversed(kept) for line in turn]
+    if verbose:
+        print(f"kept {len(kept)} turns of history, {total_tokens} tokens")
+    return trimmed
+
+
+def get_history_budget(
+    context_window: int, resp_length: int, new_turn_tokens: int, max_history: int = None
+):
+    """
+    get_history_budget - how many tokens of history fit alongside the new turn and the response
+
+    Args:
+        context_window (int): the model's context window in tokens
+        resp_length (int): the number of tokens reserved for the response
+        new_turn_tokens (int): the number of tokens in the new prompt turn (speaker, message and responder tag)
+        max_history (int, optional): an additional cap on the history tokens. Defaults to None.
+
+    Returns:
+        int: the history budget in tokens (may be 0)
+    """
+    budget = context_window - resp_length - new_turn_tokens
+    if max_history is not None:
+        budget = min(budget, max_history)
+    return max(budget, 0)
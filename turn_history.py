@@ -0,0 +1,218 @@
+"""
+turn_history.py - a compact, bounded conversation history with cached token ids
+
+Conversation history is otherwise passed around as a list of script lines ("speaker:\\n", "text\\n", "\\n"), which is
+re-joined, re-split into turns and re-tokenized every turn to fit it into the context window. A TurnHistory keeps one
+record per turn (speaker id, text, token ids) in a ring buffer of max_turns turns:
+
+- append is O(1) plus tokenizing the new turn, once
+- last_turns(max_tokens) walks back from the newest turn and stops at the budget, so it is O(k) in the turns kept
+- the running token total is updated as turns are appended and evicted
+
+query_gpt_model accepts a TurnHistory as conversation_history: the prompt is assembled from the cached token ids of the
+kept turns, and the new message and the reply are appended to the history (a cancelled reply is not). Iterating over a
+TurnHistory yields its script lines, so it also works where a list of lines is expected (the response cache key, the
+full_conv dict).
+
+With compact_at, turns age out as soon as the history has more than compact_at tokens, and the most salient sentences of
+the aged-out turns are kept as a summary of at most summary_tokens tokens in front of the prompt (see compaction.py).
+
+example:
+    from ai_single_response import query_gpt_model
+    from model_registry import get_model
+    from turn_history import TurnHistory
+
+    history = TurnHistory(get_model("distilgpt2-tiny-conversational").tokenizer, max_tokens=512)
+    query_gpt_model("distilgpt2-tiny-conversational", "hey, what's up?", conversation_history=history)
+    query_gpt_model("distilgpt2-tiny-conversational", "what are you up to today?", conversation_history=history)
+    len(history), history.n_tokens  # 4 turns
+"""
+from collections import deque, namedtuple
+
+from compaction import TurnCompactor
+from token_budget import split_turns
+
+Turn = namedtuple("Turn", ["speaker_id", "text", "token_ids"])
+
+
+def format_turn(speaker: str, text: str):
+    """format_turn - the script lines of one turn: name tag, text and blank separator"""
+    return [speaker.lower() + ":" + "\n", text + "\n", "\n"]
+
+
+class TurnHistory:
+    """
+    TurnHistory - a ring buffer of conversation turns with their token ids
+
+    Args:
+        tokenizer: the tokenizer of the model the history is used with
+        max_turns (int, optional): turns kept, the oldest is dropped when a new one is appended. Defaults to 256.
+        max_tokens (int, optional): an additional cap on the history tokens in a prompt. Defaults to None (only the
+            model's context window).
+        compact_at (int, optional): tokens of history above which the oldest turns are compacted into the summary.
+            Defaults to None (no compaction, old turns are dropped).
+        summary_tokens (int, optional): the token allowance of the summary of compacted turns. Defaults to 96.
+        on_append (callable, optional): called with (seq, speaker, text) for every appended turn, before any turn is
+            dropped or compacted (seq counts the turns ever appended). Defaults to None.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        max_turns: int = 256,
+        max_tokens: int = None,
+        compact_at: int = None,
+        summary_tokens: int = 96,
+        on_append=None,
+    ):
+        self.tokenizer = tokenizer
+        self.on_append = on_append
+        self.max_tokens = max_tokens
+        self.compact_at = compact_at
+        self.compactor = (
+            TurnCompactor(self.tokenize_turn, summary_tokens)
+            if compact_at is not None
+            else None
+        )
+        self.turns = deque(maxlen=max_turns)
+        self.speakers = []  # speaker id -> name
+        self._speaker_ids = {}
+        self.n_tokens = 0  # tokens of all turns in the buffer
+        self.n_appended = 0  # turns ever appended, including the dropped ones
+
+    @classmethod
+    def from_lines(cls, lines: list, tokenizer, **kwargs):
+        """
+        from_lines - build a TurnHistory from a conversation as a list of script lines (e.g. full_conv.values())
+
+        Returns:
+            TurnHistory
+        """
+        history = cls(tokenizer, **kwargs)
+        for turn in split_turns(lines):
+            speaker = str(turn[0]).strip()
+            if not speaker.endswith(":"):
+                continue  # not a turn (text without a name tag)
+            text = "\n".join(
+                str(line).strip() for line in turn[1:] if str(line).strip()
+            )
+            history.append(speaker[:-1], text)
+        return history
+
+    def __len__(self):
+        return len(self.turns)
+
+    def __iter__(self):
+        """the history as script lines, oldest first (the summary of compacted turns first)"""
+        for sentence in self.get_summary():
+            yield from format_turn(sentence.speaker, sentence.text)
+        for turn in self.turns:
+            yield from format_turn(self.get_speaker(turn), turn.text)
+
+    def get_speaker_id(self, speaker: str):
+        """get_speaker_id - the id of a speaker name (names are stored once)"""
+        speaker = speaker.lower()
+        if speaker not in self._speaker_ids:
+            self._speaker_ids[speaker] = len(self.speakers)
+            self.speakers.append(speaker)
+        return self._speaker_ids[speaker]
+
+    def append(self, speaker: str, text: str):
+        """
+        append - add a turn, and drop the oldest one if the buffer is full
+
+        Args:
+            speaker (str): the name of who said it
+            text (str): what was said (in the form it should have in the prompt)
+        """
+        token_ids = self.tokenize_turn(speaker, text)
+        if self.on_append is not None:
+            self.on_append(self.n_appended, speaker.lower(), text)
+        if len(self.turns) == self.turns.maxlen:
+            self._age_out()
+        self.turns.append(Turn(self.get_speaker_id(speaker), text, token_ids))
+        self.n_tokens += len(token_ids)
+        self.n_appended += 1
+        if self.compactor is not None:
+            self.compactor.observe(text)
+            while self.n_tokens > self.compact_at and len(self.turns) > 1:
+                self._age_out()
+
+    def tokenize_turn(self, speaker: str, text: str):
+        """tokenize_turn - the token ids of a turn as it appears in the prompt"""
+        return self.tokenizer("".join(format_turn(speaker, text)))["input_ids"]
+
+    def _age_out(self):
+        """drop the oldest turn, into the summary if there is one"""
+        turn = self.turns.popleft()
+        self.n_tokens -= len(turn.token_ids)
+        if self.compactor is not None:
+            self.compactor.add_turn(self.get_speaker(turn), turn.text)
+
+    def get_summary(self):
+        """get_summary - the sentences kept from compacted turns, oldest first (empty without compaction)"""
+        return [] if self.compactor is None else self.compactor.summary
+
+    def last_turns(self, max_tokens: int = None):
+        """
+        last_turns - the most recent whole turns that fit in max_tokens (and the max_tokens of the history)
+
+        Returns:
+            list: the kept turns, oldest first
+        """
+        if self.max_tokens is not None:
+            max_tokens = (
+                self.max_tokens
+                if max_tokens is None
+                else min(max_tokens, self.max_tokens)
+            )
+        if max_tokens is None or max_tokens >= self.n_tokens:
+            return list(self.turns)
+        kept = []
+        total_tokens = 0
+        for turn in reversed(self.turns):
+            if total_tokens + len(turn.token_ids) > max_tokens:
+                break
+            total_tokens += len(turn.token_ids)
+            kept.append(turn)
+        return kept[::-1]
+
+    def get_window(self, max_tokens: int = None):
+        """
+        get_window - the prompt of the most recent turns that fit in max_tokens, from the cached token ids. The summary
+        of compacted turns comes first, if it fits in half of max_tokens.
+
+        Returns:
+            tuple: (lines, token_ids) - the script lines and the token ids of the summary and the kept turns
+        """
+        if self.max_tokens is not None:
+            max_tokens = (
+                self.max_tokens
+                if max_tokens is None
+                else min(max_tokens, self.max_tokens)
+            )
+        lines, token_ids = [], []
+        summary = self.get_summary()
+        if summary and (
+            max_tokens is None or 2 * self.compactor.n_tokens <= max_tokens
+        ):
+            for sentence in summary:
+                lines.extend(format_turn(sentence.speaker, sentence.text))
+                token_ids.extend(sentence.token_ids)
+            if max_tokens is not None:
+                max_tokens -= self.compactor.n_tokens
+        for turn in self.last_turns(max_tokens):
+            lines.extend(format_turn(self.get_speaker(turn), turn.text))
+            token_ids.extend(turn.token_ids)
+        return lines, token_ids
+
+    def get_speaker(self, turn: Turn):
+        """get_speaker - the speaker name of a turn"""
+        return self.speakers[turn.speaker_id]
+
+    def clear(self):
+        """clear - drop all turns, and the summary"""
+        self.turns.clear()
+        self.n_tokens = 0
+        if self.compactor is not None:
+            self.compactor.clear()
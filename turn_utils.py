@@ -0,0 +1,96 @@
+"""
+turn_utils.py - find the end of the responder's turn in generated text
+
+These run on plain text / token id lists and do not need torch, so they can be used both inside the decode loop
+(generation_utils.TurnEndCriteria, ConversationSession) and in the response post-processing (ai_single_response.isolate_reply)
+without slowing down imports.
+"""
+
+
+def is_name_line(line: str):
+    """
+    is_name_line - True if line is a "name:" tag that starts a turn (the rule token_budget.split_turns uses), and not
+    just a line with a colon in it, like "meet me at 3:30"
+    """
+    return str(line).strip().endswith(":")
+
+
+def find_turn_end(text: str, speaker: str, responder: str):
+    """
+    find_turn_end - find where the responder's turn ends in text generated after the "responder:" tag
+
+    Args:
+        text (str): the generated text (not including the prompt)
+        speaker (str): the name of the speaker
+        responder (str): the name of the responder
+
+    Returns:
+        int: the index in text where the turn ends, or -1 if the turn is not over yet
+    """
+    speaker, responder = speaker.lower(), responder.lower()
+    responder_line_seen = False  # mirrors break_safe in get_bot_response
+    has_content = False
+    pos = 0
+    while pos <= len(text):
+        nl = text.find("\n", pos)
+        line_complete = nl != -1
+        line = (text[pos:nl] if line_complete else text[pos:]).lower()
+        if responder in line:
+            responder_line_seen = True
+        elif line_complete and is_name_line(line):
+            return pos  # a "name:" tag for someone else
+        elif line_complete and speaker in line and not responder_line_seen:
+            return pos
+        elif line_complete and not line.strip() and has_content:
+            return pos  # blank line = turn separator
+        elif line.strip():
+            has_content = True
+        if not line_complete:
+            break
+        pos = nl + 1
+    return -1
+
+
+def get_visible_text(text: str, speaker: str, responder: str):
+    """
+    get_visible_text - the part of partially generated text that can be shown to a user while streaming: everything up
+    to the end of the responder's turn, holding back an unfinished last line that could still turn into a name tag
+
+    Args:
+        text (str): the generated text so far (not including the prompt)
+        speaker (str): the name of the speaker
+        responder (str): the name of the responder
+
+    Returns:
+        str: the visible text
+    """
+    end = find_turn_end(text, speaker, responder)
+    if end != -1:
+        return text[:end]
+    last_nl = text.rfind("\n")
+    last_line = text[last_nl + 1 :].strip().lower()
+    tags = [speaker.lower() + ":", responder.lower() + ":"]
+    if last_line and any(tag.startswith(last_line) for tag in tags):
+        return text[: last_nl + 1]
+    return text
+
+
+def has_repetition(token_ids: list, ngram: int = 4, max_repeats: int = 3):
+    """
+    has_repetition - True if the last ngram tokens have already occurred max_repeats times, i.e. the model is looping
+
+    Args:
+        token_ids (list): generated token ids
+        ngram (int, optional): the n-gram size to check. Defaults to 4.
+        max_repeats (int, optional): how many occurrences count as a loop. Defaults to 3.
+    """
+    if len(token_ids) < ngram * max_repeats:
+        return False
+    tail = token_ids[-ngram:]
+    count = 0
+    for i in range(len(token_ids) - ngram + 1):
+        if token_ids[i : i + ngram] == tail:
+            count += 1
+            if count >= max_repeats:
+                return True
+    return False
@@ -13,12 +13,6 @@ from os.path import basename, getsize, join
 from pathlib import Path
 import logging
 
-import pandas as pd
-import requests
-from natsort import natsorted
-from symspellpy import SymSpell
-from tqdm.auto import tqdm
-
 import warnings
 
 warnings.filterwarnings(
@@ -34,8 +28,19 @@ class DisableLogger:
         logging.disable(logging.NOTSET)
 
 
-with DisableLogger():
-    from cleantext import clean
+_clean = None  # cleantext.clean, imported on first use
+
+
+def clean(text: str, **kwargs):
+    """
+    clean - cleantext.clean, imported on first use so that importing utils stays fast. Same arguments as cleantext.clean.
+    """
+    global _clean
+    if _clean is None:
+        with DisableLogger():
+            from cleantext import clean as cleantext_clean
+        _clean = cleantext_clean
+    return _clean(text, **kwargs)
 
 
 def clear_loggers():
@@ -67,7 +72,8 @@ def remove_trailing_punctuation(text: str):
 
 def correct_phrase_load(my_string: str):
     """
-    correct_phrase_load [basic / unoptimized implementation of SymSpell to correct a string]
+    correct_phrase_load - correct a string with the shared SymSpell corrector (see spell_correct.py, the dictionary is
+    loaded once per process)
 
     Args:
         my_string (str): [text to be corrected]
@@ -75,28 +81,9 @@ def correct_phrase_load(my_string: str):
     Returns:
         str: the corrected string
     """
-    sym_spell = SymSpell(max_dictionary_edit_distance=2, prefix_length=7)
+    from spell_correct import get_corrector
 
-    dictionary_path = (
-        r"symspell_rsc/frequency_dictionary_en_82_765.txt"  # from repo root
-    )
-    bigram_path = (
-        r"symspell_rsc/frequency_bigramdictionary_en_243_342.txt"  # from repo root
-    )
-    # term_index is the column of the term and count_index is the
-    # column of the term frequency
-    sym_spell.load_dictionary(dictionary_path, term_index=0, count_index=1)
-    sym_spell.load_bigram_dictionary(bigram_path, term_index=0, count_index=2)
-
-    # max edit distance per lookup (per single word, not per whole input string)
-    suggestions = sym_spell.lookup_compound(
-        clean(my_string), max_edit_distance=2, ignore_non_words=True
-    )
-    if len(suggestions) < 1:
-        return my_string
-    else:
-        first_result = suggestions[0]
-        return first_result._term
+    return get_corrector().correct(my_string)
 
 
 def fast_scandir(dirname: str):
@@ -140,20 +127,18 @@ def shorten_list(
         no_blanks (bool, optional): if True, blank strings are not added to the new list. Defaults to True.
         verbose (bool, optional): if True, print the list of strings before and after the shorten. Defaults to False.
     """
-    list_of_strings = [
-        str(x) for x in list_of_strings
-    ]  # convert to strings if not already
     shortened_list = []
     total_len = 0
-    for i, string in enumerate(list_of_strings[::-1], start=1):
-
+    for i, string in enumerate(reversed(list_of_strings), start=1):
+        string = str(string)  # convert to strings if not already, only the ones kept
         if len(string.strip()) == 0 and no_blanks:
             continue
         if len(string) + total_len >= max_chars:
             logging.info(f"string # {i} puts total over limit, breaking ")
             break
         total_len += len(string)
-        shortened_list.insert(0, string)
+        shortened_list.append(string)
+    shortened_list.reverse()  # built newest first
     if len(shortened_list) == 0:
         logging.info(f"shortened list with max_chars={max_chars} has no entries")
     if verbose:
@@ -190,6 +175,8 @@ def load_dir_files(
     Returns:
         list or dict: an iterable of filepaths or a dict of filepaths and their respective filenames
     """
+    from natsort import natsorted
+
     appr_files = []
     # r=root, d=directories, f = files
     for r, d, f in os.walk(directory):
@@ -257,6 +244,7 @@ def get_zip_URL(
     verbose: bool = False,
 ):
     """get_zip_URL - download a zip file from a given URL and extract it to a given location"""
+    import requests
 
     r = requests.get(URLtoget, allow_redirects=True)
     names = getFilename_fromCd(r.headers.get("content-disposition"))
@@ -302,6 +290,8 @@ def merge_dataframes(data_dir: str, ext=".xlsx", verbose=False):
     Returns:
         pd.DataFrame(): merged dataframe of all files
     """
+    import pandas as pd
+    from tqdm.auto import tqdm
 
     src = Path(data_dir)
     src_str = str(src.resolve())
@@ -348,6 +338,8 @@ def download_URL(url: str, file=None, dlpath=None, verbose=False):
     -------
     str - path to the downloaded file
     """
+    import requests
+    from tqdm.auto import tqdm
 
     if file is None:
         if "?dl=" in url:
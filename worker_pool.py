@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+worker_pool.py - a pre-fork pool of inference worker processes that share one copy of the model weights
+
+One process with one model cannot keep a many-core CPU busy with concurrent chats: a single generate call only scales to
+a few intra-op threads. A WorkerPool loads the model once in the parent process and forks n_workers workers. The weight
+tensors are never written after loading, so their memory pages stay shared copy-on-write between the parent and all the
+workers (check the pss_mb column of get_stats()): N workers of the 774M model need about the RAM of one, plus activations.
+
+Each worker runs query_gpt_model with threads_per_worker intra-op threads, pinned to its own slice of the CPU cores if
+there are enough of them. Requests go to a shared queue, so whichever worker is idle takes the next one.
+
+The parent loads the model with one intra-op thread and forks before running anything on it: GNU OpenMP (used by the
+torch CPU builds) is not fork-safe once its thread pool has started. Create the pool before using the model in the
+parent process, and not from a process that already has threads running generation.
+
+example:
+    from worker_pool import WorkerPool
+
+    pool = WorkerPool("distilgpt2-tiny-conversational", n_workers=4, threads_per_worker=2)
+    resp = pool.query("hey, what's up?")  # same arguments and return value as query_gpt_model
+    pool.close()
+
+    python worker_pool.py --model GPT2_trivNatQAdailydia_774M_175Ksteps --workers 4 --n-requests 32
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import gc
+import io
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from pathlib import Path
+
+from cancellation import STATUS_OK, CancellationToken
+
+logging.basicConfig(
+    filename=f"LOGFILE-{Path(__file__).stem}.log",
+    filemode="a",
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+
+
+def get_available_cores():
+    """get_available_cores - the ids of the CPU cores this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def get_core_slices(n_workers: int, threads_per_worker: int):
+    """
+    get_core_slices - the CPU cores each worker is pinned to
+
+    Returns:
+        list: one list of core ids per worker, or None per worker if there are not enough cores to give each its own
+    """
+    cores = get_available_cores()
+    if n_workers * threads_per_worker > len(cores):
+        return [None] * n_workers  # oversubscribed, let the OS schedule
+    return [
+        cores[i * threads_per_worker : (i + 1) * threads_per_worker]
+        for i in range(n_workers)
+    ]
+
+
+def get_memory_mb(pid: int):
+    """
+    get_memory_mb - resident (rss) and proportional (pss, shared pages split between the processes sharing them) memory of
+    a process in MB, from /proc/<pid>/smaps_rollup (Linux only)
+
+    Returns:
+        dict: rss_mb and pss_mb, or an empty dict if not available
+    """
+    path = Path(f"/proc/{pid}/smaps_rollup")
+    memory = {}
+    with contextlib.suppress(OSError):
+        for line in path.read_text().splitlines():
+            key, _, value = line.partition(":")
+            if key in ("Rss", "Pss"):
+                memory[f"{key.lower()}_mb"] = round(int(value.split()[0]) / 1024, 1)
+    return memory
+
+
+class WorkerCancellationToken(CancellationToken):
+    """
+    WorkerCancellationToken - the token of a task in a worker process. The absolute deadline is sent along with the task
+    (time.monotonic() is the same clock in all processes of the host, so time spent in the queue counts), and the parent
+    cancels the task by writing its id to cancel_requests[worker_id] (shared memory).
+    """
+
+    def __init__(self, deadline: float, cancel_requests, worker_id: int, task_id: int):
+        super().__init__()
+        self.deadline = deadline
+        self.cancel_requests = cancel_requests
+        self.worker_id = worker_id
+        self.task_id = task_id
+
+    @property
+    def cancelled(self):
+        return self.cancel_requests[self.worker_id] == self.task_id or super().cancelled
+
+
+def worker_main(
+    worker_id: int,
+    ai,
+    folder_path: str,
+    precision: str,
+    n_threads: int,
+    cores: list,
+    tasks,
+    results,
+    current_tasks,
+    cancel_requests,
+):
+    """
+    worker_main - the loop of a worker process: run query_gpt_model for each task until it gets None
+
+    Results are sent as (status, task_id, worker_id, payload) tuples: ("done", ..., (model_resp, printed output)) or
+    ("error", ..., error message). current_tasks[worker_id] is the id of the task being run (-1 when idle), so the parent
+    knows which task was lost if the worker dies, and which worker to cancel a task on (see WorkerCancellationToken).
+    """
+    import torch
+
+    from ai_single_response import query_gpt_model
+
+    # the parent handles Ctrl+C and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    torch.set_num_threads(n_threads)
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, kwargs = task
+        current_tasks[worker_id] = task_id
+        kwargs["token"] = WorkerCancellationToken(
+            kwargs.pop("deadline", None), cancel_requests, worker_id, task_id
+        )
+        # a task whose deadline passed in the queue is not generated (query_gpt_model checks the token first)
+        stdout = io.StringIO()
+        try:
+            # a worker runs one task at a time, so this only captures this task's printouts
+            with contextlib.redirect_stdout(stdout):
+                result = query_gpt_model(
+                    folder_path, aitextgen_obj=ai, precision=precision, **kwargs
+                )
+            results.put(("done", task_id, worker_id, (result, stdout.getvalue())))
+        except Exception as e:
+            results.put(("error", task_id, worker_id, f"{type(e).__name__}: {e}"))
+        current_tasks[worker_id] = -1
+
+
+class WorkerPool:
+    """
+    WorkerPool - forked inference workers sharing the weights of one model loaded in this process (CPU only)
+
+    Args:
+        folder_path (str or Path): the model folder
+        n_workers (int, optional): number of worker processes. Defaults to 2.
+        threads_per_worker (int, optional): intra-op threads of each worker. Defaults to None (the available cores
+            divided between the workers).
+        precision (str, optional): "fp32", "int8" or "bf16", see model_registry.get_model. Defaults to "fp32".
+        verbose (bool, optional): also print what the workers print for each request. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        folder_path: str or Path,
+        n_workers: int = 2,
+        threads_per_worker: int = None,
+        precision: str = "fp32",
+        verbose: bool = False,
+    ):
+        import torch
+
+        from model_registry import get_model
+
+        self.folder_path = str(folder_path)
+        self.precision = precision
+        self.verbose = verbose
+        n_cores = len(get_available_cores())
+        self.n_workers = max(int(n_workers), 1)
+        self.threads_per_worker = threads_per_worker or max(
+            n_cores // self.n_workers, 1
+        )
+        self.stats = {"requests": 0, "errors": 0, "busy_s": 0.0}
+        self._task_ids = itertools.count()
+        self._pending = {}  # task_id -> {"future", "submitted", "token"}
+        self._lock = threading.Lock()
+        self._accepting = True  # False once close() was called
+        self._closed = False  # True once the workers are stopped
+
+        parent_threads = torch.get_num_threads()
+        # keep OpenMP from starting its thread pool before the fork
+        torch.set_num_threads(1)
+        self.ai = get_model(self.folder_path, precision=precision, verbose=verbose)
+        ctx = multiprocessing.get_context("fork")
+        self._tasks = ctx.Queue()
+        self._results = ctx.Queue()
+        self._current_tasks = ctx.Array("q", [-1] * self.n_workers, lock=False)
+        self._cancel_requests = ctx.Array("q", [-1] * self.n_workers, lock=False)
+        # objects that exist now are never scanned by the workers' garbage collector, so it does not write to (and
+        # copy) their pages
+        gc.collect()
+        gc.freeze()
+        self.workers = []
+        for worker_id, cores in enumerate(
+            get_core_slices(self.n_workers, self.threads_per_worker)
+        ):
+            process = ctx.Process(
+                target=worker_main,
+                args=(
+                    worker_id,
+                    self.ai,
+                    self.folder_path,
+                    precision,
+                    self.threads_per_worker,
+                    cores,
+                    self._tasks,
+                    self._results,
+                    self._current_tasks,
+                    self._cancel_requests,
+                ),
+                name=f"inference-worker-{worker_id}",
+                daemon=True,
+            )
+            process.start()
+            self.workers.append(process)
+        gc.unfreeze()
+        torch.set_num_threads(parent_threads)
+        self.worker_requests = [0] * self.n_workers
+        self._collector = threading.Thread(
+            target=self._collect, name="worker-pool-results", daemon=True
+        )
+        self._collector.start()
+        logging.info(
+            f"started {self.n_workers} inference workers with {self.threads_per_worker} threads each"
+        )
+
+    def submit(self, **kwargs):
+        """
+        submit - queue a query_gpt_model call for the next idle worker
+
+        Args:
+            **kwargs: query_gpt_model arguments, except folder_path, aitextgen_obj and precision (set by the pool) and
+                the caches (use query for those). A token is not sent to the worker: its deadline is, and cancelling it
+                stops the task in the worker within about 0.1 s (a queued task is cancelled when a worker takes it).
+
+        Returns:
+            concurrent.futures.Future: resolves to the query_gpt_model return value (with a status key)
+        """
+        if not self._accepting:
+            raise RuntimeError("the worker pool is closed")
+        if not any(process.is_alive() for process in self.workers):
+            raise RuntimeError("all inference workers have died, see the log")
+        token = kwargs.pop("token", None)
+        if token is not None and token.deadline is not None:
+            kwargs["deadline"] = token.deadline
+        future = concurrent.futures.Future()
+        task_id = next(self._task_ids)
+        with self._lock:
+            self._pending[task_id] = {
+                "future": future,
+                "submitted": time.perf_counter(),
+                "token": token,
+            }
+        self._tasks.put((task_id, kwargs))
+        return future
+
+    def query(
+        self,
+        prompt_msg: str,
+        conversation_history: list = None,
+        speaker: str = None,
+        responder: str = None,
+        resp_length: int = 48,
+        kparam: int = 20,
+        temp: float = 0.4,
+        top_p: float = 0.9,
+        response_cache=None,
+        semantic_cache=None,
+        timeout: float = None,
+        **kwargs,
+    ):
+        """
+        query - query_gpt_model in a worker: same arguments (without folder_path, aitextgen_obj and precision) and return
+        value. The caches are looked up in this process, a cached reply does not go to a worker.
+
+        Args:
+            timeout (float, optional): seconds to wait for the worker. Defaults to None (no limit).
+
+        Returns:
+            model_resp (dict): out_text and full_conv, as returned by query_gpt_model
+        """
+        from ai_single_response import (
+            add_reply_to_history,
+            get_speaker_names,
+            lookup_response_caches,
+            make_new_turn,
+        )
+
+        speaker, responder = get_speaker_names(self.folder_path, speaker, responder)
+        sampling = dict(kparam=kparam, top_p=top_p, temp=temp, resp_length=resp_length)
+        cached, store_reply = lookup_response_caches(
+            self.folder_path,
+            prompt_msg,
+            conversation_history,
+            speaker,
+            responder,
+            sampling,
+            response_cache=response_cache,
+            semantic_cache=semantic_cache,
+            precision=self.precision,
+        )
+        if cached is not None:
+            prompt_list = list(conversation_history or []) + make_new_turn(
+                prompt_msg, speaker, responder
+            )
+            return add_reply_to_history(cached, prompt_list)
+
+        future = self.submit(
+            prompt_msg=prompt_msg,
+            conversation_history=conversation_history,
+            speaker=speaker,
+            responder=responder,
+            **sampling,
+            **kwargs,
+        )
+        model_resp = future.result(timeout)
+        if model_resp.get("status", STATUS_OK) == STATUS_OK:
+            store_reply(model_resp["out_text"])  # partial replies are not cached
+        return model_resp
+
+    def _collect(self):
+        """resolve the futures with the results sent back by the workers"""
+        while True:
+            self._send_cancellations()
+            try:
+                status, task_id, worker_id, payload = self._results.get(timeout=0.1)
+            except queue.Empty:
+                if self._closed:
+                    break  # the workers are stopped and all their results are in
+                self._check_workers()
+                continue
+            except (EOFError, OSError):
+                break  # the queue was closed
+            with self._lock:
+                task = self._pending.pop(task_id, None)
+                if task is None:
+                    continue
+                self.stats["requests"] += 1
+                self.stats["busy_s"] += time.perf_counter() - task["submitted"]
+                self.worker_requests[worker_id] += 1
+            if status == "done":
+                result, stdout = payload
+                if self.verbose and stdout:
+                    print(stdout, end="")
+                task["future"].set_result(result)
+            else:
+                with self._lock:
+                    self.stats["errors"] += 1
+                logging.error(f"inference worker {worker_id} failed: {payload}")
+                task["future"].set_exception(RuntimeError(payload))
+
+    def _send_cancellations(self):
+        """tell the workers running tasks whose token was cancelled to stop them"""
+        with self._lock:
+            cancelled = {
+                task_id
+                for task_id, task in self._pending.items()
+                if task["token"] is not None and task["token"].cancelled
+            }
+        if not cancelled:
+            return
+        for worker_id, task_id in enumerate(self._current_tasks):
+            if task_id in cancelled:
+                self._cancel_requests[worker_id] = task_id
+
+    def _check_workers(self):
+        """fail the tasks of workers that died (e.g. killed by the OOM killer), they are not restarted"""
+        dead = [i for i, process in enumerate(self.workers) if not process.is_alive()]
+        lost = {}  # task_id -> worker_id
+        for worker_id in dead:
+            if self._current_tasks[worker_id] != -1:
+                lost[self._current_tasks[worker_id]] = worker_id
+                self._current_tasks[worker_id] = -1
+        with self._lock:
+            tasks = {
+                task_id: self._pending.pop(task_id)
+                for task_id in lost
+                if task_id in self._pending
+            }
+            self.stats["errors"] += len(tasks)
+        for task_id, task in tasks.items():
+            logging.error(f"inference worker {lost[task_id]} died")
+            task["future"].set_exception(
+                RuntimeError(f"inference worker {lost[task_id]} died")
+            )
+
+    def close(self, timeout: float = 10):
+        """close - let the workers finish their current task, stop them, and fail whatever is still queued"""
+        if not self._accepting:
+            return
+        self._accepting = False
+        for _ in self.workers:
+            self._tasks.put(None)
+        for process in self.workers:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._closed = True
+        self._collector.join()
+        with self._lock:
+            tasks, self._pending = list(self._pending.values()), {}
+        for task in tasks:
+            task["future"].set_exception(RuntimeError("the worker pool was closed"))
+
+    def get_stats(self):
+        """get_stats - request counts, requests per worker, workers alive, and memory per process (rss and pss in MB)"""
+        return dict(
+            self.stats,
+            busy_s=round(self.stats["busy_s"], 2),
+            queued=len(self._pending),
+            worker_requests=list(self.worker_requests),
+            workers_alive=sum(process.is_alive() for process in self.workers),
+            memory_mb={
+                "parent": get_memory_mb(os.getpid()),
+                **{
+                    process.name: get_memory_mb(process.pid)
+                    for process in self.workers
+                    if process.is_alive()
+                },
+            },
+        )
+
+
+def get_parser():
+    """
+    get_parser [a helper function for the argparse module]
+
+    Returns: argparse.ArgumentParser
+    """
+    from model_registry import PRECISIONS
+
+    parser = argparse.ArgumentParser(
+        description="send concurrent requests to a pool of forked inference workers and report throughput and memory"
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        required=False,
+        type=str,
+        default="distilgpt2-tiny-conversational",
+        help="folder - with respect to git directory of your repo that has the model files in it (pytorch.bin + "
+        "config.json). You can also pass the huggingface model name (e.g. distilgpt2)",
+    )
+    parser.add_argument(
+        "--workers",
+        required=False,
+        type=int,
+        default=2,
+        help="number of worker processes",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        required=False,
+        type=int,
+        default=None,
+        help="intra-op threads of each worker (default: the cores divided between the workers)",
+    )
+    parser.add_argument(
+        "--precision",
+        required=False,
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="model precision",
+    )
+    parser.add_argument(
+        "--n-requests",
+        required=False,
+        type=int,
+        default=16,
+        help="number of concurrent requests to send",
+    )
+    parser.add_argument(
+        "--prompt",
+        required=False,
+        type=str,
+        default="hey, what's up?",
+        help="the prompt for every request",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        default=False,
+        action="store_true",
+        help="pass this argument if you want all the printouts",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    from inference_daemon import model_arg_to_path
+
+    args = get_parser().parse_args()
+    pool = WorkerPool(
+        model_arg_to_path(args.model),
+        n_workers=args.workers,
+        threads_per_worker=args.threads_per_worker,
+        precision=args.precision,
+        verbose=args.verbose,
+    )
+    print(
+        f"{pool.n_workers} workers with {pool.threads_per_worker} threads each, sending {args.n_requests} requests"
+    )
+    st = time.perf_counter()
+    futures = [pool.submit(prompt_msg=args.prompt) for _ in range(args.n_requests)]
+    replies = [future.result()["out_text"] for future in futures]
+    rt = time.perf_counter() - st
+    print(f"sample reply: {replies[0]}")
+    print(
+        f"{args.n_requests} requests in {round(rt, 2)} s ({round(args.n_requests / rt, 2)} requests/s)"
+    )
+    print(f"pool stats: {pool.get_stats()}")
+    pool.close()